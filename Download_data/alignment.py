@@ -0,0 +1,258 @@
+import datetime
+from Download_data.utils_dates import to_datetime
+from Download_data.loader import get_local_files, load_CDF_arrays
+
+
+"""
+Alignment of OMNI solar wind data to the times of RBSP samples.
+
+OMNI variables are interpolated (or nearest-matched) at an array of RBSP times
+with sorted-array searches over whole blocks of months at once, instead of one
+lookup per sample. The RBSP times are processed in chunks of chunk_months, and
+only the OMNI files of each chunk are loaded, so memory stays bounded for
+mission-long ranges:
+
+    data = load_CDFfiles({'dataset': 'emfisis', 'probe': 'a'}, start, end, local_root_dir, ['Epoch', 'Mag'])
+    omni = align_OMNI(data['Epoch'], local_root_dir, ['BZ_GSM', 'flow_speed'], res='1min', lag=[0, 1800])
+
+OMNI fill values are replaced by NaN, and samples with no OMNI data within
+max_gap are NaN too.
+"""
+
+
+# Cadencia de los datos OMNI en segundos, según la resolución
+OMNI_CADENCE = {'1min': 60, '5min': 300, '1h': 3600}
+
+
+def to_datetime64(times):
+
+    '''
+    Convert an array of times to numpy.datetime64[ns].
+
+    Args:
+        - times (array-like): Times as datetime64, or as raw CDF epochs as read from a CDF file
+          (CDF_EPOCH, CDF_EPOCH16 or CDF_TIME_TT2000, told apart by cdflib from their type).
+
+    Returns:
+        - times (numpy.ndarray): The times as datetime64[ns].
+    '''
+
+    import numpy as np
+
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.datetime64):
+        return times.astype('datetime64[ns]')
+    if times.size == 0:
+        return np.empty(times.shape, dtype='datetime64[ns]')
+
+    import cdflib
+
+    return np.asarray(cdflib.cdfepoch.to_datetime(times), dtype='datetime64[ns]').reshape(times.shape)
+
+
+def _get_OMNI_file_start(date, res):
+
+    # Los archivos OMNI son mensuales (1min y 5min) o semestrales (1h): retrocedemos al
+    # inicio del archivo que contiene la fecha
+    month = date.month if res != '1h' else (1 if date.month < 7 else 7)
+
+    return datetime.datetime(date.year, month, 1)
+
+
+def load_OMNI(start_date, end_date, local_root_dir, variables, res='1min', typ='hro', n_processes=None):
+
+    '''
+    Load some OMNI variables from the local OMNI tree (get_local_dir_OMNI layout), with
+    their fill values replaced by NaN.
+
+    Args:
+        - start_date (datetime.date or str): The start date of the range.
+        - end_date (datetime.date or str): The end date of the range.
+        - local_root_dir (str): The root directory on the local machine where OMNI files are saved.
+        - variables (list): The names of the OMNI variables (e.g. ['BZ_GSM', 'flow_speed']).
+        - res (str, optional): The time resolution of the data files ('1min', '5min' or '1h').
+          Defaults to '1min'.
+        - typ (str, optional): The type of OMNI data file ('hro' or 'hro2'). Defaults to 'hro'.
+        - n_processes (int, optional): Number of processes that read files (see
+          loader.load_CDF_arrays). Defaults to None.
+
+    Returns:
+        - times (numpy.ndarray): The OMNI times as datetime64[ns], in whole files covering the range.
+        - values (dict): Dictionary variable -> numpy.ndarray of float64.
+    '''
+
+    import numpy as np
+
+    start = _get_OMNI_file_start(to_datetime(start_date), res)
+    paths = get_local_files({'dataset': 'omni', 'res': res, 'typ': typ}, start, end_date, local_root_dir)
+    data = load_CDF_arrays(paths, ['Epoch'] + list(variables), n_processes=n_processes)
+
+    fill_values = _get_fill_values(paths[0], variables) if paths else {}
+    values = {}
+    for variable in variables:
+        value = np.asarray(data[variable], dtype=float)
+        if fill_values.get(variable) is not None:
+            value[value == fill_values[variable]] = np.nan
+        values[variable] = value
+
+    return to_datetime64(data['Epoch']), values
+
+
+def _get_fill_values(path, variables):
+
+    # El valor de relleno de cada variable está en su atributo FILLVAL
+    import cdflib
+    import numpy as np
+
+    cdf = cdflib.CDF(path)
+    fill_values = {}
+    for variable in variables:
+        fill_value = cdf.varattsget(variable).get('FILLVAL')
+        fill_values[variable] = float(np.ravel(fill_value)[0]) if fill_value is not None else None
+
+    return fill_values
+
+
+def interpolate_series(source_times, source_values, times, method='linear', max_gap=None):
+
+    '''
+    Evaluate a time series at other times, in one vectorized pass.
+
+    Args:
+        - source_times (numpy.ndarray): The sorted times of the series, as datetime64.
+        - source_values (numpy.ndarray): The values of the series, one per time (NaN for missing).
+        - times (numpy.ndarray): The times where the series is evaluated, as datetime64.
+        - method (str, optional): 'linear' to interpolate between the two samples around each
+          time, or 'nearest' to take the closest sample. Defaults to 'linear'.
+        - max_gap (float, optional): For 'linear', the maximum time in seconds between the two
+          samples used; for 'nearest', the maximum distance in seconds to the sample taken.
+          Times farther from data get NaN. Defaults to None (no limit).
+
+    Returns:
+        - values (numpy.ndarray): The values at times, as float64.
+
+    Raises:
+        - ValueError: If the method is unknown.
+    '''
+
+    import numpy as np
+
+    result = np.full(len(times), np.nan)
+    if len(source_times) == 0 or len(times) == 0:
+        return result
+
+    # Trabajamos en nanosegundos relativos al primer dato, para no perder precisión al pasar a float
+    origin = source_times[0]
+    source = (source_times - origin).astype('timedelta64[ns]').astype(np.int64)
+    target = (times - origin).astype('timedelta64[ns]').astype(np.int64)
+    source_values = np.asarray(source_values, dtype=float)
+    gap = None if max_gap is None else max_gap*1e9
+
+    # Índice del primer dato posterior a cada instante
+    right = np.searchsorted(source, target, side='right')
+    left = right - 1
+    inside_left = left >= 0
+    inside_right = right < len(source)
+    left = np.clip(left, 0, len(source) - 1)
+    right = np.clip(right, 0, len(source) - 1)
+
+    if method == 'linear':
+        valid = inside_left & (inside_right | (target == source[left]))
+        span = (source[right] - source[left]).astype(float)
+        if gap is not None:
+            valid &= (span <= gap) | (target == source[left])
+        weight = np.divide(target - source[left], span, out=np.zeros(len(target)), where=span > 0)
+        value = source_values[left] + weight*(source_values[right] - source_values[left])
+        # En un dato exacto no mezclamos con el vecino (que puede ser NaN)
+        value = np.where(weight == 0, source_values[left], value)
+        result[valid] = value[valid]
+
+    elif method == 'nearest':
+        distance_left = np.where(inside_left, target - source[left], np.iinfo(np.int64).max)
+        distance_right = np.where(inside_right, source[right] - target, np.iinfo(np.int64).max)
+        nearest = np.where(distance_right < distance_left, right, left)
+        distance = np.minimum(distance_left, distance_right)
+        valid = distance <= gap if gap is not None else np.ones(len(target), dtype=bool)
+        result[valid] = source_values[nearest[valid]]
+
+    else:
+        raise ValueError("Unknown method %r (valid: 'linear', 'nearest')" % method)
+
+    return result
+
+
+def align_OMNI(times, local_root_dir, variables, res='1min', typ='hro', method='linear', lag=0,
+               max_gap=None, chunk_months=12, n_processes=None):
+
+    '''
+    Attach OMNI variables to the times of RBSP samples, interpolated or nearest-matched,
+    optionally lagged.
+
+    The times are processed in chunks of chunk_months calendar months. For every chunk,
+    the OMNI files that cover it (with the lags and max_gap) are loaded once and all its
+    samples are aligned with sorted-array searches.
+
+    Args:
+        - times (array-like): The RBSP times, as datetime64 or as raw CDF epochs (e.g. the 'Epoch'
+          array returned by loader.load_CDFfiles). They do not need to be sorted.
+        - local_root_dir (str): The root directory on the local machine where OMNI files are saved.
+        - variables (list): The names of the OMNI variables (e.g. ['BZ_GSM', 'flow_speed']).
+        - res (str, optional): The time resolution of the OMNI files ('1min', '5min' or '1h').
+          Defaults to '1min'.
+        - typ (str, optional): The type of OMNI data file ('hro' or 'hro2'). Defaults to 'hro'.
+        - method (str, optional): 'linear' or 'nearest' (see interpolate_series). Defaults to 'linear'.
+        - lag (float or list, optional): Time lag in seconds: each sample at time t gets the OMNI
+          value at t - lag. A list of lags gives one column per lag. Defaults to 0.
+        - max_gap (float, optional): Maximum gap in seconds bridged by the alignment (see
+          interpolate_series). Defaults to None: twice the OMNI cadence for 'linear', and half the
+          cadence for 'nearest'.
+        - chunk_months (int, optional): Number of months of RBSP times aligned at once. Defaults to 12.
+        - n_processes (int, optional): Number of processes that read OMNI files. Defaults to None.
+
+    Returns:
+        - values (dict): Dictionary variable -> numpy.ndarray of float64, with shape (len(times),)
+          for a single lag or (len(times), len(lag)) for a list of lags.
+    '''
+
+    import numpy as np
+
+    times = to_datetime64(times)
+    lags = np.atleast_1d(np.asarray(lag, dtype=float))
+    if max_gap is None:
+        max_gap = OMNI_CADENCE[res]*(2 if method == 'linear' else 0.5)
+
+    values = dict((variable, np.full((len(times), len(lags)), np.nan)) for variable in variables)
+
+    # Ordenamos una vez, y devolvemos los resultados en el orden original
+    order = np.argsort(times, kind='stable')
+    sorted_times = times[order]
+
+    if len(times):
+        first = sorted_times[0].astype('datetime64[M]')
+        last = sorted_times[-1].astype('datetime64[M]') + 1
+        edges = np.arange(first, last + chunk_months, chunk_months).astype('datetime64[ns]')
+        bounds = np.searchsorted(sorted_times, edges)
+
+        # Cuánto antes y después de cada bloque necesitamos datos OMNI
+        before = np.timedelta64(int((lags.max() + max_gap)*1e9), 'ns')
+        after = np.timedelta64(int((max_gap - lags.min())*1e9), 'ns')
+
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if start == end:
+                continue
+            chunk = sorted_times[start:end]
+            load_start = str((chunk[0] - before).astype('datetime64[D]'))
+            load_end = str((chunk[-1] + after).astype('datetime64[D]'))
+            omni_times, omni_values = load_OMNI(load_start, load_end, local_root_dir, variables,
+                                                res=res, typ=typ, n_processes=n_processes)
+
+            for i, lag_seconds in enumerate(lags):
+                shifted = chunk - np.timedelta64(int(lag_seconds*1e9), 'ns')
+                for variable in variables:
+                    values[variable][order[start:end], i] = interpolate_series(omni_times, omni_values[variable],
+                                                                               shifted, method, max_gap)
+
+    if np.ndim(lag) == 0:
+        values = dict((variable, value[:, 0]) for variable, value in values.items())
+
+    return values
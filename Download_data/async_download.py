@@ -0,0 +1,420 @@
+import os
+import time
+import asyncio
+import hashlib
+from Download_data.utils_metrics import emit_event
+from Download_data.download_engine import _call_on_complete
+from Download_data.utils_bandwidth import throttle_async
+from Download_data.utils_retry import call_with_retry_async, DEFAULT_MAX_RETRIES
+from Download_data.utils_lock import get_lock_path, try_acquire_lock, release_lock, LOCK_POLL_SECONDS
+from Download_data.utils_session import get_timeout, get_verify
+from Download_data.utils_download import (get_expected_size, get_validators, get_part_origin, set_part_origin,
+                                          remove_part, get_range_total, get_if_range, finish_part,
+                                          DOWNLOAD_CHUNK_SIZE, PART_SUFFIX)
+from Download_data.utils_listing import lookup_listing, store_listing, parse_links, DEFAULT_LISTING_TTL
+from Download_data.rbsp.download_ect import get_listing_urls_ECT, get_jobs_ECT
+from Download_data.rbsp.download_emfisis import get_listing_urls_EMFISIS, get_jobs_EMFISIS
+from Download_data.omni.download_omni import get_jobs_OMNI
+
+
+"""
+asyncio counterpart of the listing resolution and file transfer steps, to embed
+the downloads in an asyncio application without blocking its event loop.
+
+All the requests of a run share one aiohttp session, the number of requests in
+flight is bounded, and transient errors are retried with the policy of the
+synchronous engine (Download_data.utils_retry). Listings go through the same
+cache as the synchronous downloaders (Download_data.utils_listing), so the job
+lists are the same as those of get_jobs_ECT / get_jobs_EMFISIS / get_jobs_OMNI.
+The disk work runs in worker threads (asyncio.to_thread), and the downloads emit
+the same instrumentation events as the synchronous ones (see utils_metrics).
+
+Requires the optional dependency aiohttp.
+
+Example:
+
+    async with open_session_async() as session:
+        jobs = await get_jobs_ECT_async(session, start, end, remote_root_dir, local_root_dir, 'both', 'rept')
+        with get_inventory_callback(local_root_dir) as recorder:
+            async for local_path in download_jobs_async(session, jobs, on_complete=recorder):
+                ...
+"""
+
+
+DEFAULT_MAX_CONCURRENCY = 32
+
+
+def open_session_async(max_concurrency=DEFAULT_MAX_CONCURRENCY, max_per_host=0):
+
+    '''
+    Create the aiohttp session used by the asynchronous functions, with the TLS
+    verification and timeout configured in Download_data.utils_session.
+
+    Args:
+        - max_concurrency (int, optional): Maximum number of open connections. Defaults to 32.
+        - max_per_host (int, optional): Maximum number of open connections per host (0 for no
+          limit). Defaults to 0.
+
+    Returns:
+        - session (aiohttp.ClientSession): The session, to be used as an async context manager.
+    '''
+
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError('The asynchronous API requires aiohttp (pip install aiohttp)')
+
+    timeout = get_timeout()
+    if isinstance(timeout, tuple):
+        client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout[0], sock_read=timeout[1])
+    else:
+        client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+
+    verify = get_verify()
+    if isinstance(verify, str):
+        import ssl
+        ssl_option = ssl.create_default_context(cafile=verify)
+    else:
+        ssl_option = None if verify else False
+
+    connector = aiohttp.TCPConnector(limit=max_concurrency, limit_per_host=max_per_host, ssl=ssl_option)
+
+    return aiohttp.ClientSession(connector=connector, timeout=client_timeout)
+
+
+async def read_site_content_async(session, url):
+
+    '''
+    Retrieve the list of filenames linked from a remote directory index page.
+
+    Args:
+        - session (aiohttp.ClientSession): The session used for the request.
+        - url (str): The URL of the remote directory.
+
+    Returns:
+        - remote_files (list): The text of every link of the page.
+    '''
+
+    async with session.get(url) as response:
+        response.raise_for_status()
+        content = await response.read()
+
+    return parse_links(content)
+
+
+async def fetch_listings_async(session, urls, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                               cache_dir=None, ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Fetch concurrently the remote directory listings that are not cached yet, and
+    store them in the listing cache.
+
+    Args:
+        - session (aiohttp.ClientSession): The session used for the requests.
+        - urls (list): The URLs of the remote directories.
+        - max_concurrency (int, optional): Maximum number of requests in flight. Defaults to 32.
+        - cache_dir (str, optional): Directory where listings are persisted between runs. Defaults to None.
+        - ttl (float, optional): Maximum age in seconds of a listing read from cache_dir. Defaults to one day.
+
+    Returns:
+        - None
+    '''
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(url):
+        async with semaphore:
+            start = time.perf_counter()
+            files = await call_with_retry_async(read_site_content_async, session, url, url=url)
+            emit_event('listing', url, seconds=time.perf_counter() - start, files=len(files))
+        store_listing(url, files, cache_dir=cache_dir)
+
+    missing = [url for url in dict.fromkeys(urls) if lookup_listing(url, cache_dir=cache_dir, ttl=ttl) is None]
+    await asyncio.gather(*[fetch(url) for url in missing])
+
+    return
+
+
+async def get_jobs_ECT_async(session, start_date, end_date, remote_root_dir, local_root_dir, probe, instrument, level="3",
+                             max_concurrency=DEFAULT_MAX_CONCURRENCY, listing_cache_dir=None, listing_ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Asynchronous counterpart of download_ect.get_jobs_ECT: the yearly listings of the
+    range are fetched concurrently, and the jobs are then resolved against them.
+
+    Args:
+        - session (aiohttp.ClientSession): The session used for the requests.
+        - start_date, end_date, remote_root_dir, local_root_dir, probe, instrument, level:
+          As in download_ect.get_jobs_ECT.
+        - max_concurrency (int, optional): Maximum number of requests in flight. Defaults to 32.
+        - listing_cache_dir (str, optional): Directory where listings are persisted between runs. Defaults to None.
+        - listing_ttl (float, optional): Maximum age in seconds of a listing read from listing_cache_dir.
+
+    Returns:
+        - jobs (list): List of (url, local_path) tuples, ordered by date and probe.
+    '''
+
+    urls = get_listing_urls_ECT(start_date, end_date, remote_root_dir, probe, instrument, level)
+    await fetch_listings_async(session, urls, max_concurrency=max_concurrency,
+                               cache_dir=listing_cache_dir, ttl=listing_ttl)
+
+    return get_jobs_ECT(start_date, end_date, remote_root_dir, local_root_dir, probe, instrument, level,
+                        listing_cache_dir=listing_cache_dir, listing_ttl=listing_ttl)
+
+
+async def get_jobs_EMFISIS_async(session, start_date, end_date, remote_root_dir, local_root_dir, probe, level="3",
+                                 interval=4, coordinates='geo', max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                                 listing_cache_dir=None, listing_ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Asynchronous counterpart of download_emfisis.get_jobs_EMFISIS: the yearly listings
+    of the range are fetched concurrently, and the jobs are then resolved against them.
+
+    Args:
+        - session (aiohttp.ClientSession): The session used for the requests.
+        - start_date, end_date, remote_root_dir, local_root_dir, probe, level, interval, coordinates:
+          As in download_emfisis.get_jobs_EMFISIS.
+        - max_concurrency (int, optional): Maximum number of requests in flight. Defaults to 32.
+        - listing_cache_dir (str, optional): Directory where listings are persisted between runs. Defaults to None.
+        - listing_ttl (float, optional): Maximum age in seconds of a listing read from listing_cache_dir.
+
+    Returns:
+        - jobs (list): List of (url, local_path) tuples, ordered by date and probe.
+    '''
+
+    urls = get_listing_urls_EMFISIS(start_date, end_date, remote_root_dir, probe, level, interval, coordinates)
+    await fetch_listings_async(session, urls, max_concurrency=max_concurrency,
+                               cache_dir=listing_cache_dir, ttl=listing_ttl)
+
+    return get_jobs_EMFISIS(start_date, end_date, remote_root_dir, local_root_dir, probe, level, interval, coordinates,
+                            listing_cache_dir=listing_cache_dir, listing_ttl=listing_ttl)
+
+
+async def get_jobs_OMNI_async(session, start_date, end_date, remote_root_dir, local_root_dir, res="1min", typ="hro"):
+
+    '''
+    Asynchronous counterpart of download_omni.get_jobs_OMNI. The names of the OMNI files
+    follow from their dates, so no listing is fetched and the session is not used; it is
+    taken for symmetry with get_jobs_ECT_async and get_jobs_EMFISIS_async.
+
+    Args:
+        - session (aiohttp.ClientSession): The session of the run.
+        - start_date, end_date, remote_root_dir, local_root_dir, res, typ: As in download_omni.get_jobs_OMNI.
+
+    Returns:
+        - jobs (list): List of (url, local_path) tuples, ordered by date.
+    '''
+
+    return get_jobs_OMNI(start_date, end_date, remote_root_dir, local_root_dir, res, typ)
+
+
+async def download_file_async(session, url, local_path, chunk_size=DOWNLOAD_CHUNK_SIZE, validate_cdf=True):
+
+    '''
+    Asynchronous counterpart of utils_download.download_file: the file is claimed with
+    '<local_path>.lock', streamed to '<local_path>.part', resumed with a Range (and If-Range)
+    request if a partial file from the same URL exists, validated and renamed into place.
+
+    Only the requests run on the event loop: the disk work (lock files, writes, the CDF
+    check and the rename) runs in worker threads, so a slow disk or network filesystem
+    does not stall the other downloads. The data is written in blocks of chunk_size bytes,
+    however small the chunks the server sends, and its checksum is computed on the way
+    (see utils_download.pop_file_checksum).
+
+    Args:
+        - session (aiohttp.ClientSession): The session used for the request.
+        - url (str): The full URL of the file to download.
+        - local_path (str): The local path where the file will be saved.
+        - chunk_size (int, optional): Size in bytes of the chunks written to disk. Defaults to 1 MiB.
+        - validate_cdf (bool, optional): Whether to check that the file is a valid CDF file. Defaults to True.
+
+    Returns:
+        - downloaded (bool): True if the file was downloaded, False if it already existed.
+
+    Raises:
+        - aiohttp.ClientResponseError: If the server answers with an error status.
+        - IOError: If the file is incomplete or not a valid CDF file.
+    '''
+
+    if await asyncio.to_thread(os.path.exists, local_path):
+        return False
+
+    await asyncio.to_thread(os.makedirs, os.path.dirname(local_path), exist_ok=True)
+
+    # Reclamamos el archivo como download_file, esperando sin bloquear el event loop
+    lock_path = get_lock_path(local_path)
+    while not await asyncio.to_thread(try_acquire_lock, lock_path):
+        if await asyncio.to_thread(os.path.exists, local_path):
+            return False
+        await asyncio.sleep(LOCK_POLL_SECONDS)
+    try:
+        if await asyncio.to_thread(os.path.exists, local_path):
+            return False
+        return await _transfer_file_async(session, url, local_path, chunk_size, validate_cdf)
+    finally:
+        await asyncio.to_thread(release_lock, lock_path)
+
+
+def _open_part(url, part_path):
+
+    # Sólo continuamos una descarga a medias que empezó en esta misma URL; devuelve de dónde viene
+    # y cuántos bytes tiene
+    origin = get_part_origin(part_path)
+    if os.path.exists(part_path) and origin.get('url') != url:
+        remove_part(part_path)
+
+    return origin, os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+
+def _read_digest(part_path, chunk_size):
+
+    # Checksum del comienzo ya guardado de una descarga que se continúa
+    digest = hashlib.sha256()
+    with open(part_path, 'rb') as file:
+        for block in iter(lambda: file.read(chunk_size), b''):
+            digest.update(block)
+
+    return digest
+
+
+def _write_chunks(file, digest, chunks):
+
+    # Escribe un bloque de trozos recibidos (en un hilo) y devuelve cuánto tardó
+    start = time.perf_counter()
+    for chunk in chunks:
+        file.write(chunk)
+        digest.update(chunk)
+
+    return time.perf_counter() - start
+
+
+async def _transfer_file_async(session, url, local_path, chunk_size, validate_cdf):
+
+    part_path = local_path + PART_SUFFIX
+
+    origin, offset = await asyncio.to_thread(_open_part, url, part_path)
+    headers = {'Accept-Encoding': 'identity'}
+    if offset > 0:
+        headers['Range'] = 'bytes=%d-' % offset
+        if get_if_range(origin):
+            headers['If-Range'] = get_if_range(origin)
+
+    start = time.perf_counter()
+    async with session.get(url, headers=headers) as response:
+        emit_event('first_byte', url, seconds=time.perf_counter() - start, status=response.status)
+        if response.status == 416 and offset > 0:
+            # Como en utils_download: el archivo parcial ya estaba completo, o partimos de cero una vez
+            if get_range_total(response.headers) == offset:
+                digest = await asyncio.to_thread(_read_digest, part_path, chunk_size)
+                await asyncio.to_thread(finish_part, url, part_path, local_path, offset, validate_cdf,
+                                        digest.hexdigest())
+                return True
+            await asyncio.to_thread(remove_part, part_path)
+            return await _transfer_file_async(session, url, local_path, chunk_size, validate_cdf)
+        response.raise_for_status()
+
+        if response.status != 206:
+            offset = 0
+        expected_size = get_expected_size(response.status, response.headers, offset)
+        if offset == 0:
+            await asyncio.to_thread(set_part_origin, part_path, get_validators(response.headers, expected_size, url))
+
+        digest = (await asyncio.to_thread(_read_digest, part_path, chunk_size) if offset > 0
+                  else hashlib.sha256())
+
+        # Juntamos los trozos (aiohttp suele entregar pocos KB) hasta chunk_size antes de cada
+        # escritura, para no pagar un paso a otro hilo por trozo
+        transfer_start = time.perf_counter()
+        write_seconds = 0.0
+        n_bytes = 0
+        buffer, buffered = [], 0
+        file = await asyncio.to_thread(open, part_path, 'ab' if offset > 0 else 'wb')
+        try:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                await throttle_async(len(chunk))
+                buffer.append(chunk)
+                buffered += len(chunk)
+                n_bytes += len(chunk)
+                if buffered >= chunk_size:
+                    write_seconds += await asyncio.to_thread(_write_chunks, file, digest, buffer)
+                    buffer, buffered = [], 0
+            if buffer:
+                write_seconds += await asyncio.to_thread(_write_chunks, file, digest, buffer)
+        finally:
+            await asyncio.to_thread(file.close)
+        emit_event('transfer', url, seconds=time.perf_counter() - transfer_start - write_seconds, bytes=n_bytes)
+        emit_event('write', url, seconds=write_seconds, bytes=n_bytes)
+
+    await asyncio.to_thread(finish_part, url, part_path, local_path, expected_size, validate_cdf,
+                            digest.hexdigest())
+
+    return True
+
+
+async def download_jobs_async(session, jobs, max_concurrency=DEFAULT_MAX_CONCURRENCY, on_error=None,
+                              max_retries=DEFAULT_MAX_RETRIES, on_complete=None):
+
+    '''
+    Run a list of download jobs concurrently and yield the local path of each file as
+    soon as it is on disk (downloaded or already existing), in completion order.
+
+    At most max_concurrency jobs exist as tasks at any time (the next ones are started
+    as the running ones finish), so a long job list costs no more memory than a short
+    one. Transient errors are retried with the policy of the synchronous engine (see
+    utils_retry.call_with_retry_async).
+
+    Args:
+        - session (aiohttp.ClientSession): The session used for the requests.
+        - jobs (iterable): The (url, local_path) tuples.
+        - max_concurrency (int, optional): Maximum number of downloads in flight. Defaults to 32.
+        - on_error (callable, optional): Function called as on_error(url, local_path, exception) for
+          each failed job. Defaults to None, which prints the error.
+        - max_retries (int, optional): Maximum number of retries of a file after a transient error
+          (timeout, connection reset, truncated transfer, HTTP 429 or 5xx). Defaults to 5.
+        - on_complete (callable, optional): Function called as on_complete(local_path) in the event
+          loop thread for every job whose file is on disk (downloaded or already existing), as in
+          download_engine.run_download_jobs, e.g. the recorder of inventory.get_inventory_callback.
+          Its errors are reported, and do not count the job as failed. Defaults to None.
+
+    Yields:
+        - local_path (str): The local path of each completed job.
+    '''
+
+    async def run_job(job):
+        url, local_path = job[0], job[1]
+        start = time.perf_counter()
+        try:
+            downloaded = await call_with_retry_async(download_file_async, session, url, local_path,
+                                                     max_retries=max_retries, url=url)
+        except Exception as e:
+            emit_event('job', url, seconds=time.perf_counter() - start, status='failed')
+            if on_error is not None:
+                on_error(url, local_path, e)
+            else:
+                print(f"File not found {url}")
+                print(e)
+            return None
+        emit_event('job', url, seconds=time.perf_counter() - start, status='downloaded' if downloaded else 'existing')
+        if on_complete is not None:
+            _call_on_complete(on_complete, local_path)
+        return local_path
+
+    jobs = iter(jobs)
+    running = set()
+    try:
+        while True:
+            # Creamos tareas sólo hasta llenar los cupos
+            for job in jobs:
+                running.add(asyncio.ensure_future(run_job(job)))
+                if len(running) >= max_concurrency:
+                    break
+            if not running:
+                break
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                local_path = task.result()
+                if local_path is not None:
+                    yield local_path
+    finally:
+        for task in running:
+            task.cancel()
@@ -0,0 +1,348 @@
+import os
+import json
+import datetime
+from itertools import repeat
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from Download_data.utils_dates import to_datetime, year_range
+from Download_data.utils_listing import get_file_date, get_file_span
+from Download_data.loader import get_local_files, read_CDF_info, _get_field, PROCESS_POOL_MIN_FILES
+
+
+"""
+Columnar (Parquet) copy of the downloaded CDF files, for fast repeated reads.
+
+Every CDF file is converted once into a Parquet file with one column per
+record-varying variable. The time variable is stored as timestamps, and
+multidimensional variables (e.g. FEDU) as fixed-size lists. The files are
+partitioned by dataset, probe and year:
+
+    <local_root_dir>/columnar/<dataset>/rbsp_<probe>/<year>/<CDF name>.parquet
+
+The store is kept in sync incrementally: sync_columnar_store only converts the
+CDF files that are new or newer than their Parquet copy, and drops the copies
+of superseded versions. Reads select columns, prune files and row groups by
+time range, and memory-map the files:
+
+    spec = {'dataset': 'omni', 'res': '1min', 'typ': 'hro'}
+    sync_columnar_store(spec, '2010-01-01', '2019-12-31', local_root_dir)
+    data = read_columnar(spec, '2010-01-01', '2019-12-31', local_root_dir, ['BZ_GSM', 'flow_speed'])
+
+pyarrow is an optional dependency, imported only by these functions.
+"""
+
+
+COLUMNAR_DIR = 'columnar'
+
+# Filas por row group: la unidad mínima que se lee al filtrar por tiempo
+ROW_GROUP_SIZE = 65536
+
+# Metadatos del esquema: archivo de origen, formas de las variables y variables fijas
+_METADATA_KEY = b'Download_data'
+
+
+def _import_pyarrow():
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.dataset
+    except ImportError:
+        raise ImportError('The columnar store needs pyarrow (pip install pyarrow)')
+
+    return pyarrow
+
+
+def get_columnar_dir(spec, date, local_root_dir, store_dir=None):
+
+    '''
+    Construct the directory of the Parquet files of a dataset spec for one year.
+
+    Args:
+        - spec (dict): The dataset spec (see loader.get_local_files).
+        - date (datetime.date): A date of the year.
+        - local_root_dir (str): The root directory on the local machine where files are saved.
+        - store_dir (str, optional): The root of the columnar store. Defaults to None
+          ('<local_root_dir>/columnar').
+
+    Returns:
+        - columnar_dir (str): The directory, structured as
+          '<store_dir>/<dataset>/<probe>/<year>/', with the dataset name including the product
+          (e.g. 'ect_rept_l3', 'emfisis_l3_4sec_geo', 'omni_hro_1min') and probe 'rbsp_a' or
+          'rbsp_b' ('all' for OMNI).
+    '''
+
+    if store_dir is None:
+        store_dir = os.path.join(local_root_dir, COLUMNAR_DIR)
+
+    dataset = spec.get('dataset')
+    if dataset == 'ect':
+        name = 'ect_%s_l%s' % (spec['instrument'], spec.get('level', '3'))
+    elif dataset == 'emfisis':
+        name = 'emfisis_l%s_%ssec_%s' % (spec.get('level', '3'), spec.get('interval', 4), spec.get('coordinates', 'geo'))
+    elif dataset == 'omni':
+        name = 'omni_%s_%s' % (spec.get('typ', 'hro'), spec.get('res', '1min'))
+    else:
+        raise ValueError('Unknown dataset %r (valid: ect, emfisis, omni)' % dataset)
+
+    probe = 'rbsp_%s' % spec['probe'] if dataset != 'omni' else 'all'
+
+    return os.path.join(store_dir, name, probe, '%s' % date.year, '')
+
+
+def convert_CDF_file(path, target_path, time_variable='Epoch'):
+
+    '''
+    Convert a CDF file into a Parquet file, with one column per variable that has one
+    record per record of the time variable.
+
+    The time variable is converted to timestamps. Multidimensional variables are stored
+    as fixed-size lists (their shape is kept in the schema metadata), and the variables
+    that do not vary by record are kept in the schema metadata too. The file is written
+    under a temporary name and renamed when complete.
+
+    Args:
+        - path (str): The path of the CDF file.
+        - target_path (str): The path of the Parquet file.
+        - time_variable (str, optional): The name of the time variable. Defaults to 'Epoch'.
+
+    Returns:
+        - n_records (int): The number of records written.
+    '''
+
+    import cdflib
+    import numpy as np
+    pa = _import_pyarrow()
+
+    cdf = cdflib.CDF(path)
+    cdf_info = cdf.cdf_info()
+    variables = list(_get_field(cdf_info, 'zVariables')) + list(_get_field(cdf_info, 'rVariables'))
+    info = read_CDF_info(path, variables)
+    n_records = info[time_variable][0]
+
+    columns, shapes, static = {}, {}, {}
+    for variable in variables:
+        count, shape, dtype = info[variable]
+        if count is None:
+            static[variable] = np.asarray(cdf.varget(variable)).tolist()
+            continue
+        # Sólo las variables con un registro por cada instante; epoch16 no tiene tipo en Parquet
+        if count != n_records or dtype == 'c16':
+            continue
+
+        values = np.reshape(cdf.varget(variable), (count,) + shape) if count else np.empty((0,) + shape, dtype)
+        if variable == time_variable:
+            values = np.asarray(cdflib.cdfepoch.to_datetime(values) if count else [], dtype='datetime64[ns]')
+
+        if shape:
+            columns[variable] = pa.FixedSizeListArray.from_arrays(pa.array(np.ascontiguousarray(values).ravel()),
+                                                                  int(np.prod(shape)))
+            shapes[variable] = list(shape)
+        else:
+            columns[variable] = pa.array(values)
+
+    metadata = {'source': os.path.basename(path), 'time': time_variable, 'shapes': shapes, 'static': static}
+    table = pa.table(columns).replace_schema_metadata({_METADATA_KEY: json.dumps(metadata)})
+
+    # Escribimos con otro nombre y renombramos, para que nunca quede un archivo a medias
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    partial_path = target_path + '.part'
+    pa.parquet.write_table(table, partial_path, row_group_size=ROW_GROUP_SIZE)
+    os.replace(partial_path, target_path)
+
+    return n_records
+
+
+def _convert_CDF_file_safe(path, target_path, time_variable):
+
+    # En los procesos del pool: devolvemos el error en vez de levantarlo, para seguir con los demás
+    try:
+        return convert_CDF_file(path, target_path, time_variable), None
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, e)
+
+
+def sync_columnar_store(spec, start_date, end_date, local_root_dir, store_dir=None, time_variable='Epoch',
+                        n_processes=None):
+
+    '''
+    Bring the columnar store of a dataset spec up to date with the downloaded CDF files
+    of a date range: convert the files that have no Parquet copy or are newer than it,
+    and remove the copies of superseded versions. Running it after every download keeps
+    the store in sync at the cost of one stat per file.
+
+    Args:
+        - spec (dict): The dataset spec (see loader.get_local_files), for one probe.
+        - start_date (datetime.date or str): The start date of the range, unless the spec has its own.
+        - end_date (datetime.date or str): The end date of the range, unless the spec has its own.
+        - local_root_dir (str): The root directory on the local machine where files are saved.
+        - store_dir (str, optional): The root of the columnar store. Defaults to None
+          ('<local_root_dir>/columnar').
+        - time_variable (str, optional): The name of the time variable. Defaults to 'Epoch'.
+        - n_processes (int, optional): Number of processes that convert files. Defaults to None
+          (the number of CPUs). A pool is only used for PROCESS_POOL_MIN_FILES files or more.
+
+    Returns:
+        - n_converted (int): The number of files converted.
+    '''
+
+    _import_pyarrow()
+
+    jobs = []
+    for path in get_local_files(spec, start_date, end_date, local_root_dir):
+        date = datetime.datetime.strptime(get_file_date(os.path.basename(path)), '%Y%m%d')
+        target_dir = get_columnar_dir(spec, date, local_root_dir, store_dir)
+        target_path = target_dir + os.path.splitext(os.path.basename(path))[0] + '.parquet'
+        if not os.path.exists(target_path) or os.path.getmtime(target_path) < os.path.getmtime(path):
+            jobs.append((path, target_path))
+
+    if n_processes is None:
+        n_processes = os.cpu_count() or 1
+
+    executor = None
+    if n_processes > 1 and len(jobs) >= PROCESS_POOL_MIN_FILES:
+        executor = ProcessPoolExecutor(n_processes)
+        mapper = partial(executor.map, chunksize=max(1, len(jobs)//(4*n_processes)))
+    else:
+        mapper = map
+
+    n_converted = 0
+    try:
+        results = mapper(_convert_CDF_file_safe, [path for path, target_path in jobs],
+                         [target_path for path, target_path in jobs], repeat(time_variable))
+        for (path, target_path), (n_records, error) in zip(jobs, results):
+            if error is not None:
+                print(f"Could not convert {path}: {error}")
+                continue
+            n_converted += 1
+
+            # Borramos las copias de otras versiones del mismo día
+            target_dir, target_name = os.path.split(target_path)
+            for name in os.listdir(target_dir):
+                if (name.endswith('.parquet') and name != target_name
+                        and get_file_date(name) == get_file_date(target_name)):
+                    os.remove(os.path.join(target_dir, name))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return n_converted
+
+
+def _overlaps(name, start, end):
+
+    # Un archivo sin fecha en el nombre se conserva; lo descartan después las estadísticas de tiempo
+    first_date, last_date = get_file_span(name)
+
+    return first_date is None or (first_date <= end and last_date >= start)
+
+
+def get_columnar_files(spec, start_date, end_date, local_root_dir, store_dir=None):
+
+    '''
+    Find the Parquet files of a dataset spec that may hold records of a date range.
+
+    Files are pruned by year and by the dates they cover, from the date in their name
+    (the date a file starts) and the cadence of the product (see
+    utils_listing.get_file_span), so a monthly file is kept only if its month overlaps
+    the range. The row groups are pruned later by their time statistics.
+
+    Args:
+        - spec (dict): The dataset spec (see loader.get_local_files), for one probe.
+        - start_date (datetime.date or str): The start date of the range, unless the spec has its own.
+        - end_date (datetime.date or str): The end date of the range, unless the spec has its own.
+        - local_root_dir (str): The root directory on the local machine where files are saved.
+        - store_dir (str, optional): The root of the columnar store. Defaults to None
+          ('<local_root_dir>/columnar').
+
+    Returns:
+        - files (list): The paths of the Parquet files, ordered by date.
+    '''
+
+    start_date = spec.get('start_date', start_date)
+    end_date = spec.get('end_date', end_date)
+    start = to_datetime(start_date).strftime('%Y%m%d')
+    end = to_datetime(end_date).strftime('%Y%m%d')
+
+    files = []
+    for year in year_range(start_date, end_date):
+        columnar_dir = get_columnar_dir(spec, year, local_root_dir, store_dir)
+        try:
+            names = os.listdir(columnar_dir)
+        except FileNotFoundError:
+            continue
+        names = [name for name in names if name.endswith('.parquet') and _overlaps(name, start, end)]
+        files += [columnar_dir + name for name in sorted(names, key=get_file_date)]
+
+    return files
+
+
+def read_columnar(spec, start_date, end_date, local_root_dir, columns=None, store_dir=None, as_table=False):
+
+    '''
+    Read some columns of the columnar store of a dataset spec over a time range.
+
+    Only the requested columns are read, files and row groups outside the range are
+    skipped, and the files are memory-mapped.
+
+    Args:
+        - spec (dict): The dataset spec (see loader.get_local_files), for one probe.
+        - start_date (datetime.date or str): The start of the range, unless the spec has its own.
+        - end_date (datetime.date or str): The end of the range, unless the spec has its own. A date
+          without time includes the whole day.
+        - local_root_dir (str): The root directory on the local machine where files are saved.
+        - columns (list, optional): The names of the variables to read. Defaults to None (all).
+        - store_dir (str, optional): The root of the columnar store. Defaults to None
+          ('<local_root_dir>/columnar').
+        - as_table (bool, optional): Whether to return a pyarrow.Table (without the variables that
+          do not vary by record) instead of NumPy arrays. Defaults to False.
+
+    Returns:
+        - data (dict or pyarrow.Table): Dictionary variable -> numpy.ndarray (multidimensional
+          variables with their original shape, the time variable as datetime64, and the variables
+          that do not vary by record as stored in the first file), or the table if as_table is True.
+          Empty if there are no files in the range.
+    '''
+
+    pa = _import_pyarrow()
+    import pyarrow.fs
+
+    files = get_columnar_files(spec, start_date, end_date, local_root_dir, store_dir)
+    if not files:
+        print('No columnar files in range')
+        return pa.table({}) if as_table else {}
+
+    dataset = pa.dataset.dataset(files, format='parquet', filesystem=pa.fs.LocalFileSystem(use_mmap=True))
+    metadata = json.loads(dataset.schema.metadata[_METADATA_KEY])
+
+    # Una fecha sin hora incluye el día completo
+    start = to_datetime(spec.get('start_date', start_date))
+    end = to_datetime(spec.get('end_date', end_date))
+    if end == datetime.datetime(end.year, end.month, end.day):
+        end += datetime.timedelta(days=1)
+    else:
+        end += datetime.timedelta(microseconds=1)
+
+    # Las variables fijas están en los metadatos, no en las columnas
+    static = dict((name, values) for name, values in metadata['static'].items()
+                  if columns is None or name in columns)
+    if columns is not None:
+        columns = [name for name in columns if name not in static]
+
+    time = pa.dataset.field(metadata['time'])
+    time_type = dataset.schema.field(metadata['time']).type
+    table = dataset.to_table(columns=columns, filter=(time >= pa.scalar(start, time_type)) & (time < pa.scalar(end, time_type)))
+    if as_table:
+        return table
+
+    import numpy as np
+
+    data = dict((name, np.asarray(values)) for name, values in static.items())
+    for name in table.column_names:
+        column = table[name].combine_chunks()
+        if name in metadata['shapes']:
+            data[name] = column.flatten().to_numpy(zero_copy_only=False).reshape([-1] + metadata['shapes'][name])
+        else:
+            data[name] = column.to_numpy(zero_copy_only=False)
+
+    return data
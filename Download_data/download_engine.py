@@ -0,0 +1,396 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from Download_data.utils_download import download_file, jobs_progress
+from Download_data.utils_metrics import emit_event, bind_run
+from Download_data.utils_listing import get_file_date, get_file_span
+from Download_data.utils_dates import to_datetime
+from Download_data.utils_retry import (is_transient_error, is_throttle_error, get_backoff_delay,
+                                       DEFAULT_MAX_RETRIES)
+
+
+"""
+Shared download engine for the ECT, EMFISIS and OMNI downloaders.
+
+The entry points build the full list of (remote URL, local path) jobs for the
+requested date range, and the engine runs them with a bounded pool of worker
+threads and a cap on the number of simultaneous connections to each host.
+
+Jobs that fail with transient errors are retried with jittered exponential
+backoff (see Download_data.utils_retry). The cap of each host adapts to the
+server: it is halved when the server throttles us (HTTP 429 or 503) and grows
+back by one connection per round of successful requests (additive increase,
+multiplicative decrease).
+
+Jobs start in the order given, or by priority: run_download_jobs takes a sort
+key, e.g. newest_first or window_first(start, end) for an event window. The
+bytes received by all the workers are capped together by the bandwidth limit
+of the process (see Download_data.utils_bandwidth), which can be changed while
+a run is going.
+"""
+
+
+DEFAULT_N_WORKERS = 4
+DEFAULT_MAX_PER_HOST = 4
+
+
+def get_host(url):
+
+    '''
+    Return the host (network location) of a URL.
+
+    Args:
+        - url (str): The URL.
+
+    Returns:
+        - host (str): The host part of the URL, including the port if present.
+    '''
+
+    return urlparse(url).netloc
+
+
+class HostLimit:
+
+    '''
+    Adaptive cap on the number of simultaneous jobs against one host.
+
+    The cap starts at max_per_host. A throttling answer halves it (never below
+    one), and every successful job raises it by 1/cap, i.e. by one connection
+    per round of successful requests, up to max_per_host again.
+    '''
+
+    def __init__(self, max_per_host):
+        self.maximum = max_per_host
+        self.limit = float(max_per_host)
+        self.active = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+
+        '''
+        Wait until a slot of the host is free and take it.
+
+        Returns:
+            - start (float): The time (time.monotonic) at which the slot was taken.
+        '''
+
+        with self._condition:
+            while self.active >= max(int(self.limit), 1):
+                self._condition.wait()
+            self.active += 1
+            return time.monotonic()
+
+    def release(self, start, throttled=False):
+
+        '''
+        Free a slot taken with acquire, and adapt the cap to the outcome of the job.
+
+        Args:
+            - start (float): The value returned by acquire.
+            - throttled (bool, optional): Whether the server throttled the request. Defaults to False.
+
+        Returns:
+            - None
+        '''
+
+        with self._condition:
+            self.active -= 1
+            if throttled:
+                # Los rechazos de peticiones lanzadas antes de la última reducción ya se contaron
+                if start >= self._last_decrease:
+                    self.limit = max(self.limit/2, 1.0)
+                    self._last_decrease = time.monotonic()
+            else:
+                self.limit = min(self.limit + 1/self.limit, self.maximum)
+            self._condition.notify_all()
+
+        return
+
+
+def newest_first(job):
+
+    '''
+    Priority for run_download_jobs that starts the files of the newest dates first.
+
+    Args:
+        - job (tuple): The (url, local_path) job.
+
+    Returns:
+        - key (int): The sort key of the job.
+    '''
+
+    return -int(get_file_date(os.path.basename(job[1])) or 0)
+
+
+def window_first(start_date, end_date):
+
+    '''
+    Build a priority for run_download_jobs that starts the files of a date window
+    (e.g. an event) first, and then the rest, each group in date order. A file is in
+    the window if any of the dates it covers is (see utils_listing.get_file_span), so a
+    monthly OMNI file counts for a window in the middle of its month.
+
+    Args:
+        - start_date (datetime.date or str): The first date of the window.
+        - end_date (datetime.date or str): The last date of the window.
+
+    Returns:
+        - priority (callable): The function that returns the sort key of a job.
+    '''
+
+    start = to_datetime(start_date).strftime('%Y%m%d')
+    end = to_datetime(end_date).strftime('%Y%m%d')
+
+    def priority(job):
+        first_date, last_date = get_file_span(os.path.basename(job[1]))
+        if first_date is None:
+            return (1, '')
+        return (0 if first_date <= end and last_date >= start else 1, first_date)
+
+    return priority
+
+
+def write_failure_manifest(path, failed):
+
+    '''
+    Write the jobs that failed in a run to a JSON manifest, so they can be inspected
+    and retried later (see read_failure_manifest).
+
+    Args:
+        - path (str): The path of the JSON manifest.
+        - failed (list): List of (url, local_path, error message) tuples, as in the
+          'failed' list returned by run_download_jobs.
+
+    Returns:
+        - None
+    '''
+
+    manifest = [{'url': url, 'local_path': local_path, 'error': error} for url, local_path, error in failed]
+    with open(path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+    return
+
+
+def read_failure_manifest(path):
+
+    '''
+    Read the jobs of a failure manifest written by write_failure_manifest.
+
+    Args:
+        - path (str): The path of the JSON manifest.
+
+    Returns:
+        - jobs (list): List of (url, local_path) tuples, that can be passed to run_download_jobs.
+    '''
+
+    with open(path) as file:
+        manifest = json.load(file)
+
+    return [(entry['url'], entry['local_path']) for entry in manifest]
+
+
+def _make_job_runner(jobs, download_function, max_per_host, max_retries):
+
+    # Función que corre un trabajo en un hilo, con reintentos y un límite adaptativo por
+    # host, para limitar las conexiones simultáneas a cada servidor
+    host_limits = {}
+    for job in jobs:
+        host_limits.setdefault(get_host(job[0]), HostLimit(max_per_host))
+
+    def run_job(job):
+        url, local_path = job[0], job[1]
+        host_limit = host_limits[get_host(url)]
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            slot = host_limit.acquire()
+            try:
+                downloaded = download_function(url, local_path)
+            except Exception as e:
+                host_limit.release(slot, throttled=is_throttle_error(e))
+                if attempt >= max_retries or not is_transient_error(e):
+                    emit_event('job', url, seconds=time.perf_counter() - start, status='failed')
+                    raise
+                # Esperamos fuera del límite del host, para no bloquear a los demás trabajos
+                delay = get_backoff_delay(attempt, error=e)
+                emit_event('retry', url, seconds=delay, attempt=attempt + 1, error=str(e))
+                time.sleep(delay)
+                attempt += 1
+                continue
+            host_limit.release(slot)
+            emit_event('job', url, seconds=time.perf_counter() - start,
+                       status='downloaded' if downloaded else 'existing')
+            return downloaded
+
+    return run_job
+
+
+def _call_on_complete(on_complete, local_path):
+
+    # Un error al registrar un archivo (p. ej. en el inventario) no es un error de la descarga:
+    # el archivo ya está en disco, así que lo informamos sin contarlo como fallido
+    try:
+        on_complete(local_path)
+    except Exception as e:
+        print(f"\nCould not record {local_path}: {e}")
+
+    return
+
+
+def run_download_jobs(jobs, download_function=download_file, n_workers=DEFAULT_N_WORKERS,
+                      max_per_host=DEFAULT_MAX_PER_HOST, progress=True, on_complete=None,
+                      max_retries=DEFAULT_MAX_RETRIES, failure_manifest=None, priority=None):
+
+    '''
+    Run a list of download jobs with a bounded pool of concurrent workers.
+
+    Each job is a (remote URL, local path) tuple. Jobs are run by n_workers threads,
+    and no more than max_per_host of them talk to the same host at the same time
+    (fewer while the host throttles us, see HostLimit). Transient errors are
+    retried with backoff, without holding the slot of the host while waiting.
+    The aggregate progress is displayed in the console as jobs finish.
+
+    Args:
+        - jobs (list): List of (url, local_path) tuples.
+        - download_function (callable, optional): Function called as download_function(url, local_path)
+          for each job. It returns True if the file was downloaded and False if it already
+          existed, and raises an exception on failure. Defaults to utils_download.download_file.
+        - n_workers (int, optional): Number of concurrent workers. Defaults to 4.
+        - max_per_host (int, optional): Maximum number of concurrent jobs against the same host.
+          Defaults to 4.
+        - progress (bool, optional): Whether to display the aggregate progress. Defaults to True.
+        - on_complete (callable, optional): Function called as on_complete(local_path) in the calling
+          thread for every job whose file is on disk at the end (downloaded or already existing),
+          e.g. to record it in the local inventory. Its errors are reported, and do not count the
+          job as failed. Defaults to None.
+        - max_retries (int, optional): Maximum number of retries of a job after a transient error
+          (timeout, connection reset, truncated transfer, HTTP 429 or 5xx). Defaults to 5.
+        - failure_manifest (str, optional): Path of a JSON file where the jobs that still failed at
+          the end are written (see write_failure_manifest); it is an empty list if every job
+          succeeded. Defaults to None.
+        - priority (callable, optional): Function called as priority(job) that returns a sort key;
+          jobs with lower keys start first (e.g. newest_first or window_first(start, end)).
+          Defaults to None (the order of jobs).
+
+    Returns:
+        - results (dict): Dictionary with the keys 'downloaded' and 'existing' (lists of local
+          paths) and 'failed' (list of (url, local_path, error message) tuples).
+    '''
+
+    results = {'downloaded': [], 'existing': [], 'failed': []}
+    if len(jobs) == 0:
+        if failure_manifest is not None:
+            write_failure_manifest(failure_manifest, results['failed'])
+        return results
+
+    # Los trabajadores toman los trabajos en el orden en que se entregan
+    if priority is not None:
+        jobs = sorted(jobs, key=priority)
+
+    # Los eventos de los hilos trabajadores van a la ejecución que nos llamó (ver utils_metrics)
+    run_job = bind_run(_make_job_runner(jobs, download_function, max_per_host, max_retries))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+
+        for n_done, future in enumerate(as_completed(futures), 1):
+            url, local_path = futures[future][0], futures[future][1]
+            try:
+                downloaded = future.result()
+            except Exception as e:
+                results['failed'].append((url, local_path, str(e)))
+            else:
+                results['downloaded' if downloaded else 'existing'].append(local_path)
+                if on_complete is not None:
+                    _call_on_complete(on_complete, local_path)
+
+            if progress:
+                jobs_progress(n_done, len(jobs), len(results['downloaded']),
+                              len(results['existing']), len(results['failed']))
+
+    if progress:
+        print()
+        for url, local_path, error in results['failed']:
+            print(f"File not found {url}")
+            print(error)
+
+    if failure_manifest is not None:
+        write_failure_manifest(failure_manifest, results['failed'])
+
+    return results
+
+
+def iter_download_jobs(jobs, download_function=download_file, n_workers=DEFAULT_N_WORKERS,
+                       max_per_host=DEFAULT_MAX_PER_HOST, lookahead=8, on_complete=None, on_error=None,
+                       max_retries=DEFAULT_MAX_RETRIES):
+
+    '''
+    Run a list of download jobs in the background and yield the local path of each
+    file, in the order of the jobs, as soon as it is on disk.
+
+    Only a window of lookahead jobs ahead of the consumer is downloading at any
+    time, so processing a file overlaps with the download of the next ones
+    without fetching the whole range in advance. If the consumer stops early, the
+    jobs that did not start are cancelled.
+
+    Args:
+        - jobs (list): List of (url, local_path) tuples, in the order the files are wanted.
+        - download_function (callable, optional): As in run_download_jobs. Defaults to download_file.
+        - n_workers (int, optional): Number of concurrent workers. Defaults to 4.
+        - max_per_host (int, optional): Maximum number of concurrent jobs against the same host.
+          Defaults to 4.
+        - lookahead (int, optional): Number of jobs started ahead of the file being yielded.
+          Defaults to 8.
+        - on_complete (callable, optional): Function called as on_complete(local_path) in the consuming
+          thread for every job whose file is on disk (downloaded or already existing), before it is
+          yielded, as in run_download_jobs. Its errors are reported, and do not skip the file.
+          Defaults to None.
+        - on_error (callable, optional): Function called as on_error(url, local_path, exception) for
+          every job that failed, which is then skipped. Defaults to None (the error is printed).
+        - max_retries (int, optional): Maximum number of retries of a job after a transient error.
+          Defaults to 5.
+
+    Yields:
+        - local_path (str): The local path of each file on disk, in the order of the jobs.
+    '''
+
+    jobs = list(jobs)
+    run_job = bind_run(_make_job_runner(jobs, download_function, max_per_host, max_retries))
+    pending = iter(jobs)
+    window = deque()
+
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    try:
+        # Llenamos la ventana, y cada vez que entregamos un archivo lanzamos el siguiente
+        for job in pending:
+            window.append((job, executor.submit(run_job, job)))
+            if len(window) > lookahead:
+                break
+
+        while window:
+            job, future = window.popleft()
+            next_job = next(pending, None)
+            if next_job is not None:
+                window.append((next_job, executor.submit(run_job, next_job)))
+
+            try:
+                future.result()
+            except Exception as e:
+                if on_error is not None:
+                    on_error(job[0], job[1], e)
+                else:
+                    print(f"File not found {job[0]}")
+                    print(e)
+                continue
+
+            if on_complete is not None:
+                _call_on_complete(on_complete, job[1])
+            yield job[1]
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
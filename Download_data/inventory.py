@@ -0,0 +1,680 @@
+import os
+import sqlite3
+from Download_data.utils_download import file_checksum, revalidate_file, pop_file_checksum
+from Download_data.utils_listing import get_file_date, get_file_version, get_version_key, get_product_key
+
+
+"""
+Persistent local inventory of the downloaded data files.
+
+The inventory is an SQLite database stored in local_root_dir that records, for
+every CDF file under it, its dataset, probe, date, version, size and checksum.
+It is built once by a single scan of the directory tree and then updated as
+downloads finish, so finding out which files of a date range are missing is
+one indexed query instead of one os.path.exists call per file.
+
+If files are added or removed by hand, scan_inventory brings the inventory back
+in sync with the directory tree.
+
+The inventory also keeps the HTTP validators (ETag, Last-Modified and size) of
+the remote copy of each file, and the URL they came from, so files that keep their name when the archive
+regenerates them (OMNI) can be revalidated with conditional requests (see
+get_revalidation_function).
+"""
+
+
+INVENTORY_FILENAME = 'inventory.sqlite'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    probe TEXT NOT NULL,
+    date TEXT,
+    version TEXT,
+    size INTEGER,
+    checksum TEXT,
+    mtime REAL,
+    etag TEXT,
+    last_modified TEXT,
+    remote_size INTEGER,
+    remote_url TEXT
+);
+CREATE INDEX IF NOT EXISTS files_by_date ON files (dataset, probe, date);
+'''
+
+# Columnas agregadas después de la primera versión del inventario, con su tipo
+_ADDED_COLUMNS = (('etag', 'TEXT'), ('last_modified', 'TEXT'), ('remote_size', 'INTEGER'), ('remote_url', 'TEXT'))
+
+_INSERT = ('INSERT OR REPLACE INTO files (path, dataset, probe, date, version, size, checksum, mtime, '
+           'etag, last_modified, remote_size, remote_url) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+# Al registrar de nuevo un archivo que no cambió (mismo tamaño y fecha de modificación), el
+# checksum y los validadores que no se entregan conservan su valor anterior
+_KEEP_IF_UNCHANGED = ('CASE WHEN excluded.{0} IS NULL AND files.size = excluded.size AND files.mtime = excluded.mtime '
+                      'THEN files.{0} ELSE excluded.{0} END')
+_UPSERT = (_INSERT.replace('INSERT OR REPLACE', 'INSERT') + ' ON CONFLICT (path) DO UPDATE SET '
+           + ', '.join('%s = excluded.%s' % (column, column) for column in ('dataset', 'probe', 'date', 'version'))
+           + ', ' + ', '.join('%s = %s' % (column, _KEEP_IF_UNCHANGED.format(column))
+                              for column in ('checksum', 'etag', 'last_modified', 'remote_size', 'remote_url'))
+           + ', size = excluded.size, mtime = excluded.mtime')
+
+# Cantidad de archivos terminados que se acumulan antes de escribirlos en el inventario
+INVENTORY_BATCH_SIZE = 256
+
+
+def get_inventory_path(local_root_dir):
+
+    '''
+    Construct the path of the inventory database of a local data directory.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+
+    Returns:
+        - inventory_path (str): The path of the SQLite inventory file.
+    '''
+
+    return os.path.join(local_root_dir, INVENTORY_FILENAME)
+
+
+def connect_inventory(local_root_dir):
+
+    '''
+    Open the inventory database of a local data directory.
+
+    If the inventory does not exist yet, it is created and filled with a scan of
+    the directory tree. When several processes open a new inventory at once, only
+    one of them scans the tree.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+
+    Returns:
+        - connection (sqlite3.Connection): An open connection to the inventory.
+    '''
+
+    os.makedirs(local_root_dir, exist_ok=True)
+    connection = sqlite3.connect(get_inventory_path(local_root_dir), timeout=60)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(_SCHEMA)
+    _migrate(connection)
+
+    # Sólo un proceso hace el primer recorrido: los demás esperan el bloqueo y ya lo encuentran
+    # hecho (user_version marca el inventario como inicializado)
+    with connection:
+        connection.execute('BEGIN IMMEDIATE')
+        if connection.execute('PRAGMA user_version').fetchone()[0] == 0:
+            is_new = connection.execute('SELECT 1 FROM files LIMIT 1').fetchone() is None
+            connection.execute('PRAGMA user_version = 1')
+            if is_new:
+                _scan(connection, local_root_dir)
+
+    return connection
+
+
+def _migrate(connection):
+
+    '''
+    Add to an inventory created by an older version the columns it lacks.
+
+    Args:
+        - connection (sqlite3.Connection): An open connection to the inventory.
+
+    Returns:
+        - None
+    '''
+
+    columns = set(row['name'] for row in connection.execute('PRAGMA table_info(files)'))
+    with connection:
+        for name, column_type in _ADDED_COLUMNS:
+            if name not in columns:
+                connection.execute('ALTER TABLE files ADD COLUMN %s %s' % (name, column_type))
+
+    return
+
+
+def get_relative_path(local_root_dir, local_path):
+
+    '''
+    Return the path of a local file relative to local_root_dir, with '/' as separator,
+    which is the key of the file in the inventory.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - local_path (str): The path of the file.
+
+    Returns:
+        - relative_path (str): The path of the file relative to local_root_dir.
+    '''
+
+    relative_path = os.path.relpath(local_path, local_root_dir)
+
+    return relative_path.replace(os.sep, '/')
+
+
+def parse_local_path(relative_path):
+
+    '''
+    Extract the dataset, probe, date and version of a data file from its path
+    relative to local_root_dir.
+
+    The dataset is made of the directories of the path, leaving out the probe
+    ('rbsp_<probe>') and year directories, e.g. 'ect/rept/level3' for
+    'ect/rbsp_a/rept/level3/2013/<file>' and 'hro' for 'hro/2013/<file>'.
+
+    Args:
+        - relative_path (str): The path of the file relative to local_root_dir.
+
+    Returns:
+        - info (dict): Dictionary with the keys 'dataset', 'probe' ('' if the path has no
+          probe), 'date' ('YYYYMMDD' or None) and 'version' (str or None).
+    '''
+
+    parts = relative_path.split('/')
+    filename = parts[-1]
+
+    probe = ''
+    dataset = []
+    for part in parts[:-1]:
+        if part.startswith('rbsp_') and len(part) == 6:
+            probe = part[-1]
+        elif not (part.isdigit() and len(part) == 4):
+            dataset.append(part)
+
+    info = {'dataset': '/'.join(dataset), 'probe': probe,
+            'date': get_file_date(filename), 'version': get_file_version(filename)}
+
+    return info
+
+
+def _make_row(local_root_dir, local_path, checksum=None, validators=None):
+
+    '''
+    Build the inventory row of a local file.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - local_path (str): The path of the file.
+        - checksum (str, optional): The checksum of the file, if already known. Defaults to None.
+        - validators (dict, optional): The HTTP validators of the remote file (see
+          utils_download.get_validators), if known. Defaults to None.
+
+    Returns:
+        - row (tuple): The values of the row, in the order of the inventory columns.
+    '''
+
+    relative_path = get_relative_path(local_root_dir, local_path)
+    info = parse_local_path(relative_path)
+    stat = os.stat(local_path)
+    validators = validators or {}
+
+    return (relative_path, info['dataset'], info['probe'], info['date'], info['version'],
+            stat.st_size, checksum, stat.st_mtime,
+            validators.get('etag'), validators.get('last_modified'), validators.get('remote_size'),
+            validators.get('url'))
+
+
+def _scan(connection, local_root_dir, checksum=False):
+
+    '''
+    Fill the inventory with a single scan of the directory tree (see scan_inventory).
+
+    Args:
+        - connection (sqlite3.Connection): An open connection to the inventory.
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - checksum (bool, optional): Whether to compute the checksum of the files. Defaults to False.
+
+    Returns:
+        - n_files (int): The number of files in the inventory after the scan.
+    '''
+
+    # Lo que ya sabemos de cada archivo, para no recalcular checksums (ni perder validadores)
+    # de archivos que no cambiaron
+    known = {}
+    for row in connection.execute('SELECT path, size, mtime, checksum, etag, last_modified, remote_size, remote_url '
+                                  'FROM files'):
+        known[row['path']] = tuple(row)[1:]
+
+    rows = []
+    for dirpath, dirnames, filenames in os.walk(local_root_dir):
+        for filename in filenames:
+            if not filename.lower().endswith('.cdf'):
+                continue
+            local_path = os.path.join(dirpath, filename)
+            row = _make_row(local_root_dir, local_path)
+
+            old = known.get(row[0])
+            if old is not None and old[:2] == (row[5], row[7]):
+                row = row[:6] + old[2:3] + row[7:8] + old[3:]
+            if row[6] is None and checksum:
+                row = row[:6] + (file_checksum(local_path),) + row[7:]
+            rows.append(row)
+
+    with connection:
+        connection.execute('DELETE FROM files')
+        connection.executemany(_INSERT, rows)
+
+    return len(rows)
+
+
+def scan_inventory(local_root_dir, checksum=False):
+
+    '''
+    Rebuild the inventory of a local data directory with a single scan of its tree.
+
+    Files that are no longer on disk are removed from the inventory and new files
+    are added. Only '.cdf' files are recorded, so partial downloads are ignored.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - checksum (bool, optional): Whether to compute the checksum of the files whose checksum
+          is not known yet (this reads every such file). Defaults to False.
+
+    Returns:
+        - n_files (int): The number of files in the inventory.
+    '''
+
+    connection = connect_inventory(local_root_dir)
+    try:
+        n_files = _scan(connection, local_root_dir, checksum=checksum)
+    finally:
+        connection.close()
+
+    return n_files
+
+
+def record_file(local_root_dir, local_path, checksum=None, validators=None):
+
+    '''
+    Add or update a local file in the inventory.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - local_path (str): The path of the file.
+        - checksum (str, optional): The checksum of the file. If not given it is computed
+          from the file. Defaults to None.
+        - validators (dict, optional): The HTTP validators of the remote file (see
+          utils_download.get_validators). Defaults to None.
+
+    Returns:
+        - None
+    '''
+
+    if checksum is None:
+        checksum = file_checksum(local_path)
+
+    connection = connect_inventory(local_root_dir)
+    try:
+        with connection:
+            connection.execute(_UPSERT, _make_row(local_root_dir, local_path, checksum, validators))
+    finally:
+        connection.close()
+
+    return
+
+
+def remove_file_record(local_root_dir, local_path):
+
+    '''
+    Remove a file from the inventory (the file itself is not deleted).
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - local_path (str): The path of the file.
+
+    Returns:
+        - None
+    '''
+
+    connection = connect_inventory(local_root_dir)
+    try:
+        with connection:
+            connection.execute('DELETE FROM files WHERE path = ?',
+                               (get_relative_path(local_root_dir, local_path),))
+    finally:
+        connection.close()
+
+    return
+
+
+def get_stored_files(local_root_dir, dataset, probe='', start_date=None, end_date=None, pattern='*'):
+
+    '''
+    Query the inventory for the files of a dataset stored locally.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - dataset (str): The dataset, as stored in the inventory (e.g. 'ect/rept/level3').
+        - probe (str, optional): The probe ('a' or 'b'), or '' for OMNI. Defaults to ''.
+        - start_date (datetime.date, optional): First date of the range. Defaults to None (no limit).
+        - end_date (datetime.date, optional): Last date of the range. Defaults to None (no limit).
+        - pattern (str, optional): Glob pattern that the filenames must match. Defaults to '*'.
+
+    Returns:
+        - files (list): List of dictionaries with the inventory columns of each file
+          ('path' is relative to local_root_dir), ordered by date.
+    '''
+
+    query = 'SELECT * FROM files WHERE dataset = ? AND probe = ? AND path GLOB ?'
+    params = [dataset, probe, '*/' + pattern]
+    if start_date is not None:
+        query += ' AND date >= ?'
+        params.append(start_date.strftime('%Y%m%d'))
+    if end_date is not None:
+        query += ' AND date <= ?'
+        params.append(end_date.strftime('%Y%m%d'))
+    query += ' ORDER BY date, path'
+
+    connection = connect_inventory(local_root_dir)
+    try:
+        files = [dict(row) for row in connection.execute(query, params)]
+    finally:
+        connection.close()
+
+    return files
+
+
+def get_missing_jobs(local_root_dir, jobs):
+
+    '''
+    Select the download jobs whose target file is not in the inventory.
+
+    The local paths of all the jobs are checked against the inventory with a
+    single indexed query, without touching the files themselves.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - jobs (list): List of (url, local_path) tuples.
+
+    Returns:
+        - missing_jobs (list): The jobs whose local path is not in the inventory, in the same order.
+    '''
+
+    keys = [get_relative_path(local_root_dir, job[1]) for job in jobs]
+
+    connection = connect_inventory(local_root_dir)
+    try:
+        connection.execute('CREATE TEMP TABLE wanted (path TEXT PRIMARY KEY)')
+        connection.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', [(key,) for key in keys])
+        stored = set(row[0] for row in connection.execute(
+            'SELECT wanted.path FROM wanted JOIN files ON files.path = wanted.path'))
+    finally:
+        connection.close()
+
+    missing_jobs = [job for job, key in zip(jobs, keys) if key not in stored]
+
+    return missing_jobs
+
+
+def get_sync_jobs(local_root_dir, jobs):
+
+    '''
+    Select the download jobs that bring the local files up to date with the remote
+    listings (incremental sync).
+
+    Each job is compared with the files of the inventory stored in the same local
+    directory for the same product and date (see utils_listing.get_product_key). A
+    job is kept only if no local copy exists or the remote file has a higher
+    release/version than every local copy. The older local copies are reported as
+    superseded by the new file.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - jobs (list): List of (url, local_path) tuples, normally with the highest remote
+          version of each date.
+
+    Returns:
+        - sync_jobs (list): The jobs to run, in the same order.
+        - superseded (dict): Dictionary with the local path of each new file as key and the list
+          of local paths of the older versions it replaces as value.
+    '''
+
+    # Archivos guardados en los directorios de los trabajos, agrupados por producto y fecha
+    directories = sorted(set(os.path.dirname(get_relative_path(local_root_dir, job[1])) for job in jobs))
+    stored = {}
+
+    connection = connect_inventory(local_root_dir)
+    try:
+        for directory in directories:
+            for row in connection.execute('SELECT path FROM files WHERE path GLOB ?', (directory + '/*',)):
+                path = row['path']
+                if os.path.dirname(path) != directory:
+                    continue
+                key = (directory, get_product_key(os.path.basename(path)))
+                stored.setdefault(key, []).append(path)
+    finally:
+        connection.close()
+
+    sync_jobs = []
+    superseded = {}
+    for job in jobs:
+        relative_path = get_relative_path(local_root_dir, job[1])
+        filename = os.path.basename(relative_path)
+        local_copies = stored.get((os.path.dirname(relative_path), get_product_key(filename)), [])
+
+        remote_version = get_version_key(filename)
+        if any(get_version_key(os.path.basename(path)) >= remote_version for path in local_copies):
+            continue
+
+        sync_jobs.append(job)
+        if local_copies:
+            superseded[job[1]] = [os.path.join(local_root_dir, path) for path in local_copies]
+
+    return sync_jobs, superseded
+
+
+def remove_superseded_files(local_root_dir, superseded, completed_paths):
+
+    '''
+    Delete the older versions of the files that were downloaded, and remove them from
+    the inventory.
+
+    Older versions are only removed once their replacement is on disk.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - superseded (dict): Dictionary returned by get_sync_jobs.
+        - completed_paths (list): Local paths of the files that are now on disk.
+
+    Returns:
+        - removed (list): Local paths of the files that were deleted.
+    '''
+
+    removed = []
+    for local_path in completed_paths:
+        for old_path in superseded.get(local_path, []):
+            if os.path.exists(old_path):
+                os.remove(old_path)
+                print(f"Superseded file removed: {os.path.basename(old_path)}")
+            remove_file_record(local_root_dir, old_path)
+            removed.append(old_path)
+
+    return removed
+
+
+class InventoryRecorder:
+
+    '''
+    Records finished downloads in the inventory, to be passed as on_complete to
+    download_engine.run_download_jobs.
+
+    The rows are written in batches of batch_size files, through one connection
+    kept open for the whole run, and the checksums are the ones computed while
+    the files were downloaded (see utils_download.pop_file_checksum), so recording
+    a file does not read it again. Files that were already on disk are recorded
+    without a checksum (scan_inventory can compute it). close must be called at
+    the end of the run to write the last batch.
+
+    The connection is opened by the first batch, so the recorder must be called
+    and closed from one thread. If the inventory cannot be written (e.g. it is
+    locked for too long), the batch is reported and dropped, and the downloads
+    go on.
+    '''
+
+    def __init__(self, local_root_dir, batch_size=INVENTORY_BATCH_SIZE):
+        self.local_root_dir = local_root_dir
+        self.batch_size = batch_size
+        self._validators = {}
+        self._rows = []
+        self._connection = None
+
+    def set_validators(self, local_path, validators):
+
+        '''
+        Give the HTTP validators of a file, to be stored when the file is recorded. It
+        can be called from any thread.
+
+        Args:
+            - local_path (str): The local path of the file.
+            - validators (dict): The validators (see utils_download.get_validators).
+
+        Returns:
+            - None
+        '''
+
+        self._validators[local_path] = validators
+
+        return
+
+    def __call__(self, local_path):
+        if not os.path.exists(local_path):
+            return
+        self._rows.append(_make_row(self.local_root_dir, local_path, pop_file_checksum(local_path),
+                                    self._validators.pop(local_path, None)))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+
+        '''
+        Write the files recorded so far to the inventory.
+
+        Returns:
+            - None
+        '''
+
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+
+        try:
+            if self._connection is None:
+                self._connection = connect_inventory(self.local_root_dir)
+            with self._connection:
+                self._connection.executemany(_UPSERT, rows)
+        except sqlite3.Error as e:
+            print(f"\nCould not record {len(rows)} files in the inventory ({e}); "
+                  "scan_inventory brings it back in sync")
+
+        return
+
+    def close(self):
+
+        '''
+        Write the last batch and close the connection. The recorder can still be used
+        afterwards (it opens a new connection).
+
+        Returns:
+            - None
+        '''
+
+        try:
+            self.flush()
+        finally:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def get_inventory_callback(local_root_dir):
+
+    '''
+    Build a recorder of finished downloads, to be passed as on_complete to
+    download_engine.run_download_jobs and closed when the run ends.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+
+    Returns:
+        - recorder (InventoryRecorder): Callable as recorder(local_path).
+    '''
+
+    return InventoryRecorder(local_root_dir)
+
+
+def get_file_validators(local_root_dir, local_paths):
+
+    '''
+    Query the inventory for the HTTP validators stored for some local files.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - local_paths (list): The paths of the files.
+
+    Returns:
+        - validators (dict): Dictionary with the local path of each file in the inventory as key
+          and its validators (see utils_download.get_validators) as value.
+    '''
+
+    keys = dict((get_relative_path(local_root_dir, local_path), local_path) for local_path in local_paths)
+
+    connection = connect_inventory(local_root_dir)
+    try:
+        connection.execute('CREATE TEMP TABLE wanted (path TEXT PRIMARY KEY)')
+        connection.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', [(key,) for key in keys])
+        rows = connection.execute('SELECT files.path, etag, last_modified, remote_size, remote_url FROM wanted '
+                                  'JOIN files ON files.path = wanted.path').fetchall()
+    finally:
+        connection.close()
+
+    validators = {}
+    for row in rows:
+        validators[keys[row['path']]] = {'etag': row['etag'], 'last_modified': row['last_modified'],
+                                         'remote_size': row['remote_size'], 'url': row['remote_url']}
+
+    return validators
+
+
+def get_revalidation_function(local_root_dir, jobs, recorder):
+
+    '''
+    Build a download function that revalidates the local copies of some files against
+    the server, to be passed as download_function to download_engine.run_download_jobs.
+
+    The validators of all the jobs are read from the inventory at once. Each file is
+    then fetched with a conditional request (see utils_download.revalidate_file): an
+    unchanged file costs one 304 response without a body, and a changed or missing
+    file is downloaded again. The new validators are handed to recorder, which
+    stores them when the engine reports the job (so recorder must also be the
+    on_complete of the run); a file without stored validators is checked against
+    its modification time only the first time.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - jobs (list): List of (url, local_path) tuples that will be run.
+        - recorder (InventoryRecorder): The recorder of the run (see get_inventory_callback).
+
+    Returns:
+        - download_function (callable): Function called as download_function(url, local_path), that
+          returns True if the file was downloaded.
+    '''
+
+    stored = get_file_validators(local_root_dir, [job[1] for job in jobs])
+
+    def revalidate(url, local_path):
+        changed, validators = revalidate_file(url, local_path, stored.get(local_path))
+        recorder.set_validators(local_path, validators)
+        stored[local_path] = validators
+        return changed
+
+    return revalidate
@@ -0,0 +1,283 @@
+import os
+from itertools import repeat
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from Download_data.utils_dates import to_datetime, year_range
+from Download_data.utils_listing import get_file_date, get_version_key
+from Download_data.rbsp.download_ect import get_local_dir_ECT
+from Download_data.rbsp.download_emfisis import get_local_dir_EMFISIS
+from Download_data.omni.download_omni import get_jobs_OMNI
+
+
+"""
+Loading of the downloaded CDF files of a date range into NumPy arrays.
+
+The files are found in the same local layout used by the download functions
+(get_local_dir_ECT, get_local_dir_EMFISIS, get_local_dir_OMNI). The record
+counts of the requested variables are read first from the file headers, so
+that every output array is allocated once with its final size and then filled
+file by file, without Python lists or repeated concatenation:
+
+    spec = {'dataset': 'emfisis', 'probe': 'a', 'interval': 1}
+    data = load_CDFfiles(spec, '2013-01-01', '2013-12-31', local_root_dir, ['Epoch', 'Mag'])
+
+When many files are involved, they are read in a pool of processes. cdflib
+and numpy are imported only when data is loaded.
+"""
+
+
+# Con menos archivos que esto no vale la pena levantar procesos
+PROCESS_POOL_MIN_FILES = 16
+
+# Tipos de datos CDF -> tipos de numpy (los de caracteres se resuelven aparte)
+_CDF_DTYPES = {1: 'i1', 2: 'i2', 4: 'i4', 8: 'i8', 11: 'u1', 12: 'u2', 14: 'u4',
+               21: 'f4', 22: 'f8', 31: 'f8', 32: 'c16', 33: 'i8', 41: 'i1', 44: 'f4', 45: 'f8'}
+_CDF_CHAR_TYPES = (51, 52)
+
+# Claves de un spec que no describen los archivos locales
+_SPEC_KEYS = ('dataset', 'remote_root_dir', 'start_date', 'end_date')
+
+
+def _get_local_files_by_date(local_dirs, start_date, end_date, pattern=None):
+
+    # Un archivo por fecha (la versión más nueva), dentro del rango y en orden
+    start = to_datetime(start_date).strftime('%Y%m%d')
+    end = to_datetime(end_date).strftime('%Y%m%d')
+
+    files = []
+    for local_dir in local_dirs:
+        try:
+            names = os.listdir(local_dir)
+        except FileNotFoundError:
+            continue
+
+        newest = {}
+        for name in names:
+            if not name.lower().endswith('.cdf') or (pattern is not None and pattern not in name.lower()):
+                continue
+            date = get_file_date(name)
+            if date is None or not start <= date <= end:
+                continue
+            if date not in newest or get_version_key(name) > get_version_key(newest[date]):
+                newest[date] = name
+
+        files += [os.path.join(local_dir, newest[date]) for date in sorted(newest)]
+
+    return files
+
+
+def get_local_files(spec, start_date, end_date, local_root_dir):
+
+    '''
+    Find the downloaded CDF files of a dataset in a date range.
+
+    Args:
+        - spec (dict): The dataset spec, as in planner.plan_downloads: the key 'dataset' ('ect',
+          'emfisis' or 'omni') and the arguments that select the files ('probe', 'instrument'
+          and 'level' for ECT; 'probe', 'level', 'interval' and 'coordinates' for EMFISIS; 'res'
+          and 'typ' for OMNI). 'remote_root_dir' is not needed. The probe must be 'a' or 'b'.
+        - start_date (datetime.date or str): The start date of the range, unless the spec has its own.
+        - end_date (datetime.date or str): The end date of the range, unless the spec has its own.
+        - local_root_dir (str): The root directory on the local machine where files are saved.
+
+    Returns:
+        - files (list): The paths of the files on disk, ordered by date, with the newest version
+          of each daily file.
+
+    Raises:
+        - ValueError: If the dataset is unknown or the probe is not 'a' or 'b'.
+    '''
+
+    dataset = spec.get('dataset')
+    options = dict((key, value) for key, value in spec.items() if key not in _SPEC_KEYS)
+    start_date = spec.get('start_date', start_date)
+    end_date = spec.get('end_date', end_date)
+
+    if dataset == 'omni':
+        # Los nombres de OMNI se conocen sin listado: los mismos que se descargaron
+        jobs = get_jobs_OMNI(start_date, end_date, '', local_root_dir, **options)
+        return [local_path for url, local_path in jobs if os.path.exists(local_path)]
+
+    if dataset not in ('ect', 'emfisis'):
+        raise ValueError('Unknown dataset %r (valid: ect, emfisis, omni)' % dataset)
+    if options.get('probe') not in ('a', 'b'):
+        raise ValueError('Data is loaded for one probe at a time (probe must be a or b)')
+
+    years = year_range(start_date, end_date)
+    if dataset == 'ect':
+        local_dirs = [get_local_dir_ECT(year, local_root_dir, options['probe'], options['instrument'],
+                                        options.get('level', '3')) for year in years]
+        pattern = None
+    else:
+        # Los archivos de 1 y 4 segundos, y de cada sistema de coordenadas, comparten directorio
+        local_dirs = [get_local_dir_EMFISIS(year, local_root_dir, options['probe'], options.get('level', '3'))
+                      for year in years]
+        pattern = '%ssec-%s' % (options.get('interval', 4), options.get('coordinates', 'geo').lower())
+
+    return _get_local_files_by_date(local_dirs, start_date, end_date, pattern)
+
+
+def _get_field(info, key):
+
+    # cdflib < 1.0 devuelve diccionarios, las versiones nuevas dataclasses
+    return info[key] if isinstance(info, dict) else getattr(info, key)
+
+
+def read_CDF_info(path, variables):
+
+    '''
+    Read from the header of a CDF file the number of records, the shape of a record
+    and the data type of some variables, without reading their data.
+
+    Args:
+        - path (str): The path of the CDF file.
+        - variables (list): The names of the variables.
+
+    Returns:
+        - info (dict): Dictionary variable -> (n_records, record_shape, dtype), with n_records None
+          for variables that do not vary by record.
+    '''
+
+    import cdflib
+
+    cdf = cdflib.CDF(path)
+    info = {}
+    for variable in variables:
+        var_info = cdf.varinq(variable)
+        data_type = _get_field(var_info, 'Data_Type')
+        if data_type in _CDF_CHAR_TYPES:
+            dtype = 'U%d' % _get_field(var_info, 'Num_Elements')
+        else:
+            dtype = _CDF_DTYPES[data_type]
+        n_records = _get_field(var_info, 'Last_Rec') + 1 if _get_field(var_info, 'Rec_Vary') else None
+        info[variable] = (n_records, tuple(_get_field(var_info, 'Dim_Sizes')), dtype)
+
+    return info
+
+
+def _read_CDF_info_safe(path, variables):
+
+    # En los procesos del pool: devolvemos el error en vez de levantarlo, para saltar el archivo
+    try:
+        return read_CDF_info(path, variables), None
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, e)
+
+
+def _read_CDF_data(path, variables):
+
+    import cdflib
+
+    cdf = cdflib.CDF(path)
+
+    return dict((variable, cdf.varget(variable)) for variable in variables)
+
+
+def load_CDF_arrays(paths, variables, n_processes=None):
+
+    '''
+    Read some variables of a list of CDF files into contiguous NumPy arrays.
+
+    Record-varying variables are concatenated along the first axis, in the order of
+    paths; each output array is allocated once, from the record counts of the file
+    headers. Variables that do not vary by record (e.g. energy channels) are read
+    from the first file. Files that cannot be read, or lack a variable, are reported
+    and skipped.
+
+    Args:
+        - paths (list): The paths of the CDF files.
+        - variables (list): The names of the variables to read.
+        - n_processes (int, optional): Number of processes that read files. Defaults to None
+          (the number of CPUs). A pool is only used for PROCESS_POOL_MIN_FILES files or more.
+
+    Returns:
+        - data (dict): Dictionary variable -> numpy.ndarray.
+    '''
+
+    import numpy as np
+
+    if n_processes is None:
+        n_processes = os.cpu_count() or 1
+
+    executor = None
+    if n_processes > 1 and len(paths) >= PROCESS_POOL_MIN_FILES:
+        executor = ProcessPoolExecutor(n_processes)
+        # Mandamos los archivos en grupos, para no pagar un viaje entre procesos por archivo
+        mapper = partial(executor.map, chunksize=max(1, len(paths)//(4*n_processes)))
+    else:
+        mapper = map
+
+    try:
+        # Primera pasada: sólo encabezados, para saber cuántos registros aporta cada archivo
+        infos = []
+        for path, (info, error) in zip(paths, mapper(_read_CDF_info_safe, paths, repeat(variables))):
+            if error is not None:
+                print(f"Could not read {path}: {error}")
+            else:
+                infos.append((path, info))
+
+        if not infos:
+            return dict((variable, np.empty(0)) for variable in variables)
+
+        first_path = infos[0][0]
+        record_variables = [variable for variable in variables if infos[0][1][variable][0] is not None]
+        static_variables = [variable for variable in variables if infos[0][1][variable][0] is None]
+
+        # Reservamos cada arreglo de salida una sola vez, con su tamaño final
+        data = {}
+        for variable in record_variables:
+            n_records, shape, dtype = infos[0][1][variable]
+            total = sum(info[variable][0] or 0 for path, info in infos)
+            data[variable] = np.empty((total,) + shape, dtype=dtype)
+
+        # Segunda pasada: cada archivo escribe en su tramo de los arreglos
+        offsets = dict((variable, 0) for variable in record_variables)
+        infos = [(path, info) for path, info in infos if any(info[variable][0] for variable in record_variables)]
+        results = mapper(_read_CDF_data, [path for path, info in infos],
+                         [[variable for variable in record_variables if info[variable][0]] for path, info in infos])
+        for (path, info), values in zip(infos, results):
+            for variable in record_variables:
+                n_records, shape, dtype = info[variable]
+                if not n_records:
+                    continue
+                start = offsets[variable]
+                data[variable][start:start + n_records] = np.reshape(values[variable], (n_records,) + shape)
+                offsets[variable] = start + n_records
+
+        if static_variables:
+            data.update(_read_CDF_data(first_path, static_variables))
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return data
+
+
+def load_CDFfiles(spec, start_date, end_date, local_root_dir, variables, n_processes=None):
+
+    '''
+    Load some variables of the downloaded CDF files of a dataset over a date range
+    into contiguous NumPy arrays (see get_local_files and load_CDF_arrays).
+
+    Args:
+        - spec (dict): The dataset spec (see get_local_files), for one probe.
+        - start_date (datetime.date or str): The start date of the range, unless the spec has its own.
+        - end_date (datetime.date or str): The end date of the range, unless the spec has its own.
+        - local_root_dir (str): The root directory on the local machine where files are saved.
+        - variables (list): The names of the CDF variables to load (e.g. ['Epoch', 'FEDU'] for ECT,
+          ['Epoch', 'Mag'] for EMFISIS).
+        - n_processes (int, optional): Number of processes that read files. Defaults to None
+          (the number of CPUs).
+
+    Returns:
+        - data (dict): Dictionary variable -> numpy.ndarray, with the records of all the files of
+          the range in chronological order. Whole files are loaded, so the first and last ones may
+          extend beyond the range.
+    '''
+
+    paths = get_local_files(spec, start_date, end_date, local_root_dir)
+    if not paths:
+        print('No local files in range')
+
+    return load_CDF_arrays(paths, variables, n_processes=n_processes)
@@ -0,0 +1,446 @@
+import os
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from Download_data.utils_download import download_file
+from Download_data.utils_session import get_session, get_timeout
+from Download_data.utils_metrics import emit_event, bind_run
+from Download_data.utils_bandwidth import throttle
+from Download_data.utils_retry import is_transient_error, is_throttle_error
+from Download_data.download_engine import HostLimit, DEFAULT_MAX_PER_HOST
+
+
+"""
+Mirrors of the datasets, with latency probing and automatic failover.
+
+The same files are served by several archives, each with its own directory
+layout: the RBSP-ECT science center, SPDF and CDAWeb for ECT; SPDF and CDAWeb
+for EMFISIS and OMNI. The jobs of a run are still built against remote_root_dir
+(the layout of the download functions); a MirrorSet translates every job to the
+other mirrors and runs it on the healthy mirror expected to finish it first:
+
+    mirror_set = get_mirror_set('ect', ect_url, server='nm')
+    mirror_set.probe(jobs)
+    run_download_jobs(jobs, download_function=mirror_set.get_download_function(),
+                      n_workers=12, max_per_host=mirror_set.get_max_jobs())
+
+The expected time of a file on a mirror comes from its latency and throughput,
+measured by probe and updated with every download, and grows with the jobs
+already running on it, so the load is spread over the mirrors in proportion to
+their speed. A job that fails on a mirror moves at once to the next one, and a
+mirror with MIRROR_MAX_ERRORS consecutive errors is left out for
+MIRROR_COOLDOWN seconds.
+"""
+
+
+# Errores seguidos tras los cuales un espejo se deja de usar, y por cuántos segundos
+MIRROR_MAX_ERRORS = 3
+MIRROR_COOLDOWN = 300
+
+# Bytes que se piden a cada espejo para medir su latencia y velocidad
+PROBE_SIZE = 256*1024
+
+# Peso de cada medición nueva en los promedios móviles de latencia y velocidad
+MIRROR_SMOOTHING = 0.3
+
+_ECT_PATH = re.compile(r'^rbsp([ab])/(\w+)/level(3)/pitchangle/(\d{4})/(\w+_(rel\d+)_[^/]+)$')
+
+
+def get_path_ECT_SPDF(relative_path):
+
+    '''
+    Translate the path of an ECT file in the layout of the RBSP-ECT science center
+    (see rbsp.download_ect.get_remote_dir_ECT) to the layout of SPDF and CDAWeb.
+
+    Args:
+        - relative_path (str): The path relative to the root of the science center archive, e.g.
+          'rbspa/rept/level3/pitchangle/2013/rbspa_rel03_ect-rept-sci-l3_20130101_v5.0.0.cdf'.
+
+    Returns:
+        - path (str or None): The path relative to the SPDF root, e.g.
+          'rbspa/l3/ect/rept/sectors/rel03/2013/rbspa_rel03_ect-rept-sci-l3_20130101_v5.0.0.cdf',
+          or None if the file is not level 3 data.
+    '''
+
+    match = _ECT_PATH.match(relative_path)
+    if match is None:
+        return None
+    probe, instrument, level, year, filename, release = match.groups()
+
+    return 'rbsp%s/l%s/ect/%s/sectors/%s/%s/%s' % (probe, level, instrument, release, year, filename)
+
+
+# Espejos de cada dataset: nombre -> (URL raíz, traducción de rutas desde la estructura de las
+# funciones de descarga, None si es la misma)
+MIRRORS = {
+    'ect': {'nm': ('https://rbsp-ect.newmexicoconsortium.org/data_pub/', None),
+            'spdf': ('https://spdf.gsfc.nasa.gov/pub/data/rbsp/', get_path_ECT_SPDF),
+            'cdaweb': ('https://cdaweb.gsfc.nasa.gov/pub/data/rbsp/', get_path_ECT_SPDF)},
+    'emfisis': {'spdf': ('https://spdf.gsfc.nasa.gov/pub/data/rbsp/', None),
+                'cdaweb': ('https://cdaweb.gsfc.nasa.gov/pub/data/rbsp/', None)},
+    'omni': {'spdf': ('https://spdf.gsfc.nasa.gov/pub/data/omni/omni_cdaweb/', None),
+             'cdaweb': ('https://cdaweb.gsfc.nasa.gov/pub/data/omni/omni_cdaweb/', None)},
+}
+
+
+def register_mirror(dataset, name, root, layout=None):
+
+    '''
+    Add a mirror of a dataset to the registry, or replace the one with the same name
+    (e.g. an institutional cache).
+
+    Args:
+        - dataset (str): The dataset ('ect', 'emfisis' or 'omni').
+        - name (str): The name of the mirror.
+        - root (str): The root URL of the mirror (must include a trailing '/').
+        - layout (callable, optional): Function that translates the path of a file relative to
+          remote_root_dir, in the layout of the download functions, to the path relative to root,
+          returning None for files the mirror does not have. Defaults to None (same layout).
+
+    Returns:
+        - None
+    '''
+
+    MIRRORS.setdefault(dataset, {})[name] = (root, layout)
+
+    return
+
+
+class Mirror:
+
+    '''
+    One mirror of a MirrorSet, with its measured latency and throughput, its health
+    and its own adaptive cap of simultaneous downloads (see download_engine.HostLimit).
+    '''
+
+    def __init__(self, name, root, layout=None, max_per_host=DEFAULT_MAX_PER_HOST):
+        self.name = name
+        self.root = root
+        self.layout = layout
+        self.latency = None
+        self.throughput = None
+        self.errors = 0
+        self.down_until = 0.0
+        self.limit = HostLimit(max_per_host)
+
+    def get_url(self, relative_path):
+
+        '''
+        Build the URL of a file on this mirror.
+
+        Args:
+            - relative_path (str): The path of the file relative to remote_root_dir.
+
+        Returns:
+            - url (str or None): The URL, or None if the mirror does not have the file.
+        '''
+
+        path = relative_path if self.layout is None else self.layout(relative_path)
+
+        return None if path is None else self.root + path
+
+    def is_healthy(self):
+        return time.monotonic() >= self.down_until
+
+    def get_cost(self, file_size):
+
+        '''
+        Estimate how long a new file would take on this mirror, counting the jobs
+        already running on it.
+
+        Args:
+            - file_size (float or None): The typical size of a file in bytes, if known.
+
+        Returns:
+            - cost (float): The estimated time in seconds (1 per file for unmeasured mirrors).
+        '''
+
+        seconds = self.latency or 0.0
+        if self.throughput and file_size:
+            seconds += file_size/self.throughput
+        if seconds == 0:
+            seconds = 1.0
+
+        return seconds*(self.limit.active + 1)/max(int(self.limit.limit), 1)
+
+
+def _smooth(old, new):
+
+    # Promedio móvil exponencial, que parte del primer valor medido
+    return new if old is None else (1 - MIRROR_SMOOTHING)*old + MIRROR_SMOOTHING*new
+
+
+class MirrorSet:
+
+    '''
+    The mirrors of a dataset for one run. The first mirror is remote_root_dir, the
+    root the jobs are built with; the URLs of the jobs are translated to the others.
+    '''
+
+    def __init__(self, mirrors):
+        self.mirrors = mirrors
+        self.root = mirrors[0].root if mirrors[0].root.endswith('/') else mirrors[0].root + '/'
+        self.file_size = None
+        self._lock = threading.Lock()
+
+    def get_relative_path(self, url):
+
+        '''
+        Return the path of a job URL relative to remote_root_dir.
+
+        Args:
+            - url (str): The URL of the job.
+
+        Returns:
+            - relative_path (str or None): The relative path, or None if the URL is not under remote_root_dir.
+        '''
+
+        return url[len(self.root):] if url.startswith(self.root) else None
+
+    def _get_mirror_url(self, mirror, url, relative_path):
+
+        if mirror is self.mirrors[0]:
+            return url
+
+        return mirror.get_url(relative_path) if relative_path is not None else None
+
+    def get_max_jobs(self):
+
+        '''
+        Return the number of simultaneous jobs the mirrors accept together, to be used as
+        max_per_host of download_engine.run_download_jobs (all the jobs have the host of
+        remote_root_dir, and each mirror applies its own cap).
+
+        Returns:
+            - max_jobs (int): The sum of the caps of the mirrors.
+        '''
+
+        return sum(mirror.limit.maximum for mirror in self.mirrors)
+
+    def _probe_mirror(self, mirror, url):
+
+        # Pedimos el comienzo de un archivo: el tiempo hasta la respuesta es la latencia,
+        # y el resto de la transferencia da la velocidad
+        start = time.monotonic()
+        try:
+            with get_session().get(url, headers={'Range': 'bytes=0-%d' % (PROBE_SIZE - 1)},
+                                   stream=True, timeout=get_timeout()) as response:
+                latency = time.monotonic() - start
+                response.raise_for_status()
+                # Si el servidor ignora el Range, cortamos la transferencia al llegar a PROBE_SIZE
+                content = b''
+                for chunk in response.iter_content(chunk_size=64*1024):
+                    content += chunk
+                    if len(content) >= PROBE_SIZE:
+                        break
+        except Exception as e:
+            with self._lock:
+                mirror.down_until = time.monotonic() + MIRROR_COOLDOWN
+            print(f"Mirror {mirror.name} unavailable: {e}")
+            return
+
+        throttle(len(content))
+        seconds = time.monotonic() - start
+        emit_event('probe', url, seconds=seconds, bytes=len(content))
+        with self._lock:
+            mirror.latency = latency
+            if seconds > latency:
+                mirror.throughput = len(content)/(seconds - latency)
+
+        return
+
+    def probe(self, jobs):
+
+        '''
+        Measure the latency and throughput of every mirror by fetching the first bytes
+        of the file of the first job from all of them at once. Mirrors that fail are
+        left out for MIRROR_COOLDOWN seconds.
+
+        Args:
+            - jobs (list): List of (url, local_path) tuples of the run.
+
+        Returns:
+            - None
+        '''
+
+        if len(jobs) == 0:
+            return
+
+        url = jobs[0][0]
+        relative_path = self.get_relative_path(url)
+        targets = [(mirror, self._get_mirror_url(mirror, url, relative_path)) for mirror in self.mirrors]
+        targets = [(mirror, mirror_url) for mirror, mirror_url in targets if mirror_url is not None]
+
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            list(executor.map(bind_run(lambda target: self._probe_mirror(*target)), targets))
+
+        for mirror, mirror_url in targets:
+            if mirror.latency is not None and mirror.is_healthy():
+                speed = ', %.2f MB/s' % (mirror.throughput/1e6) if mirror.throughput else ''
+                print(f"Mirror {mirror.name}: {mirror.latency:.3f} s{speed}")
+
+        return
+
+    def choose(self, url, exclude=(), pinned_url=None):
+
+        '''
+        Choose the mirror for a job: the healthy mirror with the lowest expected time
+        (see Mirror.get_cost), or, if none is healthy, the one with the lowest expected time.
+
+        Args:
+            - url (str): The URL of the job.
+            - exclude (list, optional): Mirrors already tried for the job. Defaults to ().
+            - pinned_url (str, optional): URL to use if its mirror is a healthy candidate, whatever
+              its cost (e.g. the mirror that issued the stored validators of the file). Defaults to None.
+
+        Returns:
+            - mirror (Mirror or None): The mirror, or None if no mirror is left.
+            - mirror_url (str or None): The URL of the file on the mirror.
+        '''
+
+        relative_path = self.get_relative_path(url)
+        with self._lock:
+            candidates = [(mirror, self._get_mirror_url(mirror, url, relative_path))
+                          for mirror in self.mirrors if mirror not in exclude]
+            candidates = [candidate for candidate in candidates if candidate[1] is not None]
+            healthy = [candidate for candidate in candidates if candidate[0].is_healthy()] or candidates
+            if not healthy:
+                return None, None
+
+            for candidate in healthy:
+                if candidate[1] == pinned_url:
+                    return candidate
+
+            return min(healthy, key=lambda candidate: candidate[0].get_cost(self.file_size))
+
+    def _record_success(self, mirror, seconds, n_bytes):
+
+        with self._lock:
+            mirror.errors = 0
+            self.file_size = _smooth(self.file_size, n_bytes)
+            transfer_seconds = seconds - (mirror.latency or 0.0)
+            if transfer_seconds > 0:
+                mirror.throughput = _smooth(mirror.throughput, n_bytes/transfer_seconds)
+
+        return
+
+    def _record_error(self, mirror):
+
+        with self._lock:
+            mirror.errors += 1
+            if mirror.errors < MIRROR_MAX_ERRORS:
+                return
+            mirror.errors = 0
+            mirror.down_until = time.monotonic() + MIRROR_COOLDOWN
+        print(f"\nMirror {mirror.name} left out for {MIRROR_COOLDOWN} s after {MIRROR_MAX_ERRORS} errors")
+
+        return
+
+    def get_download_function(self, download_function=download_file, pinned_urls=None):
+
+        '''
+        Build a download function that runs each job on the mirrors, to be passed as
+        download_function to download_engine.run_download_jobs.
+
+        The job runs on the mirror chosen by choose. If it fails there, it moves to the
+        next mirror, until it succeeds or every mirror has failed. In that case a transient
+        error is raised if any mirror gave one (so the engine retries the job later),
+        and otherwise the last error.
+
+        A partial download ('.part' file) is only resumed on the mirror that started it
+        (see utils_download.download_file), so moving to another mirror starts the file over.
+
+        Args:
+            - download_function (callable, optional): Function called as download_function(url,
+              local_path) with the URL on the chosen mirror (e.g. the function returned by
+              inventory.get_revalidation_function). Defaults to utils_download.download_file.
+            - pinned_urls (dict, optional): Dictionary {local_path: url} with the URL to try first
+              for each file, while its mirror is healthy. Revalidations pass the URL that issued the
+              stored validators, since ETags are only valid on the server that issued them.
+              Defaults to None.
+
+        Returns:
+            - download_function (callable): Function called as download_function(url, local_path).
+        '''
+
+        pinned_urls = pinned_urls or {}
+
+        def download(url, local_path):
+            tried = []
+            error = None
+            transient_error = None
+            while True:
+                # Sólo el primer intento va al espejo fijado
+                pinned_url = pinned_urls.get(local_path) if not tried else None
+                mirror, mirror_url = self.choose(url, exclude=tried, pinned_url=pinned_url)
+                if mirror is None:
+                    # Si algún espejo falló por un error pasajero, el motor debe reintentar el archivo
+                    if transient_error is not None:
+                        raise transient_error
+                    raise error if error is not None else FileNotFoundError('No mirror has %s' % url)
+                if tried:
+                    emit_event('failover', mirror_url, previous=tried[-1].name)
+                tried.append(mirror)
+
+                slot = mirror.limit.acquire()
+                start = time.monotonic()
+                try:
+                    downloaded = download_function(mirror_url, local_path)
+                except Exception as e:
+                    mirror.limit.release(slot, throttled=is_throttle_error(e))
+                    # Un archivo que falta en un espejo no dice nada de su salud
+                    if is_transient_error(e):
+                        self._record_error(mirror)
+                        transient_error = e
+                    error = e
+                    continue
+                mirror.limit.release(slot)
+
+                if downloaded:
+                    self._record_success(mirror, time.monotonic() - start, os.path.getsize(local_path))
+                return downloaded
+
+        return download
+
+
+def get_mirror_set(dataset, remote_root_dir, mirrors='all', server=None, max_per_host=DEFAULT_MAX_PER_HOST):
+
+    '''
+    Build the MirrorSet of a dataset: remote_root_dir first, then the mirrors of the
+    registry (MIRRORS).
+
+    Args:
+        - dataset (str): The dataset ('ect', 'emfisis' or 'omni').
+        - remote_root_dir (str): The root URL the jobs are built with.
+        - mirrors (list or str, optional): The names of the registry mirrors to use, or 'all'.
+          Defaults to 'all'.
+        - server (str, optional): The name of the registry mirror remote_root_dir points to, which
+          is not added twice (mirrors with the same root are never added twice). Defaults to None.
+        - max_per_host (int, optional): Maximum number of simultaneous downloads from each mirror.
+          Defaults to 4.
+
+    Returns:
+        - mirror_set (MirrorSet): The mirrors.
+
+    Raises:
+        - ValueError: If the dataset has no mirrors or a mirror name is unknown.
+    '''
+
+    if dataset not in MIRRORS:
+        raise ValueError('No mirrors for dataset %r (valid: %s)' % (dataset, ', '.join(MIRRORS)))
+    registry = MIRRORS[dataset]
+    names = list(registry) if mirrors == 'all' else list(mirrors)
+    unknown = [name for name in names if name not in registry]
+    if unknown:
+        raise ValueError('Unknown %s mirrors: %s (valid: %s)' % (dataset, ', '.join(unknown), ', '.join(registry)))
+
+    mirror_list = [Mirror(server or 'primary', remote_root_dir, max_per_host=max_per_host)]
+    primary_root = remote_root_dir.rstrip('/') + '/'
+    for name in names:
+        root, layout = registry[name]
+        if name == server or root == primary_root:
+            continue
+        mirror_list.append(Mirror(name, root, layout, max_per_host=max_per_host))
+
+    return MirrorSet(mirror_list)
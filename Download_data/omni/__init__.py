@@ -1 +1,21 @@
-from Download_data.omni.download_omni import download_CDFfiles_OMNI
+import importlib
+
+# Los módulos de descarga se importan recién cuando se usan, para que importar
+# el paquete no cargue sus dependencias
+_lazy_attributes = {
+    'download_CDFfiles_OMNI': 'Download_data.omni.download_omni',
+}
+
+__all__ = list(_lazy_attributes)
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_attributes))
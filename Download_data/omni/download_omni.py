@@ -1,7 +1,12 @@
-import pandas as pd
 import os
-import wget
-from Download_data.utils_download import bar_progress
+from Download_data.utils_dates import date_range
+from Download_data.utils_download import download_file
+from Download_data.mirrors import get_mirror_set
+from Download_data.download_engine import run_download_jobs, DEFAULT_N_WORKERS, DEFAULT_MAX_PER_HOST
+from Download_data.utils_retry import call_with_retry, DEFAULT_MAX_RETRIES
+from Download_data.utils_metrics import collect_run_report
+from Download_data.inventory import (get_missing_jobs, get_inventory_callback, get_revalidation_function,
+                                    get_file_validators)
 
 
 
@@ -110,35 +115,64 @@ def get_file_OMNI(filename, remote_dir, local_dir):
     '''
 
     print(f"Retrieving OMNI {filename} to {local_dir}")
-#    print(local_dir)
-    # Si el directorio local no existe, lo creamos
-    if not os.path.exists(os.path.dirname(local_dir)):
-        try:
-            os.makedirs(os.path.dirname(local_dir))
-        except OSError as exc:  # Guard against race condition
-            if exc.errno != errno.EEXIST:
-                raise
 
     # Si el archivo no existe en el directorio local, lo descargamos
     # si no existe el link, printeamos un mensaje de aviso
-    if not os.path.exists(local_dir+filename):
-        try:
-            wget.download(url=remote_dir+filename, out=local_dir,
-                          bar=bar_progress)
-            print()
+    try:
+        if call_with_retry(download_file, remote_dir+filename, local_dir+filename, url=remote_dir+filename):
             print(f"File downloaded: {filename}:")
-        except Exception as e:
-            print(f"File not found {remote_dir+filename}")
-            print(e)
-    # si el archivo ya existe en el directorio local, printeamos un mensaje avisando.
-    else:
-        print(f"File already exist: {filename}")
+        # si el archivo ya existe en el directorio local, printeamos un mensaje avisando.
+        else:
+            print(f"File already exist: {filename}")
+    except Exception as e:
+        print(f"File not found {remote_dir+filename}")
+        print(e)
     print()
 
     return
 
 
-def download_CDFfiles_OMNI(start_date, end_date, remote_root_dir, local_root_dir, res="1min", type="hro"):
+# Frecuencia de los archivos OMNI según la resolución temporal
+OMNI_FILE_FREQ = {'1min': 'MS', '5min': 'MS', '1h': '6MS'}
+
+
+def get_jobs_OMNI(start_date, end_date, remote_root_dir, local_root_dir, res="1min", typ="hro"):
+
+    '''
+    Build the list of download jobs for OMNI CDF data files in a date range.
+
+    OMNI files are monthly for the 1min and 5min resolutions and cover six months
+    for the 1h resolution.
+
+    Args:
+        - start_date (datetime.date): The start date for the range of data to download.
+        - end_date (datetime.date): The end date for the range of data to download.
+        - remote_root_dir (str): The base URL of the remote server hosting the data files.
+        - local_root_dir (str): The root directory on the local machine where files will be saved.
+        - res (str, optional): The time resolution of the data files ('1min', '5min' or '1h').
+          Defaults to '1min'.
+        - typ (str, optional): The type of OMNI data file ('hro' or 'hro2'). Defaults to 'hro'.
+
+    Returns:
+        - jobs (list): List of (url, local_path) tuples, ordered by date.
+    '''
+
+    date_array = date_range(start_date, end_date, freq=OMNI_FILE_FREQ[res])
+
+    jobs = []
+    for date in date_array:
+        filename = get_filename_OMNI(date, res, typ)
+        remote_dir = get_remote_dir_OMNI(date, remote_root_dir, res, typ)
+        local_dir = get_local_dir_OMNI(date, local_root_dir, res, typ)
+        jobs.append((remote_dir+filename, local_dir+filename))
+
+    return jobs
+
+
+def download_CDFfiles_OMNI(start_date, end_date, remote_root_dir, local_root_dir, res="1min", type="hro",
+                           n_workers=DEFAULT_N_WORKERS, max_per_host=DEFAULT_MAX_PER_HOST, use_inventory=True, report_path=None,
+                           max_retries=DEFAULT_MAX_RETRIES, failure_manifest=None, priority=None, revalidate=False,
+                           mirrors=None):
 
     '''
     Download OMNI CDF data files for a specified date range and configuration.
@@ -146,7 +180,9 @@ def download_CDFfiles_OMNI(start_date, end_date, remote_root_dir, local_root_dir
     This function downloads OMNI data files from a specified remote server and
     saves them to a local directory. It supports customization of data resolution
     and the type of OMNI data file. Additionally, it validates the resolution and
-    type combination, invalid options will result in an error message and termination
+    type combination, invalid options will result in an error message and termination.
+    The files are downloaded concurrently by the shared download engine
+    (Download_data.download_engine).
 
     Args:
         - start_date (datetime.date): The start date for the range of data to download.
@@ -157,6 +193,35 @@ def download_CDFfiles_OMNI(start_date, end_date, remote_root_dir, local_root_dir
           or '1h'). Defaults to '1min'.
         - typ (str, optional): The type of OMNI data file ('hro' or 'hro2').
           Defaults to 'hro'.
+        - n_workers (int, optional): Number of concurrent downloads. Defaults to 4.
+        - max_per_host (int, optional): Maximum number of concurrent downloads from the same host.
+          Defaults to 4.
+        - use_inventory (bool, optional): Whether to check the local files against the inventory of
+          local_root_dir (see Download_data.inventory) instead of probing each file on disk, and to
+          record the downloaded files in it. Defaults to True.
+        - report_path (str, optional): Path of a JSON run report with the per-phase timings
+          (listing, connect, first byte, transfer, write), latency histograms and bytes/s of the
+          run, overall and per host (see Download_data.utils_metrics). Defaults to None (no report).
+        - max_retries (int, optional): Maximum number of retries of a file after a transient error
+          (timeout, connection reset, truncated transfer, HTTP 429 or 5xx). Defaults to 5.
+        - failure_manifest (str, optional): Path of a JSON file where the files that could not be
+          downloaded are listed (see download_engine.write_failure_manifest). Defaults to None.
+        - priority (callable, optional): Function called as priority(job) that returns a sort key;
+          jobs with lower keys start first (see download_engine.newest_first and window_first).
+          Defaults to None (date order).
+        - revalidate (bool, optional): Whether to check the files that already exist locally against
+          the server. OMNI files keep their name when SPDF regenerates them, so an existing file may be
+          stale. Each file is fetched with a conditional request using the ETag/Last-Modified stored in
+          the inventory, so unchanged files cost a 304 response and only changed files are downloaded
+          again (see inventory.get_revalidation_function). The inventory is always used in this mode.
+          Defaults to False.
+        - mirrors (list or str, optional): Names of the mirrors of the dataset (see
+          Download_data.mirrors.MIRRORS), or 'all', over which the downloads are spread besides
+          remote_root_dir. The mirrors are probed first, each file goes to the healthy mirror expected
+          to finish it first, and a file that fails on one mirror moves to the next (see
+          mirrors.MirrorSet). When revalidating, each file is checked first on the mirror it was
+          downloaded from, whose validators are stored in the inventory. Raise n_workers to make use
+          of the extra hosts. Defaults to None (only remote_root_dir).
 
     Returns:
         - None
@@ -173,7 +238,6 @@ def download_CDFfiles_OMNI(start_date, end_date, remote_root_dir, local_root_dir
         else:
             print("Please select a valid option for type")
             return
-        date_array = pd.date_range(start=start_date, end=end_date, freq='MS')
 
     elif res == '5min':
         if type == 'hro':
@@ -183,23 +247,45 @@ def download_CDFfiles_OMNI(start_date, end_date, remote_root_dir, local_root_dir
         else:
             print("Please select a valid option for type")
             return
-        date_array = pd.date_range(start=start_date, end=end_date, freq='MS')
 
     elif res == '1h':
         print("OMNI 1 hour resolution")
-        date_array = pd.date_range(start=start_date, end=end_date, freq='6MS')
 
     else:
         print("Please select a valid option for temporal resolution")
         return
 
     print('---')
-    for date in date_array:
-        filename = get_filename_OMNI(date, res, type)
-        remote_dir = get_remote_dir_OMNI(date, remote_root_dir, res, type)
-#        print(remote_dir+filename)
-        local_dir = get_local_dir_OMNI(date, local_root_dir, res, type)
-        get_file_OMNI(filename, remote_dir, local_dir)
+    with collect_run_report(report_path):
+        jobs = get_jobs_OMNI(start_date, end_date, remote_root_dir, local_root_dir, res, type)
+        on_complete = None
+        download_function = download_file
+        if revalidate:
+            # Preguntamos al servidor por todos los archivos, también los que ya tenemos
+            on_complete = get_inventory_callback(local_root_dir)
+            download_function = get_revalidation_function(local_root_dir, jobs, on_complete)
+        elif use_inventory:
+            jobs = get_missing_jobs(local_root_dir, jobs)
+            on_complete = get_inventory_callback(local_root_dir)
+        # Repartimos las descargas entre los espejos del dataset
+        if mirrors:
+            mirror_set = get_mirror_set('omni', remote_root_dir, mirrors, max_per_host=max_per_host)
+            mirror_set.probe(jobs)
+            # Al revalidar, cada archivo va primero al espejo que emitió sus validadores
+            pinned_urls = None
+            if revalidate:
+                stored = get_file_validators(local_root_dir, [job[1] for job in jobs])
+                pinned_urls = dict((path, validators['url']) for path, validators in stored.items() if validators['url'])
+            download_function = mirror_set.get_download_function(download_function, pinned_urls)
+            # El motor ve todos los trabajos con el host de remote_root_dir; cada espejo aplica su propio límite
+            max_per_host = mirror_set.get_max_jobs()
+        try:
+            run_download_jobs(jobs, download_function=download_function, n_workers=n_workers, max_per_host=max_per_host,
+                              on_complete=on_complete, max_retries=max_retries, failure_manifest=failure_manifest,
+                              priority=priority)
+        finally:
+            if on_complete is not None:
+                on_complete.close()
 
     print('---')
     print("DONE")
@@ -0,0 +1,281 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from Download_data.utils_download import get_remote_size
+from Download_data.utils_listing import fetch_listings, get_file_date, DEFAULT_LISTING_TTL
+from Download_data.download_engine import run_download_jobs, iter_download_jobs, DEFAULT_N_WORKERS, DEFAULT_MAX_PER_HOST
+from Download_data.utils_retry import DEFAULT_MAX_RETRIES
+from Download_data.utils_metrics import bind_run
+from Download_data.inventory import get_missing_jobs, get_inventory_callback
+from Download_data.rbsp.download_ect import get_jobs_ECT, get_listing_urls_ECT, read_site_content_ECT
+from Download_data.rbsp.download_emfisis import get_jobs_EMFISIS, get_listing_urls_EMFISIS, read_site_content_EMFISIS
+from Download_data.omni.download_omni import get_jobs_OMNI
+
+
+"""
+Planning of download campaigns over several datasets.
+
+A campaign is a list of dataset specs, e.g. ECT REPT and MagEIS, EMFISIS 4sec
+GEO and OMNI 1min for both probes over several years:
+
+    specs = [{'dataset': 'ect', 'remote_root_dir': ect_url, 'probe': 'both', 'instrument': 'rept'},
+             {'dataset': 'ect', 'remote_root_dir': ect_url, 'probe': 'both', 'instrument': 'mageis'},
+             {'dataset': 'emfisis', 'remote_root_dir': emfisis_url, 'probe': 'both', 'interval': 4},
+             {'dataset': 'omni', 'remote_root_dir': omni_url, 'res': '1min', 'typ': 'hro'}]
+    plan = plan_downloads(specs, '2012-09-01', '2019-10-13', local_root_dir, with_sizes=True)
+    run_plan(plan, local_root_dir)
+
+The planner fetches every yearly listing the campaign needs up front and in
+parallel, resolves all the dates against them, removes duplicated targets and
+the files already on disk, and returns one job list ordered by date, that can
+be inspected, sharded or handed to the download engine.
+
+To process the files of one dataset while the rest download, iter_CDFfiles
+yields the local paths in chronological order as they become available:
+
+    for path in iter_CDFfiles(specs[0], '2013-01-01', '2013-12-31', local_root_dir, lookahead=8):
+        process(path)
+"""
+
+
+# Funciones de cada dataset: construir los trabajos, las URLs de los listados
+# que necesita, y leer esos listados
+DATASETS = {
+    'ect': (get_jobs_ECT, get_listing_urls_ECT, read_site_content_ECT),
+    'emfisis': (get_jobs_EMFISIS, get_listing_urls_EMFISIS, read_site_content_EMFISIS),
+    'omni': (get_jobs_OMNI, None, None),
+}
+
+# Claves de un spec que no son argumentos de las funciones del dataset
+_SPEC_KEYS = ('dataset', 'remote_root_dir', 'start_date', 'end_date')
+
+
+def _get_spec_options(spec):
+
+    if spec.get('dataset') not in DATASETS:
+        raise ValueError('Unknown dataset %r (valid: %s)' % (spec.get('dataset'), ', '.join(DATASETS)))
+
+    return dict((key, value) for key, value in spec.items() if key not in _SPEC_KEYS)
+
+
+def get_spec_listings(spec, start_date, end_date):
+
+    '''
+    Build the remote directory listings needed to resolve a dataset spec.
+
+    Args:
+        - spec (dict): The dataset spec (see plan_downloads).
+        - start_date (datetime.date or str): The start date of the campaign, unless the spec has its own.
+        - end_date (datetime.date or str): The end date of the campaign, unless the spec has its own.
+
+    Returns:
+        - listings (list): List of (url, read_function) tuples, empty for datasets whose
+          filenames are known without a listing (OMNI).
+    '''
+
+    options = _get_spec_options(spec)
+    get_jobs, get_listing_urls, read_function = DATASETS[spec['dataset']]
+    if get_listing_urls is None:
+        return []
+
+    urls = get_listing_urls(spec.get('start_date', start_date), spec.get('end_date', end_date),
+                            spec['remote_root_dir'], **options)
+
+    return [(url, read_function) for url in urls]
+
+
+def get_spec_jobs(spec, start_date, end_date, local_root_dir, listing_cache_dir=None, listing_ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Build the download jobs of a dataset spec.
+
+    Args:
+        - spec (dict): The dataset spec (see plan_downloads).
+        - start_date (datetime.date or str): The start date of the campaign, unless the spec has its own.
+        - end_date (datetime.date or str): The end date of the campaign, unless the spec has its own.
+        - local_root_dir (str): The root directory on the local machine where files will be saved.
+        - listing_cache_dir (str, optional): Directory where listings are persisted between runs. Defaults to None.
+        - listing_ttl (float, optional): Maximum age in seconds of a listing read from listing_cache_dir.
+          Defaults to one day.
+
+    Returns:
+        - jobs (list): List of (url, local_path) tuples.
+    '''
+
+    options = _get_spec_options(spec)
+    get_jobs, get_listing_urls, read_function = DATASETS[spec['dataset']]
+    if get_listing_urls is not None:
+        options.update(listing_cache_dir=listing_cache_dir, listing_ttl=listing_ttl)
+
+    return get_jobs(spec.get('start_date', start_date), spec.get('end_date', end_date),
+                    spec['remote_root_dir'], local_root_dir, **options)
+
+
+def plan_downloads(specs, start_date, end_date, local_root_dir, n_workers=8, use_inventory=True,
+                   with_sizes=False, listing_cache_dir=None, listing_ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Resolve a download campaign over several datasets into one deduplicated and
+    ordered job list, without downloading any data file.
+
+    Every spec is a dictionary with the keys 'dataset' ('ect', 'emfisis' or 'omni')
+    and 'remote_root_dir', optionally 'start_date' and 'end_date' to override the
+    dates of the campaign, and the remaining arguments of the get_jobs_* function of
+    the dataset (e.g. 'probe', 'instrument' and 'level' for ECT; 'probe', 'level',
+    'interval' and 'coordinates' for EMFISIS; 'res' and 'typ' for OMNI).
+
+    Args:
+        - specs (list): The dataset specs of the campaign.
+        - start_date (datetime.date or str): The start date of the campaign.
+        - end_date (datetime.date or str): The end date of the campaign.
+        - local_root_dir (str): The root directory on the local machine where files will be saved.
+        - n_workers (int, optional): Number of listings (and HEAD requests) fetched at the same time.
+          Defaults to 8.
+        - use_inventory (bool, optional): Whether to drop the files already on disk by checking the
+          inventory of local_root_dir (see Download_data.inventory) instead of probing each file.
+          Defaults to True.
+        - with_sizes (bool, optional): Whether to ask the server for the size of every planned file
+          with HEAD requests. Defaults to False.
+        - listing_cache_dir (str, optional): Directory where listings are persisted between runs. Defaults to None.
+        - listing_ttl (float, optional): Maximum age in seconds of a listing read from listing_cache_dir.
+          Defaults to one day.
+
+    Returns:
+        - plan (dict): Dictionary with the keys:
+            - 'jobs': list of (url, local_path) tuples to download, ordered by file date (and by
+              spec for the same date).
+            - 'n_existing': number of targets left out because they are already on disk.
+            - 'sizes': list with the size in bytes of every job (None where the server did not
+              announce it), or None if with_sizes is False.
+            - 'total_bytes': sum of the known sizes, or None if with_sizes is False.
+    '''
+
+    # Traemos en paralelo todos los listados anuales que necesita la campaña
+    listings = []
+    for spec in specs:
+        listings += get_spec_listings(spec, start_date, end_date)
+    fetch_listings(listings, n_workers=n_workers, cache_dir=listing_cache_dir, ttl=listing_ttl)
+
+    # Con los listados en caché, resolver las fechas ya no consulta al servidor
+    jobs = []
+    seen = set()
+    for spec in specs:
+        for job in get_spec_jobs(spec, start_date, end_date, local_root_dir,
+                                 listing_cache_dir=listing_cache_dir, listing_ttl=listing_ttl):
+            if job[1] not in seen:
+                seen.add(job[1])
+                jobs.append(job)
+
+    # Orden cronológico; sort es estable, así que dentro de una fecha se respeta el orden de los specs
+    jobs.sort(key=lambda job: get_file_date(os.path.basename(job[0])) or '')
+
+    n_planned = len(jobs)
+    if use_inventory:
+        jobs = get_missing_jobs(local_root_dir, jobs)
+    else:
+        jobs = [job for job in jobs if not os.path.exists(job[1])]
+
+    sizes = None
+    total_bytes = None
+    if with_sizes and len(jobs) > 0:
+        def get_size(job):
+            try:
+                return get_remote_size(job[0])
+            except Exception:
+                return None
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            sizes = list(executor.map(bind_run(get_size), jobs))
+        total_bytes = sum(size for size in sizes if size is not None)
+    elif with_sizes:
+        sizes = []
+        total_bytes = 0
+
+    return {'jobs': jobs, 'n_existing': n_planned - len(jobs), 'sizes': sizes, 'total_bytes': total_bytes}
+
+
+def run_plan(plan, local_root_dir, n_workers=DEFAULT_N_WORKERS, max_per_host=DEFAULT_MAX_PER_HOST,
+             use_inventory=True, max_retries=DEFAULT_MAX_RETRIES, failure_manifest=None, priority=None):
+
+    '''
+    Download the jobs of a plan with the shared download engine.
+
+    Args:
+        - plan (dict): The plan returned by plan_downloads.
+        - local_root_dir (str): The root directory on the local machine where files are saved.
+        - n_workers (int, optional): Number of concurrent downloads. Defaults to 4.
+        - max_per_host (int, optional): Maximum number of concurrent downloads from the same host.
+          Defaults to 4.
+        - use_inventory (bool, optional): Whether to record the downloaded files in the inventory of
+          local_root_dir. Defaults to True.
+        - max_retries (int, optional): Maximum number of retries of a file after a transient error.
+          Defaults to 5.
+        - failure_manifest (str, optional): Path of a JSON file where the files that could not be
+          downloaded are listed. Defaults to None.
+        - priority (callable, optional): Function called as priority(job) that returns a sort key;
+          jobs with lower keys start first (see download_engine.newest_first and window_first).
+          Defaults to None (date order).
+
+    Returns:
+        - results (dict): The results of download_engine.run_download_jobs.
+    '''
+
+    print(f"Plan: {len(plan['jobs'])} files to download, {plan['n_existing']} already on disk")
+    if plan['total_bytes'] is not None:
+        print(f"Plan: {plan['total_bytes']/1e9:.2f} GB announced by the server")
+
+    on_complete = get_inventory_callback(local_root_dir) if use_inventory else None
+    try:
+        return run_download_jobs(plan['jobs'], n_workers=n_workers, max_per_host=max_per_host, on_complete=on_complete,
+                                 max_retries=max_retries, failure_manifest=failure_manifest, priority=priority)
+    finally:
+        if on_complete is not None:
+            on_complete.close()
+
+
+def iter_CDFfiles(spec, start_date, end_date, local_root_dir, lookahead=8, n_workers=DEFAULT_N_WORKERS,
+                  max_per_host=DEFAULT_MAX_PER_HOST, use_inventory=True, max_retries=DEFAULT_MAX_RETRIES,
+                  listing_cache_dir=None, listing_ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Yield the local paths of the files of a dataset in a date range, in chronological
+    order, as soon as each one is on disk, while the next ones download in the
+    background (see download_engine.iter_download_jobs).
+
+    Files already on disk are yielded without waiting. Files that cannot be downloaded
+    are reported and skipped.
+
+    Args:
+        - spec (dict): The dataset spec (see plan_downloads).
+        - start_date (datetime.date or str): The start date of the range, unless the spec has its own.
+        - end_date (datetime.date or str): The end date of the range, unless the spec has its own.
+        - local_root_dir (str): The root directory on the local machine where files are saved.
+        - lookahead (int, optional): Number of files downloaded ahead of the file being processed.
+          Defaults to 8.
+        - n_workers (int, optional): Number of concurrent downloads. Defaults to 4.
+        - max_per_host (int, optional): Maximum number of concurrent downloads from the same host.
+          Defaults to 4.
+        - use_inventory (bool, optional): Whether to record the downloaded files in the inventory of
+          local_root_dir. Defaults to True.
+        - max_retries (int, optional): Maximum number of retries of a file after a transient error.
+          Defaults to 5.
+        - listing_cache_dir (str, optional): Directory where listings are persisted between runs. Defaults to None.
+        - listing_ttl (float, optional): Maximum age in seconds of a listing read from listing_cache_dir.
+          Defaults to one day.
+
+    Yields:
+        - local_path (str): The local path of each file of the range.
+    '''
+
+    fetch_listings(get_spec_listings(spec, start_date, end_date), n_workers=n_workers,
+                   cache_dir=listing_cache_dir, ttl=listing_ttl)
+    jobs = get_spec_jobs(spec, start_date, end_date, local_root_dir,
+                         listing_cache_dir=listing_cache_dir, listing_ttl=listing_ttl)
+    jobs.sort(key=lambda job: get_file_date(os.path.basename(job[0])) or '')
+
+    on_complete = get_inventory_callback(local_root_dir) if use_inventory else None
+    try:
+        yield from iter_download_jobs(jobs, n_workers=n_workers, max_per_host=max_per_host, lookahead=lookahead,
+                                      on_complete=on_complete, max_retries=max_retries)
+    finally:
+        if on_complete is not None:
+            on_complete.close()
@@ -1,2 +1,22 @@
-from Download_data.rbsp.download_ect import download_CDFfiles_ECT
-from Download_data.rbsp.download_emfisis import download_CDFfiles_EMFISIS
+import importlib
+
+# Los módulos de descarga se importan recién cuando se usan, para que importar
+# el paquete no cargue sus dependencias
+_lazy_attributes = {
+    'download_CDFfiles_ECT': 'Download_data.rbsp.download_ect',
+    'download_CDFfiles_EMFISIS': 'Download_data.rbsp.download_emfisis',
+}
+
+__all__ = list(_lazy_attributes)
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_attributes))
@@ -1,13 +1,13 @@
-import wget
 import os
-from bs4 import BeautifulSoup
-from urllib.request import Request, urlopen, urlretrieve
-import ssl
-import requests
-import fnmatch
-import pandas as pd
-import glob
-from Download_data.utils_download import bar_progress
+from Download_data.utils_dates import date_range, year_range
+from Download_data.utils_session import get_session, get_timeout
+from Download_data.utils_download import download_file
+from Download_data.mirrors import get_mirror_set
+from Download_data.download_engine import run_download_jobs, DEFAULT_N_WORKERS, DEFAULT_MAX_PER_HOST
+from Download_data.utils_retry import call_with_retry, DEFAULT_MAX_RETRIES
+from Download_data.utils_metrics import collect_run_report
+from Download_data.inventory import get_missing_jobs, get_inventory_callback, get_sync_jobs, remove_superseded_files
+from Download_data.utils_listing import get_date_index, parse_links, DEFAULT_LISTING_TTL
 
 
 """
@@ -25,9 +25,10 @@ def read_site_content_ECT(url):
     Retrieve a list of download links for RBSP ECT data from a given URL.
 
     This function takes a URL as input and retrieves the HTML content of the
-    corresponding web page. It then uses BeautifulSoup's HTML parser to extract
-    all the links (URLs) present on the page that are relevant for downloading
-    satellite data files. The extracted links are returned as a list.
+    corresponding web page through the shared HTTP session. It then scans the
+    page once for all the links (URLs) present on it that are relevant for
+    downloading satellite data files (see utils_listing.parse_links). The
+    extracted links are returned as a list.
 
     Args:
         - url (str): The URL of the web page to scrape for download links.
@@ -37,23 +38,14 @@ def read_site_content_ECT(url):
             found on the web page.
     '''
 
-    remote_files = []
-    req = Request(url)
-
     # Este objeto tiene todo el contenido de la página
-    content = urlopen(req, context = ssl.SSLContext()).read()
-
-    #HTML parsing
-    #Link útil para entender qué está sucediendo: https://stackabuse.com/guide-to-parsing-html-with-beautifulsoup-in-python/
-    soup = BeautifulSoup(content, 'html.parser')
-
-    # Aquí obtenemos todos los links que se encuentran en la página, todavía en formato HTML
-    # El tag 'a' de HTML define un hyperlink
-    existing_links = (soup.find_all('a'))
+    response = get_session().get(url, timeout=get_timeout())
+    response.raise_for_status()
+    content = response.content
 
-    # Con esto obtenemos los links, en formato string
-    for link in existing_links:
-        remote_files.append(link.extract().get_text())
+    #HTML parsing: obtenemos el texto de todos los links de la página (el tag 'a'
+    #de HTML define un hyperlink), en una sola pasada sobre el contenido
+    remote_files = parse_links(content)
 
     #Retornamos una lista con todos los links de la página, en formato string,
     #que al final son los nombres de los archivos a descargar
@@ -82,36 +74,36 @@ def get_remote_dir_ECT(date, remote_root_dir, probe, instrument, level):
     return remote_dir
 
 
-def get_remote_filename_ECT(date, remote_dir, probe, instrument, level):
+def get_remote_filename_ECT(date, remote_dir, probe, instrument, level, cache_dir=None, ttl=DEFAULT_LISTING_TTL):
 
     '''
     Finds the filename for downloading RBSP ECT data files from the specified directory.
 
+    The directory listing is fetched and parsed only once per run (see
+    Download_data.utils_listing), so every date of the same year is resolved
+    against the same cached listing.
+
     Args:
         - date (datetime.date): The date of the file to be downloaded.
         - remote_dir (str): The URL for downloading the RBSP ECT data files (must include a trailing '/').
         - probe (str): The probe or satellite identifier ('a' or 'b').
         - instrument (str): The name of the instrument from the ECT suite ('rept' or 'mageis').
         - level (str): The data level ('2' or '3').
+        - cache_dir (str, optional): Directory where listings are persisted between runs. Defaults to None.
+        - ttl (float, optional): Maximum age in seconds of a listing read from cache_dir. Defaults to one day.
 
     Returns:
         - filename (str): The name of the data file matching the specified date, to be downloaded.
-
-    Raises:
-        - IndexError: If no file matching the date is found in the remote directory.
+          If no file matches the date, 0 is returned.
     '''
 
-    # Obtenemos todos los links de descarga que están en la página web
-    files = read_site_content_ECT(remote_dir)
+    # Diccionario fecha -> nombre de archivo, construido una sola vez por directorio
+    date_index = get_date_index(remote_dir, read_site_content_ECT, cache_dir=cache_dir, ttl=ttl)
 
     # Encontramos el link que hace match con la fecha, que es el nombre del archivo a descargar
-#    print(fnmatch.filter(files, f"*{date.strftime('%Y%m%d')}*"))
-    try:
-        filename = fnmatch.filter(files, f"*{date.strftime('%Y%m%d')}*")[0]
-    except:
+    filename = date_index.get(date.strftime('%Y%m%d'), 0)
+    if filename == 0:
         print('No file in remote')
-        filename = 0
-#    filename = fnmatch.filter(files, f"*{date.strftime('%Y%m%d')}*")
 
     return filename
 
@@ -166,39 +158,95 @@ def get_file_ECT(filename, remote_dir, local_dir):
     if filename ==0:
         print('No file in remote')
     else:
-        # If the local directory does not exist, create it
-        if not os.path.exists(os.path.dirname(local_dir)):
-            try:
-                os.makedirs(os.path.dirname(local_dir))
-            except OSError as exc:
-                if exc.errno != errno.EEXIST:
-                    raise
-
         # Si el archivo no existe en el directorio local, lo descargamos
         # si no existe el link, printeamos un mensaje de aviso
-        #AQUÍ TIENE QUE IR UN IF FILENAME == 0
-        if not os.path.exists(local_dir+filename):
-            try:
-    #            wget.download(url=remote_dir+filename, out=local_dir,
-    #                          bar=bar_progress)
-                response = requests.get(remote_dir+filename, verify=False)
-                with open(local_dir+filename, 'wb') as file:
-                    file.write(response.content)
-                print()
+        try:
+            if call_with_retry(download_file, remote_dir+filename, local_dir+filename, url=remote_dir+filename):
                 print(f"File downloaded: {filename}:")
-            except Exception as e:
-                print(e)
-                print(f"File not found {remote_dir+filename}")
-
-        # si el archivo ya existe en el directorio local, printeamos un mensaje avisando.
-        else:
-            print(f"File already exist: {filename}")
+            # si el archivo ya existe en el directorio local, printeamos un mensaje avisando.
+            else:
+                print(f"File already exist: {filename}")
+        except Exception as e:
+            print(e)
+            print(f"File not found {remote_dir+filename}")
     print()
 
     return
 
 
-def download_CDFfiles_ECT(start_date, end_date, remote_root_dir, local_root_dir, probe, instrument, level="3", server='nm'):
+def get_listing_urls_ECT(start_date, end_date, remote_root_dir, probe, instrument, level="3"):
+
+    '''
+    Build the URLs of the remote directory listings needed to resolve a date range,
+    so they can be fetched up front (see utils_listing.fetch_listings).
+
+    Args:
+        - start_date (datetime.date): The start date of the range.
+        - end_date (datetime.date): The end date of the range.
+        - remote_root_dir (str): The base URL of the remote server hosting the data files.
+        - probe (str): The satellite identifier ('a', 'b', or 'both').
+        - instrument (str): The instrument name ('rept' o 'mageis').
+        - level (str, optional): The data level ('2' or '3'). Defaults to '3'.
+
+    Returns:
+        - urls (list): The URLs of the yearly remote directories, one per year and probe.
+    '''
+
+    probes = ['a', 'b'] if probe == 'both' else [probe]
+
+    return [get_remote_dir_ECT(date, remote_root_dir, p, instrument, level)
+            for date in year_range(start_date, end_date) for p in probes]
+
+
+def get_jobs_ECT(start_date, end_date, remote_root_dir, local_root_dir, probe, instrument, level="3",
+                 listing_cache_dir=None, listing_ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Build the list of download jobs for RBSP ECT CDF data files in a date range.
+
+    Every date of the range is resolved against the remote directory listing, and
+    the dates without a file in the remote directory are left out.
+
+    Args:
+        - start_date (datetime.date): The start date of the range for which to download data.
+        - end_date (datetime.date): The end date of the range for which to download data.
+        - remote_root_dir (str): The base URL of the remote server hosting the data files.
+        - local_root_dir (str): The root directory on the local machine where files will be saved.
+        - probe (str): The satellite identifier ('a', 'b', or 'both').
+        - instrument (str): The instrument name ('rept' o 'mageis').
+        - level (str, optional): The data level ('2' or '3'). Defaults to '3'.
+        - listing_cache_dir (str, optional): Directory where remote directory listings are persisted
+          between runs. Defaults to None.
+        - listing_ttl (float, optional): Maximum age in seconds of a listing read from
+          listing_cache_dir. Defaults to one day.
+
+    Returns:
+        - jobs (list): List of (url, local_path) tuples, ordered by date and probe.
+    '''
+
+    probes = ['a', 'b'] if probe == 'both' else [probe]
+    date_array = date_range(start_date, end_date, freq='D')
+
+    # Por cada fecha en el arreglo, generamos el link de descarga y el directorio local
+    # donde se van a guardar los datos
+    jobs = []
+    for date in date_array:
+        for p in probes:
+            remote_dir = get_remote_dir_ECT(date, remote_root_dir, p, instrument, level)
+            filename = get_remote_filename_ECT(date, remote_dir, p, instrument, level,
+                                               cache_dir=listing_cache_dir, ttl=listing_ttl)
+            local_dir = get_local_dir_ECT(date, local_root_dir, p, instrument, level)
+            if filename != 0:
+                jobs.append((remote_dir+filename, local_dir+filename))
+
+    return jobs
+
+
+def download_CDFfiles_ECT(start_date, end_date, remote_root_dir, local_root_dir, probe, instrument, level="3", server='nm',
+                          listing_cache_dir=None, listing_ttl=DEFAULT_LISTING_TTL,
+                          n_workers=DEFAULT_N_WORKERS, max_per_host=DEFAULT_MAX_PER_HOST, use_inventory=True,
+                          sync=False, remove_superseded=False, report_path=None,
+                          max_retries=DEFAULT_MAX_RETRIES, failure_manifest=None, priority=None, mirrors=None):
 
     '''
     Download RBSP ECT CDF data files for a specified date range and configuration.
@@ -206,6 +254,8 @@ def download_CDFfiles_ECT(start_date, end_date, remote_root_dir, local_root_dir,
     This function retrieves RBSP ECT data files from a remote server and saves them
     to a local directory. It supports downloading data for a specific probe ('a' or 'b')
     or both probes, and allows customization of the data level, instrument, and server.
+    The files are downloaded concurrently by the shared download engine
+    (Download_data.download_engine).
 
     Args:
         - start_date (datetime.date): The start date of the range for which to download data.
@@ -216,7 +266,39 @@ def download_CDFfiles_ECT(start_date, end_date, remote_root_dir, local_root_dir,
                        If 'both', data for both probes will be downloaded.
         - instrument (str): The instrument name for which to download data ('rept' o 'mageis')
         - level (str, optional): The data level to download ('2' or '3'). Defaults to '3'.
-        - server (str, optional): The server identifier to use for downloading (e.g., 'nm'). Defaults to 'nm'.
+        - server (str, optional): The name of the mirror remote_root_dir points to (see
+          Download_data.mirrors.MIRRORS), so it is not used twice with mirrors. Defaults to 'nm'.
+        - listing_cache_dir (str, optional): Directory where remote directory listings are persisted
+          between runs. Defaults to None (listings are only cached in memory for this run).
+        - listing_ttl (float, optional): Maximum age in seconds of a listing read from
+          listing_cache_dir. Defaults to one day.
+        - n_workers (int, optional): Number of concurrent downloads. Defaults to 4.
+        - max_per_host (int, optional): Maximum number of concurrent downloads from the same host.
+          Defaults to 4.
+        - use_inventory (bool, optional): Whether to check the local files against the inventory of
+          local_root_dir (see Download_data.inventory) instead of probing each file on disk, and to
+          record the downloaded files in it. Defaults to True.
+        - sync (bool, optional): Incremental sync mode. The remote listings are compared with the
+          inventory of local_root_dir and only the files that are missing locally or have a newer
+          release/version than the local copy are downloaded. Defaults to False.
+        - remove_superseded (bool, optional): In sync mode, delete the older local versions of the
+          files that were downloaded. Defaults to False.
+        - report_path (str, optional): Path of a JSON run report with the per-phase timings
+          (listing, connect, first byte, transfer, write), latency histograms and bytes/s of the
+          run, overall and per host (see Download_data.utils_metrics). Defaults to None (no report).
+        - max_retries (int, optional): Maximum number of retries of a file after a transient error
+          (timeout, connection reset, truncated transfer, HTTP 429 or 5xx). Defaults to 5.
+        - failure_manifest (str, optional): Path of a JSON file where the files that could not be
+          downloaded are listed (see download_engine.write_failure_manifest). Defaults to None.
+        - priority (callable, optional): Function called as priority(job) that returns a sort key;
+          jobs with lower keys start first (see download_engine.newest_first and window_first).
+          Defaults to None (date order).
+        - mirrors (list or str, optional): Names of the mirrors of the dataset (see
+          Download_data.mirrors.MIRRORS), or 'all', over which the downloads are spread besides
+          remote_root_dir. The mirrors are probed first, each file goes to the healthy mirror expected
+          to finish it first, and a file that fails on one mirror moves to the next (see
+          mirrors.MirrorSet). Raise n_workers to make use of the extra hosts. Defaults to None (only
+          remote_root_dir).
 
     Returns:
         - None
@@ -224,35 +306,45 @@ def download_CDFfiles_ECT(start_date, end_date, remote_root_dir, local_root_dir,
 
 #    print('\nPrint para ver si efectivamente se actualiza el paquete Download_data ECT V3')
     print(f'\nDOWNLOADING ECT-{instrument.upper()} INSTRUMENT DATA')
-    date_array = pd.date_range(start=start_date, end=end_date, freq='D')
 
     if not probe == 'both':
         print('PROBE ', probe.upper())
-        print('---\n')
-
-        # Por cada fecha en el arreglo, generamos el link de descarga y el directorio local
-        # donde se van a guardar los datos
-        for date in date_array:
-            remote_dir = get_remote_dir_ECT(date, remote_root_dir, probe, instrument, level)
-            filename = get_remote_filename_ECT(date, remote_dir, probe, instrument, level)
-            local_dir = get_local_dir_ECT(date, local_root_dir, probe, instrument, level)
-
-            # Descargamos los datos
-            get_file_ECT(filename, remote_dir, local_dir)
-
     else:
         print('BOTH PROBES')
-        print('---\n')
-        for date in date_array:
-            remote_dirA = get_remote_dir_ECT(date, remote_root_dir, 'a', instrument, level)
-            filenameA = get_remote_filename_ECT(date, remote_dirA, 'a', instrument, level)
-            local_dirA = get_local_dir_ECT(date, local_root_dir, 'a', instrument, level)
-            get_file_ECT(filenameA, remote_dirA, local_dirA)
-
-            remote_dirB = get_remote_dir_ECT(date, remote_root_dir, 'b', instrument, level)
-            filenameB = get_remote_filename_ECT(date, remote_dirB, 'b', instrument, level)
-            local_dirB = get_local_dir_ECT(date, local_root_dir, 'b', instrument, level)
-            get_file_ECT(filenameB, remote_dirB, local_dirB)
+    print('---\n')
+
+    with collect_run_report(report_path):
+        jobs = get_jobs_ECT(start_date, end_date, remote_root_dir, local_root_dir, probe, instrument, level,
+                            listing_cache_dir=listing_cache_dir, listing_ttl=listing_ttl)
+
+        # Descargamos los datos
+        on_complete = None
+        superseded = {}
+        if sync:
+            jobs, superseded = get_sync_jobs(local_root_dir, jobs)
+            print(f'Sync: {len(jobs)} new or updated files')
+        elif use_inventory:
+            jobs = get_missing_jobs(local_root_dir, jobs)
+        if sync or use_inventory:
+            on_complete = get_inventory_callback(local_root_dir)
+        # Repartimos las descargas entre los espejos del dataset
+        download_function = download_file
+        if mirrors:
+            mirror_set = get_mirror_set('ect', remote_root_dir, mirrors, server=server, max_per_host=max_per_host)
+            mirror_set.probe(jobs)
+            download_function = mirror_set.get_download_function(download_function)
+            # El motor ve todos los trabajos con el host de remote_root_dir; cada espejo aplica su propio límite
+            max_per_host = mirror_set.get_max_jobs()
+        try:
+            results = run_download_jobs(jobs, download_function=download_function, n_workers=n_workers,
+                                        max_per_host=max_per_host, on_complete=on_complete, max_retries=max_retries,
+                                        failure_manifest=failure_manifest, priority=priority)
+        finally:
+            if on_complete is not None:
+                on_complete.close()
+
+        if sync and remove_superseded:
+            remove_superseded_files(local_root_dir, superseded, results['downloaded'] + results['existing'])
 
     print('---')
     print("DONE")
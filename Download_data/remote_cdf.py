@@ -0,0 +1,304 @@
+import time
+import threading
+from collections import OrderedDict
+from Download_data.utils_dates import to_datetime
+from Download_data.utils_session import get_session, get_timeout
+from Download_data.utils_retry import call_with_retry
+from Download_data.utils_metrics import emit_event
+from Download_data.utils_bandwidth import throttle
+from Download_data.utils_listing import DEFAULT_LISTING_TTL
+from Download_data.utils_cdf import read_cdf_structure, read_cdf_variable, decompress_cdf, CDF_MAGIC_COMPRESSED
+from Download_data.rbsp.download_ect import get_remote_dir_ECT, get_remote_filename_ECT
+from Download_data.rbsp.download_emfisis import get_remote_dir_EMFISIS, get_remote_filename_EMFISIS
+
+
+"""
+Reading of variables of remote CDF files through HTTP Range requests, without
+downloading the whole files.
+
+The file is read in blocks of RANGE_BLOCK_SIZE bytes, fetched on demand and
+kept in memory, so the header, the variable descriptors and the record index
+cost a few requests, and then only the records of the requested variables and
+time slice are transferred (see utils_cdf.read_cdf_variable):
+
+    spec = {'dataset': 'ect', 'remote_root_dir': ect_url, 'probe': 'a', 'instrument': 'rept'}
+    data = read_remote_CDFfile(spec, '2013-03-17', ['Epoch', 'FEDU'],
+                               start_time='2013-03-17 06:00:00', end_time='2013-03-17 09:00:00')
+
+The blocks of the last MAX_CACHED_FILES files are kept, so that repeated reads
+of the same file do not fetch its header again. Files compressed as a whole
+cannot be read by parts, and are fetched entirely.
+"""
+
+
+# Tamaño de los bloques que se piden al servidor y se guardan en memoria
+RANGE_BLOCK_SIZE = 64*1024
+
+# Cantidad de archivos remotos cuyos bloques se mantienen en memoria
+MAX_CACHED_FILES = 16
+
+_range_files = OrderedDict()
+_range_files_lock = threading.Lock()
+
+
+class RangeFile:
+
+    '''
+    Remote file read through HTTP Range requests, with an in-memory cache of the
+    blocks already fetched. Consecutive missing blocks are fetched with a single
+    request. If the server ignores the Range header, the whole file received is
+    cached.
+    '''
+
+    def __init__(self, url, block_size=RANGE_BLOCK_SIZE):
+        self.url = url
+        self.block_size = block_size
+        self.size = None
+        self.n_requests = 0
+        self.bytes_received = 0
+        self.cdf = None
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def _fetch(self, first_block, last_block):
+
+        start = first_block*self.block_size
+        end = (last_block + 1)*self.block_size - 1
+        if self.size is not None:
+            end = min(end, self.size - 1)
+
+        request_start = time.monotonic()
+        response = get_session().get(self.url, headers={'Range': 'bytes=%d-%d' % (start, end)}, timeout=get_timeout())
+        response.raise_for_status()
+        content = response.content
+        throttle(len(content))
+        emit_event('transfer', self.url, seconds=time.monotonic() - request_start, bytes=len(content))
+        self.n_requests += 1
+        self.bytes_received += len(content)
+
+        if response.status_code == 206:
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit():
+                self.size = int(total)
+        else:
+            # El servidor no soporta Range y mandó el archivo entero
+            self.size = len(content)
+            start = 0
+
+        for position in range(0, len(content), self.block_size):
+            self._blocks[(start + position)//self.block_size] = content[position:position + self.block_size]
+
+        return
+
+    def read(self, offset, size):
+
+        '''
+        Read bytes of the remote file, fetching the blocks that are not cached yet.
+
+        Args:
+            - offset (int): The position of the first byte.
+            - size (int): The number of bytes.
+
+        Returns:
+            - data (bytes): The bytes, fewer than size if the file ends before.
+        '''
+
+        if size <= 0:
+            return b''
+
+        first = offset//self.block_size
+        last = (offset + size - 1)//self.block_size
+        with self._lock:
+            if self.size is not None:
+                last = min(last, (self.size - 1)//self.block_size)
+
+            # Pedimos cada tramo de bloques faltantes consecutivos en una sola petición
+            missing = [block for block in range(first, last + 1) if block not in self._blocks]
+            while missing:
+                run_end = 0
+                while run_end + 1 < len(missing) and missing[run_end + 1] == missing[run_end] + 1:
+                    run_end += 1
+                call_with_retry(self._fetch, missing[0], missing[run_end], url=self.url)
+                missing = [block for block in missing[run_end + 1:] if block not in self._blocks]
+
+            data = b''.join(self._blocks.get(block, b'') for block in range(first, last + 1))
+
+        start = offset - first*self.block_size
+
+        return data[start:start + size]
+
+
+def get_range_file(url):
+
+    '''
+    Return the RangeFile of a URL, reusing the cached blocks of the last
+    MAX_CACHED_FILES files opened.
+
+    Args:
+        - url (str): The URL of the remote file.
+
+    Returns:
+        - remote_file (RangeFile): The remote file.
+    '''
+
+    with _range_files_lock:
+        if url in _range_files:
+            _range_files.move_to_end(url)
+        else:
+            _range_files[url] = RangeFile(url)
+            while len(_range_files) > MAX_CACHED_FILES:
+                _range_files.popitem(last=False)
+
+        return _range_files[url]
+
+
+def open_remote_CDF(url):
+
+    '''
+    Open a remote CDF file and read its structure (see utils_cdf.read_cdf_structure).
+
+    Args:
+        - url (str): The URL of the remote CDF file.
+
+    Returns:
+        - read (callable): Function read(offset, size) that returns bytes of the file.
+        - cdf (dict): The structure of the file.
+    '''
+
+    remote_file = get_range_file(url)
+    if remote_file.cdf is None:
+        read = remote_file.read
+        if read(0, 8)[4:8] == CDF_MAGIC_COMPRESSED:
+            # Comprimido entero: no se puede leer por partes, lo traemos completo
+            data = decompress_cdf(read(0, remote_file.size))
+            read = lambda offset, size: data[offset:offset + size]
+        remote_file.cdf = (read, read_cdf_structure(read))
+
+    return remote_file.cdf
+
+
+def _get_cdf_epoch(date, data_type):
+
+    # Convierte una fecha al tipo de tiempo de la variable (CDF_EPOCH o CDF_TIME_TT2000)
+    import cdflib
+
+    date = to_datetime(date)
+    components = [date.year, date.month, date.day, date.hour, date.minute, date.second, date.microsecond//1000]
+    if data_type == 31:
+        return cdflib.cdfepoch.compute_epoch(components)
+    if data_type == 33:
+        return cdflib.cdfepoch.compute_tt2000(components + [date.microsecond % 1000, 0])
+
+    raise ValueError('Time slices need a CDF_EPOCH or CDF_TIME_TT2000 time variable (type %d)' % data_type)
+
+
+def read_remote_CDF(url, variables, start_time=None, end_time=None, time_variable='Epoch'):
+
+    '''
+    Read some variables of a remote CDF file, transferring only the records needed.
+
+    Args:
+        - url (str): The URL of the remote CDF file.
+        - variables (list): The names of the variables to read.
+        - start_time (datetime.datetime or str, optional): The first time of the slice. Defaults to
+          None (from the first record).
+        - end_time (datetime.datetime or str, optional): The last time of the slice (included).
+          Defaults to None (to the last record).
+        - time_variable (str, optional): The time variable used to find the records of the slice.
+          Defaults to 'Epoch'.
+
+    Returns:
+        - data (dict): Dictionary variable -> numpy.ndarray, with the records of the slice (times as
+          raw CDF epochs) and the whole value of the variables that do not vary by record.
+
+    Raises:
+        - KeyError: If the file has no variable with one of the names.
+    '''
+
+    read, cdf = open_remote_CDF(url)
+
+    start_record, end_record = 0, None
+    if start_time is not None or end_time is not None:
+        import numpy as np
+
+        # Buscamos en la variable de tiempo los registros que caen en el tramo
+        times = read_cdf_variable(read, cdf, time_variable)
+        data_type = cdf['variables'][time_variable]['data_type']
+        if start_time is not None:
+            start_record = int(np.searchsorted(times, _get_cdf_epoch(start_time, data_type), side='left'))
+        if end_time is not None:
+            end_record = int(np.searchsorted(times, _get_cdf_epoch(end_time, data_type), side='right')) - 1
+
+    return dict((variable, read_cdf_variable(read, cdf, variable, start_record, end_record)) for variable in variables)
+
+
+def get_remote_url(spec, date, listing_cache_dir=None, listing_ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Resolve the URL of the remote file of a dataset spec for one date, the same way
+    the download functions do (remote directory and listing lookup).
+
+    Args:
+        - spec (dict): The dataset spec (see planner.plan_downloads), for ECT or EMFISIS and one probe.
+        - date (datetime.date or str): The date of the file.
+        - listing_cache_dir (str, optional): Directory where listings are persisted between runs. Defaults to None.
+        - listing_ttl (float, optional): Maximum age in seconds of a listing read from listing_cache_dir.
+          Defaults to one day.
+
+    Returns:
+        - url (str): The URL of the file.
+
+    Raises:
+        - ValueError: If the dataset is not ECT or EMFISIS.
+        - FileNotFoundError: If the remote directory has no file for the date.
+    '''
+
+    date = to_datetime(date)
+    dataset = spec.get('dataset')
+    level = spec.get('level', '3')
+    if dataset == 'ect':
+        remote_dir = get_remote_dir_ECT(date, spec['remote_root_dir'], spec['probe'], spec['instrument'], level)
+        filename = get_remote_filename_ECT(date, remote_dir, spec['probe'], spec['instrument'], level,
+                                           cache_dir=listing_cache_dir, ttl=listing_ttl)
+        url = remote_dir + '%s' % filename
+    elif dataset == 'emfisis':
+        remote_dir = get_remote_dir_EMFISIS(spec['probe'], date, spec['remote_root_dir'], level,
+                                            spec.get('interval', 4), spec.get('coordinates', 'geo'))
+        filename = get_remote_filename_EMFISIS(date, remote_dir, cache_dir=listing_cache_dir, ttl=listing_ttl)
+        url = remote_dir + '/%s' % filename
+    else:
+        raise ValueError('Remote reading is available for the ect and emfisis datasets, not %r' % dataset)
+
+    if filename == 0:
+        raise FileNotFoundError('No %s file in %s for %s' % (dataset, remote_dir, date.strftime('%Y-%m-%d')))
+
+    return url
+
+
+def read_remote_CDFfile(spec, date, variables, start_time=None, end_time=None, time_variable='Epoch',
+                        listing_cache_dir=None, listing_ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Read some variables of the remote daily file of a dataset spec, transferring only
+    the header and the records needed, instead of downloading the file.
+
+    Args:
+        - spec (dict): The dataset spec (see planner.plan_downloads), for ECT or EMFISIS and one probe.
+        - date (datetime.date or str): The date of the file.
+        - variables (list): The names of the variables to read (e.g. ['Epoch', 'FEDU']).
+        - start_time (datetime.datetime or str, optional): The first time of the slice. Defaults to None.
+        - end_time (datetime.datetime or str, optional): The last time of the slice (included).
+          Defaults to None.
+        - time_variable (str, optional): The time variable used to find the records of the slice.
+          Defaults to 'Epoch'.
+        - listing_cache_dir (str, optional): Directory where listings are persisted between runs. Defaults to None.
+        - listing_ttl (float, optional): Maximum age in seconds of a listing read from listing_cache_dir.
+          Defaults to one day.
+
+    Returns:
+        - data (dict): Dictionary variable -> numpy.ndarray (see read_remote_CDF).
+    '''
+
+    url = get_remote_url(spec, date, listing_cache_dir=listing_cache_dir, listing_ttl=listing_ttl)
+
+    return read_remote_CDF(url, variables, start_time=start_time, end_time=end_time, time_variable=time_variable)
@@ -0,0 +1,193 @@
+import time
+import threading
+
+
+"""
+Global bandwidth budget of the downloads.
+
+All the transfers of the process (the download engine workers, the asyncio
+downloader and the remote CDF reader) draw the bytes they receive from one
+token bucket, so together they do not exceed set_bandwidth_limit bytes per
+second, however many workers are running. The limit can be changed, or
+removed, from any thread while downloads are running, e.g. to let a bulk
+backfill use the whole uplink at night and throttle it during the day:
+
+    set_bandwidth_limit(2e6)        # 2 MB/s shared by every download
+    ...
+    set_bandwidth_limit(None)       # no limit
+
+Without a limit (the default) throttling costs nothing.
+"""
+
+
+class TokenBucket:
+
+    '''
+    Token bucket shared by threads (and asyncio tasks) to cap their aggregate rate.
+
+    Tokens (bytes) accumulate at rate per second, up to one second of rate. A
+    consumer takes its tokens as soon as the bucket is not in debt, and may leave
+    it in debt; the next consumers wait until the debt is paid back. A rate of None
+    means no limit. Changing the rate wakes the waiting consumers, so the new rate
+    applies at once.
+    '''
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.tokens = 0.0
+        self._updated = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.tokens + (now - self._updated)*self.rate, self.rate)
+        self._updated = now
+
+    def set_rate(self, rate):
+
+        '''
+        Change the rate of the bucket.
+
+        Args:
+            - rate (float or None): The new rate in tokens per second, or None for no limit.
+
+        Returns:
+            - None
+        '''
+
+        with self._condition:
+            self._refill()
+            self.rate = rate
+            self.tokens = 0.0 if rate is None else min(self.tokens, rate)
+            self._condition.notify_all()
+
+        return
+
+    def _take(self, n):
+
+        # Toma n fichas si el balde no está en deuda; si no, devuelve cuánto falta esperar
+        self._refill()
+        if self.rate is None or self.tokens >= 0:
+            if self.rate is not None:
+                self.tokens -= n
+            return None
+
+        return -self.tokens/self.rate
+
+    def consume(self, n):
+
+        '''
+        Take n tokens, waiting while the bucket is in debt.
+
+        Args:
+            - n (int): The number of tokens (bytes).
+
+        Returns:
+            - None
+        '''
+
+        with self._condition:
+            while True:
+                delay = self._take(n)
+                if delay is None:
+                    return
+                self._condition.wait(delay)
+
+    async def consume_async(self, n):
+
+        '''
+        Take n tokens, waiting while the bucket is in debt, without blocking the event loop.
+
+        Args:
+            - n (int): The number of tokens (bytes).
+
+        Returns:
+            - None
+        '''
+
+        import asyncio
+
+        while True:
+            with self._condition:
+                delay = self._take(n)
+            if delay is None:
+                return
+            # Esperas cortas, para enterarnos pronto de un cambio de tasa
+            await asyncio.sleep(min(delay, 0.5))
+
+
+_bandwidth_bucket = TokenBucket()
+
+
+def set_bandwidth_limit(bytes_per_second):
+
+    '''
+    Set the maximum aggregate rate of all the downloads of the process. It can be
+    called while downloads are running.
+
+    Args:
+        - bytes_per_second (float or None): The maximum rate in bytes per second, or None for no limit.
+
+    Returns:
+        - None
+
+    Raises:
+        - ValueError: If the rate is not positive.
+    '''
+
+    if bytes_per_second is not None and bytes_per_second <= 0:
+        raise ValueError('The bandwidth limit must be positive (or None for no limit)')
+
+    _bandwidth_bucket.set_rate(bytes_per_second)
+
+    return
+
+
+def get_bandwidth_limit():
+
+    '''
+    Return the maximum aggregate rate of the downloads of the process.
+
+    Returns:
+        - bytes_per_second (float or None): The limit in bytes per second, or None if there is none.
+    '''
+
+    return _bandwidth_bucket.rate
+
+
+def throttle(n_bytes):
+
+    '''
+    Account for n_bytes received by a download, waiting if the process is over its
+    bandwidth limit.
+
+    Args:
+        - n_bytes (int): The number of bytes received.
+
+    Returns:
+        - None
+    '''
+
+    if _bandwidth_bucket.rate is not None:
+        _bandwidth_bucket.consume(n_bytes)
+
+    return
+
+
+async def throttle_async(n_bytes):
+
+    '''
+    Like throttle, for asyncio downloads.
+
+    Args:
+        - n_bytes (int): The number of bytes received.
+
+    Returns:
+        - None
+    '''
+
+    if _bandwidth_bucket.rate is not None:
+        await _bandwidth_bucket.consume_async(n_bytes)
+
+    return
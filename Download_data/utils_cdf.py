@@ -0,0 +1,370 @@
+import gzip
+import struct
+
+
+"""
+Minimal helpers to recognise CDF files and read their header, without
+depending on a CDF library.
+
+read_cdf_structure and read_cdf_variable parse CDF version 3 files (variable
+descriptors, the VXR index of their records, and plain or gzip-compressed
+record blocks) through a read(offset, size) function, so that only the bytes
+of the requested records are read. This is what allows reading variables of
+remote files with HTTP Range requests (see Download_data.remote_cdf).
+"""
+
+
+# Números mágicos de los archivos CDF: versión (primeros 4 bytes) y compresión (siguientes 4)
+CDF_MAGIC_V3 = b'\xcd\xf3\x00\x01'
+CDF_MAGIC_V26 = b'\xcd\xf2\x60\x02'
+CDF_MAGIC_V25 = b'\x00\x00\xff\xff'
+CDF_MAGIC_UNCOMPRESSED = b'\x00\x00\xff\xff'
+CDF_MAGIC_COMPRESSED = b'\xcc\xcc\x00\x01'
+
+# Tipos de datos CDF: código -> (tipo de numpy, bytes por elemento)
+CDF_DATA_TYPES = {1: ('i1', 1), 2: ('i2', 2), 4: ('i4', 4), 8: ('i8', 8), 11: ('u1', 1), 12: ('u2', 2),
+                  14: ('u4', 4), 21: ('f4', 4), 22: ('f8', 8), 31: ('f8', 8), 32: ('c16', 16), 33: ('i8', 8),
+                  41: ('i1', 1), 44: ('f4', 4), 45: ('f8', 8), 51: ('S', 1), 52: ('S', 1)}
+
+# Codificaciones de los datos según el orden de sus bytes (las de punto flotante VAX no se soportan)
+_LITTLE_ENDIAN_ENCODINGS = {4, 6, 13, 16, 17, 19}
+_BIG_ENDIAN_ENCODINGS = {1, 2, 5, 7, 9, 11, 12, 18}
+
+# Tipos de registros internos y de compresión que se leen
+_VXR_RECORD, _VVR_RECORD, _CVVR_RECORD = 6, 7, 13
+_GZIP_COMPRESSION = 5
+
+
+def is_cdf_header(header):
+
+    '''
+    Check whether the first bytes of a file are those of a CDF file.
+
+    Args:
+        - header (bytes): At least the first 8 bytes of the file.
+
+    Returns:
+        - is_cdf (bool): True if the bytes start with valid CDF magic numbers.
+    '''
+
+    return (len(header) >= 8
+            and header[:4] in (CDF_MAGIC_V3, CDF_MAGIC_V26, CDF_MAGIC_V25)
+            and header[4:8] in (CDF_MAGIC_UNCOMPRESSED, CDF_MAGIC_COMPRESSED))
+
+
+def read_cdf_eof(file):
+
+    '''
+    Read the end-of-file offset of a CDF file: the one recorded in the Global
+    Descriptor Record (GDR) for uncompressed files, and the end of the Compressed
+    CDF Record (CCR) and of its Compression Parameters Record (CPR) for files
+    compressed as a whole. A file shorter than this offset is truncated.
+
+    Args:
+        - file (file object): The CDF file, opened in binary mode.
+
+    Returns:
+        - eof (int or None): The end-of-file offset, or None if its header cannot be read.
+    '''
+
+    file.seek(0)
+    header = file.read(8)
+    if not is_cdf_header(header):
+        return None
+
+    # Las versiones 3 usan offsets de 8 bytes, las anteriores de 4 bytes
+    if header[:4] == CDF_MAGIC_V3:
+        offset_format, offset_size = '>q', 8
+    else:
+        offset_format, offset_size = '>i', 4
+
+    if header[4:8] == CDF_MAGIC_COMPRESSED:
+        # CCR: RecordSize, RecordType, CPRoffset; el archivo termina donde termina el último de los dos
+        ccr = file.read(2*offset_size + 4)
+        if len(ccr) < 2*offset_size + 4:
+            return None
+        ccr_size = struct.unpack(offset_format, ccr[:offset_size])[0]
+        cpr_offset = struct.unpack(offset_format, ccr[offset_size+4:])[0]
+        file.seek(cpr_offset)
+        cpr = file.read(offset_size)
+        cpr_size = struct.unpack(offset_format, cpr)[0] if len(cpr) == offset_size else 0
+        return max(8 + ccr_size, cpr_offset + max(cpr_size, offset_size))
+
+    # CDR: RecordSize, RecordType, GDRoffset
+    cdr = file.read(2*offset_size + 4)
+    if len(cdr) < 2*offset_size + 4:
+        return None
+    gdr_offset = struct.unpack(offset_format, cdr[offset_size+4:])[0]
+
+    # GDR: RecordSize, RecordType, rVDRhead, zVDRhead, ADRhead, eof
+    file.seek(gdr_offset)
+    gdr = file.read(5*offset_size + 4)
+    if len(gdr) < 5*offset_size + 4:
+        return None
+    eof = struct.unpack(offset_format, gdr[4*offset_size+4:])[0]
+
+    return eof
+
+
+def check_cdf_file(path):
+
+    '''
+    Check that a local file is a complete CDF file: it must start with the CDF magic
+    numbers and be at least as long as the end-of-file offset of its header (see
+    read_cdf_eof), whether or not it is compressed as a whole.
+
+    Args:
+        - path (str): The path of the file.
+
+    Returns:
+        - error (str or None): A description of the problem, or None if the file looks valid.
+    '''
+
+    with open(path, 'rb') as file:
+        header = file.read(8)
+        if not is_cdf_header(header):
+            return 'not a CDF file (bad magic number)'
+
+        eof = read_cdf_eof(file)
+        size = file.seek(0, 2)
+
+    # Con los números mágicos correctos, un encabezado que no se puede leer es un archivo cortado
+    if eof is None:
+        return 'truncated CDF file: incomplete header (%d bytes)' % size
+    if size < eof:
+        return 'truncated CDF file: %d of %d bytes' % (size, eof)
+
+    return None
+
+
+def decompress_cdf(data):
+
+    '''
+    Decompress a CDF version 3 file compressed as a whole (with gzip).
+
+    Args:
+        - data (bytes): The content of the file.
+
+    Returns:
+        - data (bytes): The content of the equivalent uncompressed file (data itself if it is not
+          compressed).
+
+    Raises:
+        - NotImplementedError: If the file is not version 3 or uses a compression other than gzip.
+    '''
+
+    if data[4:8] != CDF_MAGIC_COMPRESSED:
+        return data
+    if data[:4] != CDF_MAGIC_V3:
+        raise NotImplementedError('Only CDF version 3 files are supported')
+
+    # CCR: RecordSize, RecordType, CPRoffset, uSize, rfuA y los datos comprimidos
+    record_size, record_type, cpr_offset = struct.unpack('>qiq', data[8:28])
+    compression = struct.unpack('>i', data[cpr_offset+12:cpr_offset+16])[0]
+    if compression != _GZIP_COMPRESSION:
+        raise NotImplementedError('Only gzip compressed CDF files are supported (compression %d)' % compression)
+
+    return data[:4] + CDF_MAGIC_UNCOMPRESSED + gzip.decompress(data[40:8+record_size])
+
+
+def _read_internal_record(read, offset):
+
+    # Los primeros 8 bytes de cada registro interno son su tamaño
+    size = struct.unpack('>q', read(offset, 8))[0]
+
+    return read(offset, size)
+
+
+def _parse_vdr(read, vdr, z_variable, r_dim_sizes):
+
+    # VDR: RecordSize, RecordType, VDRnext, DataType, MaxRec, VXRhead, VXRtail, Flags, SRecords,
+    # rfuB, rfuC, rfuF, NumElems, Num, CPRorSPRoffset, BlockingFactor, Name, y las dimensiones
+    data_type, max_record, vxr_head = struct.unpack('>iiq', vdr[20:36])
+    flags = struct.unpack('>i', vdr[44:48])[0]
+    n_elements = struct.unpack('>i', vdr[64:68])[0]
+    cpr_offset = struct.unpack('>q', vdr[72:80])[0]
+    name = vdr[84:340].split(b'\x00', 1)[0].decode('ascii')
+
+    if z_variable:
+        n_dims = struct.unpack('>i', vdr[340:344])[0]
+        dim_sizes = struct.unpack('>%di' % n_dims, vdr[344:344+4*n_dims])
+        dims_start = 344 + 4*n_dims
+    else:
+        n_dims = len(r_dim_sizes)
+        dim_sizes = r_dim_sizes
+        dims_start = 340
+    dim_varys = struct.unpack('>%di' % n_dims, vdr[dims_start:dims_start+4*n_dims])
+    pad_start = dims_start + 4*n_dims
+
+    if data_type not in CDF_DATA_TYPES:
+        raise NotImplementedError('Unsupported CDF data type %d of variable %s' % (data_type, name))
+
+    compression = None
+    if flags & 4:
+        compression = struct.unpack('>i', _read_internal_record(read, cpr_offset)[12:16])[0]
+
+    return name, {'data_type': data_type, 'n_elements': n_elements, 'max_record': max_record,
+                  'record_vary': bool(flags & 1),
+                  'shape': tuple(size for size, vary in zip(dim_sizes, dim_varys) if vary),
+                  'pad': vdr[pad_start:pad_start + n_elements*CDF_DATA_TYPES[data_type][1]] if flags & 2 else None,
+                  'compression': compression, 'vxr_head': vxr_head}
+
+
+def read_cdf_structure(read):
+
+    '''
+    Read the structure of a CDF version 3 file: data encoding, majority and the
+    descriptors of its variables, without reading any data record.
+
+    Args:
+        - read (callable): Function read(offset, size) that returns size bytes of the file from offset.
+
+    Returns:
+        - cdf (dict): Dictionary with the keys 'byte_order' ('<' or '>'), 'row_major' (bool) and
+          'variables', a dictionary name -> descriptor (data type, number of elements, last record,
+          record variance, record shape, pad value, compression and VXR head).
+
+    Raises:
+        - ValueError: If the bytes are not a CDF file.
+        - NotImplementedError: If the file is not version 3, is compressed as a whole (see
+          decompress_cdf) or uses a VAX encoding.
+    '''
+
+    header = read(0, 8)
+    if not is_cdf_header(header):
+        raise ValueError('Not a CDF file (bad magic number)')
+    if header[:4] != CDF_MAGIC_V3:
+        raise NotImplementedError('Only CDF version 3 files are supported')
+    if header[4:8] == CDF_MAGIC_COMPRESSED:
+        raise NotImplementedError('The file is compressed as a whole: decompress it with decompress_cdf')
+
+    # CDR: RecordSize, RecordType, GDRoffset, Version, Release, Encoding, Flags
+    cdr = _read_internal_record(read, 8)
+    gdr_offset = struct.unpack('>q', cdr[12:20])[0]
+    encoding, flags = struct.unpack('>ii', cdr[28:36])
+    if encoding in _LITTLE_ENDIAN_ENCODINGS:
+        byte_order = '<'
+    elif encoding in _BIG_ENDIAN_ENCODINGS:
+        byte_order = '>'
+    else:
+        raise NotImplementedError('Unsupported CDF encoding %d' % encoding)
+
+    # GDR: RecordSize, RecordType, rVDRhead, zVDRhead, ..., rNumDims, ..., rDimSizes
+    gdr = _read_internal_record(read, gdr_offset)
+    r_vdr_head, z_vdr_head = struct.unpack('>qq', gdr[12:28])
+    r_n_dims = struct.unpack('>i', gdr[56:60])[0]
+    r_dim_sizes = struct.unpack('>%di' % r_n_dims, gdr[84:84+4*r_n_dims])
+
+    variables = {}
+    for offset, z_variable in ((z_vdr_head, True), (r_vdr_head, False)):
+        while offset:
+            vdr = _read_internal_record(read, offset)
+            name, variable = _parse_vdr(read, vdr, z_variable, r_dim_sizes)
+            variables[name] = variable
+            offset = struct.unpack('>q', vdr[12:20])[0]
+
+    return {'byte_order': byte_order, 'row_major': bool(flags & 1), 'variables': variables}
+
+
+def _find_record_blocks(read, offset, start_record, end_record):
+
+    # Recorre el índice de una variable y devuelve (primer registro, último registro, offset, tipo)
+    # de los bloques con registros del tramo; sólo se leen las ramas que lo cubren
+    blocks = []
+    while offset:
+        vxr = _read_internal_record(read, offset)
+        next_vxr, n_entries, n_used = struct.unpack('>qii', vxr[12:28])
+        firsts = struct.unpack('>%di' % n_used, vxr[28:28+4*n_used])
+        lasts = struct.unpack('>%di' % n_used, vxr[28+4*n_entries:28+4*n_entries+4*n_used])
+        offsets = struct.unpack('>%dq' % n_used, vxr[28+8*n_entries:28+8*n_entries+8*n_used])
+        for first, last, child in zip(firsts, lasts, offsets):
+            if last < start_record or first > end_record:
+                continue
+            record_type = struct.unpack('>i', read(child + 8, 4))[0]
+            if record_type == _VXR_RECORD:
+                blocks += _find_record_blocks(read, child, start_record, end_record)
+            else:
+                blocks.append((first, last, child, record_type))
+        offset = next_vxr
+
+    return blocks
+
+
+def read_cdf_variable(read, cdf, name, start_record=0, end_record=None):
+
+    '''
+    Read the records of a variable of a CDF version 3 file, reading only the bytes
+    of the records in the requested range (whole blocks for compressed variables).
+
+    Args:
+        - read (callable): Function read(offset, size) that returns size bytes of the file from offset.
+        - cdf (dict): The structure of the file (see read_cdf_structure).
+        - name (str): The name of the variable.
+        - start_record (int, optional): The first record to read. Defaults to 0.
+        - end_record (int, optional): The last record to read (included). Defaults to None (the
+          last record of the variable).
+
+    Returns:
+        - values (numpy.ndarray): The records, with shape (n_records,) + record shape; for a
+          variable that does not vary by record, its only record. Missing records hold the pad
+          value of the variable (zero if it has none).
+
+    Raises:
+        - KeyError: If the file has no variable with that name.
+        - NotImplementedError: If the variable is compressed with other than gzip.
+    '''
+
+    import numpy as np
+
+    variable = cdf['variables'][name]
+    if not variable['record_vary']:
+        start_record, end_record = 0, 0
+    elif end_record is None or end_record > variable['max_record']:
+        end_record = variable['max_record']
+    n_records = max(end_record - start_record + 1, 0)
+
+    code, size = CDF_DATA_TYPES[variable['data_type']]
+    if code == 'S':
+        dtype = np.dtype('S%d' % variable['n_elements'])
+    else:
+        dtype = np.dtype(cdf['byte_order'] + code)
+    n_values = 1
+    for dim in variable['shape']:
+        n_values *= dim
+    record_size = dtype.itemsize*n_values
+
+    # Los registros que no están en el archivo quedan con el valor de relleno de la variable
+    if variable['pad'] is not None:
+        raw = bytearray(variable['pad']*(n_records*n_values))
+    else:
+        raw = bytearray(n_records*record_size)
+
+    for first, last, offset, record_type in _find_record_blocks(read, variable['vxr_head'], start_record, end_record):
+        low, high = max(first, start_record), min(last, end_record)
+        if low > high:
+            continue
+        if record_type == _VVR_RECORD:
+            # VVR: RecordSize, RecordType y los registros, de los que leemos sólo los pedidos
+            data = read(offset + 12 + (low - first)*record_size, (high - low + 1)*record_size)
+        elif record_type == _CVVR_RECORD:
+            # CVVR: RecordSize, RecordType, rfuA, cSize y el bloque comprimido entero
+            if variable['compression'] != _GZIP_COMPRESSION:
+                raise NotImplementedError('Only gzip compressed variables are supported (%s)' % name)
+            compressed_size = struct.unpack('>q', read(offset + 16, 8))[0]
+            block = gzip.decompress(read(offset + 24, compressed_size))
+            data = block[(low - first)*record_size:(high - first + 1)*record_size]
+        else:
+            raise ValueError('Unexpected CDF record type %d in the index of %s' % (record_type, name))
+        raw[(low - start_record)*record_size:(high - start_record + 1)*record_size] = data
+
+    shape = variable['shape']
+    values = np.frombuffer(bytes(raw), dtype=dtype)
+    if cdf['row_major'] or len(shape) < 2:
+        values = values.reshape((n_records,) + shape)
+    else:
+        # En orden por columnas la primera dimensión de cada registro es la que varía más rápido
+        values = values.reshape((n_records,) + shape[::-1]).transpose([0] + list(range(len(shape), 0, -1)))
+    if code == 'S':
+        values = values.astype(str)
+
+    return values if variable['record_vary'] else values[0]
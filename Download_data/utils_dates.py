@@ -0,0 +1,97 @@
+import datetime
+
+
+"""
+Date ranges for the download functions, built with the standard library so
+that pandas is not needed to download data.
+"""
+
+
+def to_datetime(value):
+
+    '''
+    Convert a date given as datetime.datetime, datetime.date (or pandas Timestamp)
+    or ISO string ('YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS') to datetime.datetime.
+
+    Args:
+        - value (datetime.datetime, datetime.date or str): The date to convert.
+
+    Returns:
+        - date (datetime.datetime): The converted date.
+    '''
+
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+
+    raise TypeError('Unsupported date type: %s' % type(value).__name__)
+
+
+def _add_months(date, months):
+
+    # Suma meses a una fecha que cae en el primer día del mes
+    month = date.month - 1 + months
+    return date.replace(year=date.year + month // 12, month=month % 12 + 1)
+
+
+def date_range(start_date, end_date, freq='D'):
+
+    '''
+    Build the list of dates between start_date and end_date (both included), with
+    the same semantics as pandas.date_range for the frequencies used in the package.
+
+    Args:
+        - start_date (datetime.date or str): The start date of the range.
+        - end_date (datetime.date or str): The end date of the range.
+        - freq (str, optional): 'D' for every day, 'MS' for the start of every month, or
+          '<n>MS' for the start of every n months. For month frequencies the range begins
+          at the first month start on or after start_date. Defaults to 'D'.
+
+    Returns:
+        - dates (list): List of datetime.datetime objects.
+    '''
+
+    start = to_datetime(start_date)
+    end = to_datetime(end_date)
+
+    dates = []
+    if freq == 'D':
+        date = start
+        while date <= end:
+            dates.append(date)
+            date += datetime.timedelta(days=1)
+
+    elif freq.endswith('MS'):
+        step = int(freq[:-2]) if freq[:-2] else 1
+        date = datetime.datetime(start.year, start.month, 1)
+        if date < start:
+            date = _add_months(date, 1)
+        while date <= end:
+            dates.append(date)
+            date = _add_months(date, step)
+
+    else:
+        raise ValueError('Unsupported frequency: %s' % freq)
+
+    return dates
+
+
+def year_range(start_date, end_date):
+
+    '''
+    Build one date (January 1st) for every year between start_date and end_date, to
+    construct the yearly remote and local directories of a date range.
+
+    Args:
+        - start_date (datetime.date or str): The start date of the range.
+        - end_date (datetime.date or str): The end date of the range.
+
+    Returns:
+        - dates (list): List of datetime.datetime objects, one per year.
+    '''
+
+    return [datetime.datetime(year, 1, 1)
+            for year in range(to_datetime(start_date).year, to_datetime(end_date).year + 1)]
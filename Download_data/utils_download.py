@@ -1,4 +1,35 @@
+import os
 import sys
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
+from Download_data.utils_session import get_session, get_timeout
+from Download_data.utils_cdf import check_cdf_file
+from Download_data.utils_metrics import emit_event
+from Download_data.utils_bandwidth import throttle
+from Download_data.utils_retry import IncompleteDownloadError, call_with_retry
+from Download_data.utils_lock import get_lock_path, acquire_lock, release_lock
+
+
+# Tamaño de los bloques que se escriben a disco durante la descarga
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+
+# Sufijo de los archivos que todavía se están descargando
+PART_SUFFIX = '.part'
+
+# Sufijo del archivo que guarda de qué URL (y de qué versión) viene una descarga a medias
+PART_ORIGIN_SUFFIX = '.origin'
+
+# Checksums calculados durante las descargas, hasta que los recoge el inventario (se guardan los
+# de los últimos MAX_PENDING_CHECKSUMS archivos, por si nadie los recoge)
+MAX_PENDING_CHECKSUMS = 4096
+
+_pending_checksums = OrderedDict()
+_pending_checksums_lock = threading.Lock()
+
 
 def bar_progress(current, total,  width=80):
 
@@ -19,3 +50,502 @@ def bar_progress(current, total,  width=80):
     sys.stdout.flush()
 
     return
+
+
+def jobs_progress(n_done, total, n_downloaded, n_skipped, n_failed):
+
+    '''
+    Display the aggregate progress of a set of download jobs in the console.
+
+    Args:
+        - n_done (int): The number of jobs finished so far.
+        - total (int): The total number of jobs.
+        - n_downloaded (int): The number of files downloaded so far.
+        - n_skipped (int): The number of files that already existed locally.
+        - n_failed (int): The number of jobs that failed.
+
+    Returns:
+        - None
+    '''
+
+    progress_message = "Files: %d%% [%d / %d] (downloaded %d, existing %d, failed %d)" % (
+        n_done / total * 100, n_done, total, n_downloaded, n_skipped, n_failed)
+    sys.stdout.write("\r" + progress_message)
+    sys.stdout.flush()
+
+    return
+
+
+def file_checksum(path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+
+    '''
+    Compute the SHA-256 checksum of a local file, reading it in chunks.
+
+    Args:
+        - path (str): The path of the file.
+        - chunk_size (int, optional): Size in bytes of the chunks read from disk. Defaults to 1 MiB.
+
+    Returns:
+        - checksum (str): The hexadecimal SHA-256 digest of the file.
+    '''
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def pop_file_checksum(local_path):
+
+    '''
+    Return the SHA-256 checksum computed while downloading a file, so that it does not
+    have to be read again, and forget it.
+
+    Args:
+        - local_path (str): The local path of the file.
+
+    Returns:
+        - checksum (str or None): The hexadecimal digest, or None if the file was not downloaded
+          by this process (or its checksum was already taken).
+    '''
+
+    with _pending_checksums_lock:
+        return _pending_checksums.pop(local_path, None)
+
+
+def _store_file_checksum(local_path, checksum):
+
+    with _pending_checksums_lock:
+        _pending_checksums[local_path] = checksum
+        _pending_checksums.move_to_end(local_path)
+        while len(_pending_checksums) > MAX_PENDING_CHECKSUMS:
+            _pending_checksums.popitem(last=False)
+
+    return
+
+
+def get_expected_size(status_code, headers, offset=0):
+
+    '''
+    Return the total size in bytes of the file being downloaded, as announced by
+    the server.
+
+    For a partial response (206) the size is read from the Content-Range header,
+    otherwise from Content-Length.
+
+    Args:
+        - status_code (int): The HTTP status of the response.
+        - headers (dict): The headers of the response (case-insensitive mapping).
+        - offset (int, optional): The byte offset requested with a Range header. Defaults to 0.
+
+    Returns:
+        - size (int or None): The total size of the file, or None if the server did not announce it.
+    '''
+
+    if status_code == 206:
+        total = get_range_total(headers)
+        if total is not None:
+            return total
+        content_length = headers.get('Content-Length')
+        return offset + int(content_length) if content_length is not None else None
+
+    content_length = headers.get('Content-Length')
+    return int(content_length) if content_length is not None else None
+
+
+def get_range_total(headers):
+
+    '''
+    Return the total size in bytes of a file from the Content-Range header of a
+    response (206, or 416 with 'bytes */<size>').
+
+    Args:
+        - headers (dict): The headers of the response (case-insensitive mapping).
+
+    Returns:
+        - size (int or None): The total size of the file, or None if the header is missing or has no size.
+    '''
+
+    total = headers.get('Content-Range', '').rpartition('/')[2]
+
+    return int(total) if total.isdigit() else None
+
+
+def get_if_range(validators):
+
+    '''
+    Choose the value of the If-Range header that resumes a partial download only if
+    the remote file did not change since the download started.
+
+    Args:
+        - validators (dict): The validators of the response that started the download (see get_part_origin).
+
+    Returns:
+        - if_range (str or None): The strong ETag if there is one (weak ETags are not allowed in
+          If-Range), otherwise the Last-Modified date, or None if neither is known.
+    '''
+
+    etag = validators.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+
+    return validators.get('last_modified')
+
+
+def get_remote_size(url):
+
+    '''
+    Ask the server for the size of a remote file with a HEAD request, without
+    downloading it.
+
+    Args:
+        - url (str): The full URL of the file.
+
+    Returns:
+        - size (int or None): The size in bytes, or None if the server does not announce it.
+
+    Raises:
+        - requests.HTTPError: If the server answers with an error status.
+    '''
+
+    def head():
+        response = get_session().head(url, headers={'Accept-Encoding': 'identity'},
+                                      allow_redirects=True, timeout=get_timeout())
+        response.raise_for_status()
+        return response
+
+    response = call_with_retry(head, url=url)
+
+    return get_expected_size(response.status_code, response.headers)
+
+
+def get_part_origin(part_path):
+
+    '''
+    Read where a partial download ('.part' file) comes from.
+
+    Args:
+        - part_path (str): The path of the '.part' file.
+
+    Returns:
+        - validators (dict): The validators of the response that started the partial download
+          (see get_validators), or an empty dictionary if they are unknown.
+    '''
+
+    try:
+        with open(part_path + PART_ORIGIN_SUFFIX) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def set_part_origin(part_path, validators):
+
+    '''
+    Record where a partial download ('.part' file) comes from, so that it is only resumed
+    from the same URL.
+
+    Args:
+        - part_path (str): The path of the '.part' file.
+        - validators (dict): The validators of the response (see get_validators).
+
+    Returns:
+        - None
+    '''
+
+    with open(part_path + PART_ORIGIN_SUFFIX, 'w') as file:
+        json.dump(validators, file)
+
+    return
+
+
+def remove_part(part_path):
+
+    '''
+    Remove a partial download ('.part' file) and its origin, if they exist.
+
+    Args:
+        - part_path (str): The path of the '.part' file.
+
+    Returns:
+        - None
+    '''
+
+    for path in (part_path, part_path + PART_ORIGIN_SUFFIX):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    return
+
+
+def download_file(url, local_path, chunk_size=DOWNLOAD_CHUNK_SIZE, validate_cdf=True):
+
+    '''
+    Download a single file from a URL and save it to the given local path.
+
+    The file is streamed to disk in chunks, so the memory used does not depend on
+    the size of the file. The data is first written to '<local_path>.part' and the
+    file is only renamed to local_path once the number of bytes received matches
+    the size announced by the server. If a download is interrupted the '.part'
+    file is kept, and the next call resumes it with an HTTP Range request (or
+    starts over if the server does not support ranges). A partial file is only
+    resumed from the URL that started it (e.g. not from another mirror), and
+    with an If-Range header, so the server sends the whole file again if it
+    changed in the meantime.
+
+    Before the rename the file is validated: error statuses are raised, and if
+    validate_cdf is True the data must be a complete CDF file (see
+    utils_cdf.check_cdf_file), so an HTML error page is never saved as a '.cdf'.
+
+    The request goes through the shared, pooled HTTP session (see
+    Download_data.utils_session), and emits the 'first_byte', 'transfer' and
+    'write' instrumentation events (see Download_data.utils_metrics). The local
+    directory is created if it does not exist. If the file already exists locally
+    it is not downloaded again.
+
+    Several processes (or nodes on a shared filesystem) can download into the
+    same directory: the file is claimed with '<local_path>.lock' before the
+    transfer (see Download_data.utils_lock), so it is fetched only once and the
+    other callers wait for it and then find it on disk.
+
+    Args:
+        - url (str): The full URL of the file to download.
+        - local_path (str): The local path where the file will be saved.
+        - chunk_size (int, optional): Size in bytes of the chunks written to disk. Defaults to 1 MiB.
+        - validate_cdf (bool, optional): Whether to check that the file is a valid CDF file. Defaults to True.
+
+    Returns:
+        - downloaded (bool): True if the file was downloaded, False if it already existed (or
+          another process downloaded it while we waited).
+
+    Raises:
+        - requests.HTTPError: If the server answers with an error status.
+        - utils_retry.IncompleteDownloadError: If the download ends before the whole file has been
+          received (the '.part' file is kept, so a retry resumes it).
+        - IOError: If the file is not a valid CDF file.
+    '''
+
+    if os.path.exists(local_path):
+        return False
+
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+    # Reclamamos el archivo; si otro proceso lo terminó mientras esperábamos, no hay nada que hacer
+    lock_path = get_lock_path(local_path)
+    if not acquire_lock(lock_path, done_path=local_path):
+        return False
+    try:
+        # Otro proceso pudo terminarlo justo antes de que tomáramos el bloqueo
+        if os.path.exists(local_path):
+            return False
+        return _transfer_file(url, local_path, chunk_size, validate_cdf)[0]
+    finally:
+        release_lock(lock_path)
+
+
+def get_validators(headers, size=None, url=None):
+
+    '''
+    Extract the HTTP validators of a remote file from the headers of a response.
+
+    Args:
+        - headers (dict): The headers of the response (case-insensitive mapping).
+        - size (int, optional): The size of the remote file, if known. Defaults to None.
+        - url (str, optional): The URL of the response. Validators are only valid for the server
+          that issued them (mirrors have their own). Defaults to None.
+
+    Returns:
+        - validators (dict): Dictionary with the keys 'etag', 'last_modified', 'remote_size' and
+          'url' (None for the ones the server did not send).
+    '''
+
+    return {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'), 'remote_size': size,
+            'url': url}
+
+
+def revalidate_file(url, local_path, validators=None, chunk_size=DOWNLOAD_CHUNK_SIZE, validate_cdf=True):
+
+    '''
+    Download a file again only if the remote copy changed since the local copy was
+    downloaded.
+
+    A conditional GET is sent, with If-None-Match set to the stored ETag and
+    If-Modified-Since set to the stored Last-Modified date (or, when no validators are
+    stored, to the modification time of the local file). If the file did not change the
+    server answers 304 Not Modified, without a body. Otherwise the new file is downloaded
+    and validated as in download_file, and replaces the local copy only once complete.
+    If the local file does not exist it is simply downloaded.
+
+    Args:
+        - url (str): The full URL of the file.
+        - local_path (str): The local path of the file.
+        - validators (dict, optional): The validators stored when the local copy was downloaded
+          (see get_validators). They are ignored if they came from another URL. Defaults to None.
+        - chunk_size (int, optional): Size in bytes of the chunks written to disk. Defaults to 1 MiB.
+        - validate_cdf (bool, optional): Whether to check that the file is a valid CDF file. Defaults to True.
+
+    Returns:
+        - changed (bool): True if the file was downloaded, False if the local copy is current.
+        - validators (dict): The validators of the remote file, to be stored for the next revalidation.
+
+    Raises:
+        - requests.HTTPError: If the server answers with an error status.
+        - utils_retry.IncompleteDownloadError: If the download ends before the whole file has been received.
+        - IOError: If the file is not a valid CDF file.
+    '''
+
+    validators = dict(validators or {})
+    # Los validadores de otro servidor (p. ej. otro espejo) no sirven para este
+    if validators.get('url') not in (None, url):
+        validators = {}
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+    lock_path = get_lock_path(local_path)
+    if not acquire_lock(lock_path):
+        # Sin done_path la espera sólo termina con el bloqueo tomado; no tocamos el archivo sin él
+        return False, validators
+    try:
+        conditional = {}
+        if os.path.exists(local_path):
+            if validators.get('etag'):
+                conditional['If-None-Match'] = validators['etag']
+            conditional['If-Modified-Since'] = (validators.get('last_modified')
+                                                or formatdate(os.path.getmtime(local_path), usegmt=True))
+            # Una descarga a medias podría ser de otra versión del archivo: no la continuamos
+            remove_part(local_path + PART_SUFFIX)
+        changed, new_validators = _transfer_file(url, local_path, chunk_size, validate_cdf, conditional)
+    finally:
+        release_lock(lock_path)
+
+    # Un 304 puede no repetir todos los validadores: conservamos los que ya teníamos
+    if changed:
+        validators = new_validators
+    else:
+        validators.update((key, value) for key, value in new_validators.items() if value is not None)
+
+    return changed, validators
+
+
+def _transfer_file(url, local_path, chunk_size, validate_cdf, conditional=None):
+
+    # Descarga propiamente tal, con el archivo ya reclamado (ver download_file). Devuelve si se
+    # descargó el archivo (False si el servidor respondió 304 a una petición condicional) y sus
+    # validadores HTTP
+    part_path = local_path + PART_SUFFIX
+
+    # Una descarga a medias de otra URL (p. ej. de otro espejo) puede no tener los mismos bytes
+    origin = get_part_origin(part_path)
+    if os.path.exists(part_path) and origin.get('url') != url:
+        remove_part(part_path)
+
+    # Si quedó una descarga a medias, pedimos sólo los bytes que faltan, siempre que el archivo
+    # no haya cambiado en el servidor (si cambió, If-Range hace que responda 200 con el archivo nuevo)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Accept-Encoding': 'identity'}
+    headers.update(conditional or {})
+    if offset > 0:
+        headers['Range'] = 'bytes=%d-' % offset
+        if get_if_range(origin):
+            headers['If-Range'] = get_if_range(origin)
+
+    start = time.perf_counter()
+    with get_session().get(url, headers=headers, stream=True, timeout=get_timeout()) as response:
+        emit_event('first_byte', url, seconds=time.perf_counter() - start, status=response.status_code)
+        if response.status_code == 416 and offset > 0:
+            # No quedan bytes desde offset: si el archivo parcial ya tiene el tamaño del remoto sólo
+            # faltaba renombrarlo
+            if get_range_total(response.headers) == offset:
+                validators = dict(origin, remote_size=offset)
+                finish_part(url, part_path, local_path, offset, validate_cdf, file_checksum(part_path, chunk_size))
+                return True, validators
+            # Si no calza con el del servidor partimos de cero, ya sin Range (así se repite una sola vez)
+            remove_part(part_path)
+            return _transfer_file(url, local_path, chunk_size, validate_cdf, conditional)
+        if response.status_code == 304:
+            return False, get_validators(response.headers, url=url)
+        response.raise_for_status()
+
+        # Si el servidor no soporta Range responde 200 con el archivo completo
+        if response.status_code != 206:
+            offset = 0
+        expected_size = get_expected_size(response.status_code, response.headers, offset)
+        validators = get_validators(response.headers, expected_size, url)
+        if offset == 0:
+            set_part_origin(part_path, validators)
+
+        # El checksum se calcula mientras llegan los datos; al continuar una descarga, el
+        # comienzo ya guardado se lee una vez
+        digest = hashlib.sha256()
+        if offset > 0:
+            with open(part_path, 'rb') as file:
+                for block in iter(lambda: file.read(chunk_size), b''):
+                    digest.update(block)
+
+        # Medimos por separado el tiempo de recepción y el de escritura a disco
+        transfer_start = time.perf_counter()
+        write_seconds = 0.0
+        n_bytes = 0
+        with open(part_path, 'ab' if offset > 0 else 'wb') as file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                # Respetamos el límite de ancho de banda del proceso (ver utils_bandwidth)
+                throttle(len(chunk))
+                write_start = time.perf_counter()
+                file.write(chunk)
+                digest.update(chunk)
+                write_seconds += time.perf_counter() - write_start
+                n_bytes += len(chunk)
+        emit_event('transfer', url, seconds=time.perf_counter() - transfer_start - write_seconds, bytes=n_bytes)
+        emit_event('write', url, seconds=write_seconds, bytes=n_bytes)
+
+    finish_part(url, part_path, local_path, expected_size, validate_cdf, digest.hexdigest())
+
+    return True, validators
+
+
+def finish_part(url, part_path, local_path, expected_size=None, validate_cdf=True, checksum=None):
+
+    '''
+    Check a partial download ('.part' file) that received every byte the server sent,
+    and rename it to its final path.
+
+    Args:
+        - url (str): The URL of the file (for the error messages).
+        - part_path (str): The path of the '.part' file.
+        - local_path (str): The final path of the file.
+        - expected_size (int, optional): The size announced by the server. Defaults to None (not checked).
+        - validate_cdf (bool, optional): Whether to check that the file is a valid CDF file. Defaults to True.
+        - checksum (str, optional): The SHA-256 of the file, kept for the inventory (see
+          pop_file_checksum). Defaults to None.
+
+    Returns:
+        - None
+
+    Raises:
+        - utils_retry.IncompleteDownloadError: If the file is smaller than expected_size (the '.part'
+          file is kept, so a retry resumes it).
+        - IOError: If the file is not a valid CDF file.
+    '''
+
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        if size > expected_size:
+            remove_part(part_path)
+        raise IncompleteDownloadError('Incomplete download of %s: %d of %d bytes' % (url, size, expected_size))
+
+    if validate_cdf:
+        error = check_cdf_file(part_path)
+        if error is not None:
+            remove_part(part_path)
+            raise IOError('Invalid file %s: %s' % (url, error))
+
+    # Renombramos el archivo sólo cuando la descarga está completa
+    os.replace(part_path, local_path)
+    remove_part(part_path)
+    if checksum is not None:
+        _store_file_checksum(local_path, checksum)
+
+    return
@@ -0,0 +1,461 @@
+import os
+import re
+import html
+import json
+import time
+import hashlib
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from Download_data.utils_metrics import emit_event, bind_run
+from Download_data.utils_retry import call_with_retry
+
+
+"""
+Cache of remote directory listings.
+
+The ECT and EMFISIS archives keep one index page per year, so every day of a
+download run resolves its filename against the same listing. Listings are kept
+in memory (keyed by remote directory URL) and can optionally be persisted on
+disk, to be shared between runs. The time-to-live applies to both, so a
+long-running process also sees the files added to the archive.
+"""
+
+
+# Listados en memoria: url -> (hora en que se obtuvo, lista de nombres), y url -> (lista de
+# nombres, diccionario fecha -> nombre) con el índice construido a partir de esa lista
+_listing_cache = {}
+_date_index_cache = {}
+
+# Fecha YYYYMMDD y versión (_v5.0.0, _v01) dentro del nombre del archivo
+_DATE_PATTERN = re.compile(r'(?<!\d)(\d{8})(?!\d)')
+_VERSION_PATTERN = re.compile(r'_v(\d+(?:\.\d+)*)\.cdf$', re.IGNORECASE)
+_RELEASE_PATTERN = re.compile(r'_rel(\d+)_')
+
+# Archivos que cubren más de un día: meses que cubre cada uno según su nombre (OMNI horario,
+# y OMNI de alta resolución)
+_MONTHS_PATTERNS = ((re.compile(r'_mrg1hr_'), 6), (re.compile(r'^omni_hro2?_(?:1|5)min_'), 1))
+
+# Links de una página índice: <a ...>texto</a>, el atributo href y las etiquetas dentro del texto
+_ANCHOR_PATTERN = re.compile(r'<a(\s[^>]*)?>(.*?)</a\s*>', re.IGNORECASE | re.DOTALL)
+_HREF_PATTERN = re.compile(r'\shref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.IGNORECASE)
+_TAG_PATTERN = re.compile(r'<[^>]*>')
+
+DEFAULT_LISTING_TTL = 24*3600
+
+
+def get_file_date(filename):
+
+    '''
+    Extract the date of a data file from its name.
+
+    Args:
+        - filename (str): The name of the data file.
+
+    Returns:
+        - date (str or None): The first 8-digit date found in the name, as 'YYYYMMDD',
+          or None if there is none.
+    '''
+
+    match = _DATE_PATTERN.search(filename)
+
+    return match.group(1) if match else None
+
+
+def get_file_span(filename):
+
+    '''
+    Return the dates covered by a data file, from the date in its name (the date
+    the file starts) and the cadence of its product: one day for ECT and EMFISIS,
+    one month for the OMNI 1min and 5min files, and six months for the OMNI 1h files.
+
+    Args:
+        - filename (str): The name of the data file.
+
+    Returns:
+        - first_date (str or None): The first date covered, as 'YYYYMMDD', or None if the name has no date.
+        - last_date (str or None): The last date covered (included), as 'YYYYMMDD', or None.
+    '''
+
+    first_date = get_file_date(filename)
+    if first_date is None:
+        return None, None
+
+    months = next((months for pattern, months in _MONTHS_PATTERNS if pattern.search(filename)), 0)
+    if months == 0:
+        return first_date, first_date
+
+    start = datetime.datetime.strptime(first_date, '%Y%m%d')
+    month = start.month - 1 + months
+    end = datetime.datetime(start.year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+
+    return first_date, end.strftime('%Y%m%d')
+
+
+def get_file_version(filename):
+
+    '''
+    Extract the version of a CDF data file from its name (e.g. '5.0.0' for
+    'rbspa_rel03_ect-rept-sci-l3_20130101_v5.0.0.cdf').
+
+    Args:
+        - filename (str): The name of the data file.
+
+    Returns:
+        - version (str or None): The version string, or None if the name has no version.
+    '''
+
+    match = _VERSION_PATTERN.search(filename)
+
+    return match.group(1) if match else None
+
+
+def get_version_key(filename):
+
+    '''
+    Build a sortable key with the release and version of a data file, so that
+    newer files compare greater (e.g. '_rel04_..._v1.0.0.cdf' > '_rel03_..._v5.1.0.cdf'
+    and '_v5.1.0.cdf' > '_v5.0.9.cdf').
+
+    Args:
+        - filename (str): The name of the data file.
+
+    Returns:
+        - key (tuple): Tuple (release, version numbers), with 0 and () when missing.
+    '''
+
+    release = _RELEASE_PATTERN.search(filename)
+    version = get_file_version(filename)
+
+    key = (int(release.group(1)) if release else 0,
+           tuple(int(number) for number in version.split('.')) if version else ())
+
+    return key
+
+
+def get_product_key(filename):
+
+    '''
+    Return the name of a data file without its release and version, so that
+    different versions of the same product and date share the same key
+    (e.g. 'rbspa_rel_ect-rept-sci-l3_20130101' for 'rbspa_rel03_ect-rept-sci-l3_20130101_v5.0.0.cdf').
+
+    Args:
+        - filename (str): The name of the data file.
+
+    Returns:
+        - key (str): The product key of the file.
+    '''
+
+    key = _VERSION_PATTERN.sub('', filename)
+    key = _RELEASE_PATTERN.sub('_rel_', key)
+
+    return key
+
+
+def _get_cache_path(url, cache_dir):
+
+    '''
+    Construct the path of the on-disk cache file for a remote directory listing.
+
+    Args:
+        - url (str): The URL of the remote directory.
+        - cache_dir (str): The directory where cached listings are stored.
+
+    Returns:
+        - cache_path (str): The path of the JSON file holding the cached listing.
+    '''
+
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    cache_path = os.path.join(cache_dir, key + '.json')
+
+    return cache_path
+
+
+def _read_listing_from_disk(url, cache_dir, ttl):
+
+    '''
+    Read a cached remote directory listing from disk, if present and not expired.
+
+    Args:
+        - url (str): The URL of the remote directory.
+        - cache_dir (str): The directory where cached listings are stored.
+        - ttl (float): Maximum age of the cached listing, in seconds.
+
+    Returns:
+        - fetch_time (float or None): The time at which the listing was fetched from the server.
+        - files (list or None): The cached list of filenames, or None if there is no
+          valid cached listing.
+    '''
+
+    cache_path = _get_cache_path(url, cache_dir)
+    try:
+        with open(cache_path, 'r') as file:
+            content = json.load(file)
+    except (OSError, ValueError):
+        return None, None
+
+    if content.get('url') != url or time.time() - content.get('time', 0) > ttl:
+        return None, None
+
+    return content['time'], content['files']
+
+
+def _write_listing_to_disk(url, files, cache_dir):
+
+    '''
+    Persist a remote directory listing on disk. The file is written to a temporary
+    name and then renamed, so concurrent readers never see a half-written listing.
+
+    Args:
+        - url (str): The URL of the remote directory.
+        - files (list): The list of filenames found in the remote directory.
+        - cache_dir (str): The directory where cached listings are stored.
+
+    Returns:
+        - None
+    '''
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = _get_cache_path(url, cache_dir)
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+
+    with open(tmp_path, 'w') as file:
+        json.dump({'url': url, 'time': time.time(), 'files': files}, file)
+    os.replace(tmp_path, cache_path)
+
+    return
+
+
+def iter_links(content):
+
+    '''
+    Scan an HTML index page once and yield the href and text of each link.
+
+    This is a lightweight replacement for building a full BeautifulSoup tree:
+    the page is scanned with a single regular expression, and only the anchors
+    are decoded. Yearly index pages with thousands of entries are parsed in a
+    few milliseconds.
+
+    Args:
+        - content (bytes or str): The HTML content of the page.
+
+    Yields:
+        - link (tuple): Tuple (href, text), with href None if the anchor has none and the
+          text stripped of inner tags and HTML entities, as BeautifulSoup's get_text.
+    '''
+
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', errors='replace')
+
+    for match in _ANCHOR_PATTERN.finditer(content):
+        attributes, text = match.group(1), match.group(2)
+
+        href = None
+        if attributes:
+            href_match = _HREF_PATTERN.search(attributes)
+            if href_match:
+                href = html.unescape(next(group for group in href_match.groups() if group is not None))
+
+        if '<' in text:
+            text = _TAG_PATTERN.sub('', text)
+        if '&' in text:
+            text = html.unescape(text)
+
+        yield href, text
+
+
+def parse_links(content):
+
+    '''
+    Extract the text of all the links of an HTML index page, which are the names
+    of the files in the remote directory (see iter_links).
+
+    Args:
+        - content (bytes or str): The HTML content of the page.
+
+    Returns:
+        - remote_files (list): The text of every <a> tag of the page.
+    '''
+
+    return [text for href, text in iter_links(content)]
+
+
+def lookup_listing(url, cache_dir=None, ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Look up a remote directory listing in the in-memory cache and then, if cache_dir
+    is given, in the on-disk cache, without contacting the server.
+
+    Args:
+        - url (str): The URL of the remote directory.
+        - cache_dir (str, optional): Directory where listings are persisted between runs.
+          Defaults to None (memory only).
+        - ttl (float, optional): Maximum age in seconds of a cached listing, in memory or on disk.
+          Defaults to one day.
+
+    Returns:
+        - files (list or None): The cached list of filenames, or None if it is not cached (or expired).
+    '''
+
+    cached = _listing_cache.get(url)
+    if cached is not None and time.time() - cached[0] <= ttl:
+        return cached[1]
+
+    files = None
+    if cache_dir is not None:
+        fetch_time, files = _read_listing_from_disk(url, cache_dir, ttl)
+        if files is not None:
+            _listing_cache[url] = (fetch_time, files)
+
+    return files
+
+
+def store_listing(url, files, cache_dir=None):
+
+    '''
+    Store a remote directory listing fetched from the server in the in-memory cache
+    and, if cache_dir is given, on disk.
+
+    Args:
+        - url (str): The URL of the remote directory.
+        - files (list): The list of filenames found in the remote directory.
+        - cache_dir (str, optional): Directory where listings are persisted between runs.
+          Defaults to None (memory only).
+
+    Returns:
+        - None
+    '''
+
+    if cache_dir is not None:
+        _write_listing_to_disk(url, files, cache_dir)
+    _listing_cache[url] = (time.time(), files)
+
+    return
+
+
+def get_listing(url, read_function, cache_dir=None, ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Retrieve the list of filenames in a remote directory, fetching and parsing
+    the index page only once every ttl seconds.
+
+    The listing is looked up in the in-memory cache first, then (if cache_dir is
+    given) in the on-disk cache, and only fetched from the server when neither
+    has it. Transient errors of the fetch are retried with backoff (see
+    Download_data.utils_retry).
+
+    Args:
+        - url (str): The URL of the remote directory.
+        - read_function (callable): Function that takes the URL and returns the list of
+          filenames on the page (e.g. read_site_content_ECT).
+        - cache_dir (str, optional): Directory where listings are persisted between runs.
+          Defaults to None (memory only).
+        - ttl (float, optional): Maximum age in seconds of a cached listing, in memory or on disk.
+          Defaults to one day.
+
+    Returns:
+        - files (list): The list of filenames found in the remote directory.
+    '''
+
+    files = lookup_listing(url, cache_dir=cache_dir, ttl=ttl)
+
+    if files is None:
+        start = time.perf_counter()
+        files = call_with_retry(read_function, url, url=url)
+        emit_event('listing', url, seconds=time.perf_counter() - start, files=len(files))
+        store_listing(url, files, cache_dir=cache_dir)
+
+    return files
+
+
+def get_date_index(url, read_function, cache_dir=None, ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Build a dictionary that maps each date in a remote directory to its filename.
+
+    The directory listing is parsed only once, so all the dates of a download run
+    are resolved against the same listing. When several versions of a file share
+    a date the highest release/version is kept (see get_version_key).
+
+    Args:
+        - url (str): The URL of the remote directory.
+        - read_function (callable): Function that takes the URL and returns the list of
+          filenames on the page.
+        - cache_dir (str, optional): Directory where listings are persisted between runs.
+          Defaults to None.
+        - ttl (float, optional): Maximum age in seconds of a cached listing, in memory or on disk.
+          Defaults to one day.
+
+    Returns:
+        - date_index (dict): Dictionary with dates as 'YYYYMMDD' strings as keys and
+          filenames as values.
+    '''
+
+    # El índice guardado sólo sirve si se construyó con el listado vigente (no uno ya vencido)
+    files = get_listing(url, read_function, cache_dir=cache_dir, ttl=ttl)
+    cached = _date_index_cache.get(url)
+    if cached is not None and cached[0] is files:
+        return cached[1]
+
+    date_index = {}
+    for filename in files:
+        date = get_file_date(filename)
+        if date is None:
+            continue
+        if date not in date_index or get_version_key(filename) > get_version_key(date_index[date]):
+            date_index[date] = filename
+
+    _date_index_cache[url] = (files, date_index)
+
+    return date_index
+
+
+def fetch_listings(listings, n_workers=8, cache_dir=None, ttl=DEFAULT_LISTING_TTL):
+
+    '''
+    Fetch concurrently the remote directory listings that are not cached yet, and
+    store them in the listing cache, so that resolving the dates of a range
+    afterwards does not wait on the server one directory at a time.
+
+    Args:
+        - listings (list): List of (url, read_function) tuples, as passed to get_listing.
+        - n_workers (int, optional): Number of listings fetched at the same time. Defaults to 8.
+        - cache_dir (str, optional): Directory where listings are persisted between runs. Defaults to None.
+        - ttl (float, optional): Maximum age in seconds of a listing read from cache_dir. Defaults to one day.
+
+    Returns:
+        - None
+
+    Raises:
+        - Exception: The error of the first listing that could not be fetched.
+    '''
+
+    missing = dict((url, read_function) for url, read_function in listings
+                   if lookup_listing(url, cache_dir=cache_dir, ttl=ttl) is None)
+    if len(missing) == 0:
+        return
+
+    # Los hilos sólo esperan al servidor, así que basta con un ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(n_workers, len(missing))) as executor:
+        futures = [executor.submit(bind_run(get_listing), url, read_function, cache_dir, ttl)
+                   for url, read_function in missing.items()]
+        for future in futures:
+            future.result()
+
+    return
+
+
+def clear_listing_cache():
+
+    '''
+    Empty the in-memory listing cache, so that the next lookup fetches the
+    listings again (or reads them from disk).
+
+    Returns:
+        - None
+    '''
+
+    _listing_cache.clear()
+    _date_index_cache.clear()
+
+    return
@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import random
+import socket
+import threading
+
+
+"""
+Claim files that coordinate the downloads of several processes (and nodes on a
+shared filesystem) working on the same local_root_dir.
+
+Before downloading a file, a worker creates '<local_path>.lock' atomically
+(O_CREAT | O_EXCL), so exactly one worker fetches each file. While the lock is
+held, a background thread of its owner touches it every LOCK_HEARTBEAT_SECONDS
+(also while a connection or a slow transfer is stalled), and the other workers
+wait for the lock to go away and then reuse the file. A lock that has not been touched for
+LOCK_STALE_SECONDS belongs to a worker that died, and is broken so the file can
+be fetched again; if the owner ran on the same host, its death is detected from
+the pid recorded in the lock without waiting.
+"""
+
+
+# Sufijo de los archivos de bloqueo de cada archivo de destino
+LOCK_SUFFIX = '.lock'
+
+# Un bloqueo que no se toca en este tiempo es de un proceso que murió
+LOCK_STALE_SECONDS = 300
+
+# Cada cuánto el dueño del bloqueo lo toca mientras lo tiene
+LOCK_HEARTBEAT_SECONDS = 30
+
+# Intervalo entre intentos de tomar un bloqueo ocupado
+LOCK_POLL_SECONDS = 0.5
+
+# Bloqueos que tiene este proceso, que el hilo de latido toca periódicamente
+_held_locks = set()
+_held_locks_lock = threading.Lock()
+_heartbeat_thread = None
+
+
+def get_lock_path(local_path):
+
+    '''
+    Construct the path of the claim file of a target file.
+
+    Args:
+        - local_path (str): The local path of the target file.
+
+    Returns:
+        - lock_path (str): The path of the claim file.
+    '''
+
+    return local_path + LOCK_SUFFIX
+
+
+def is_lock_stale(lock_path, stale_seconds=LOCK_STALE_SECONDS):
+
+    '''
+    Check whether a claim file has not been touched for stale_seconds.
+
+    Args:
+        - lock_path (str): The path of the claim file.
+        - stale_seconds (float, optional): Maximum age in seconds of a live claim. Defaults to 300.
+
+    Returns:
+        - stale (bool): True if the claim is stale, False if it is live or no longer exists.
+    '''
+
+    try:
+        return time.time() - os.path.getmtime(lock_path) > stale_seconds
+    except FileNotFoundError:
+        return False
+
+
+def is_lock_owner_dead(lock_path):
+
+    '''
+    Check whether the process that created a claim file is known to be dead, i.e. it
+    ran on this host and no process with its pid exists any more.
+
+    Args:
+        - lock_path (str): The path of the claim file.
+
+    Returns:
+        - dead (bool): True if the owner is dead. False if it is alive, runs on another host,
+          or the claim file cannot be read (e.g. it is being written).
+    '''
+
+    try:
+        with open(lock_path) as file:
+            owner = json.load(file)
+    except (OSError, ValueError):
+        return False
+
+    if owner.get('host') != socket.gethostname() or not isinstance(owner.get('pid'), int):
+        return False
+
+    try:
+        os.kill(owner['pid'], 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # Existe pero es de otro usuario
+        return False
+
+    return False
+
+
+def _break_stale_lock(lock_path, stale_seconds):
+
+    # El dueño murió: apartamos su bloqueo con un rename, que sólo un proceso logra. Devuelve
+    # False si lo que apartamos resultó ser un bloqueo vivo (otro proceso se adelantó y lo
+    # rompió y creó uno nuevo), que no se rompe
+    broken_path = '%s.%s.%d.%d.stale' % (lock_path, socket.gethostname(), os.getpid(), threading.get_ident())
+    try:
+        os.rename(lock_path, broken_path)
+    except FileNotFoundError:
+        return True
+
+    # Volvemos a mirar el latido y el dueño del archivo que apartamos, no del que vimos antes
+    if is_lock_stale(broken_path, stale_seconds) or is_lock_owner_dead(broken_path):
+        os.remove(broken_path)
+        return True
+
+    # Era un bloqueo vivo: lo devolvemos a su lugar, salvo que ya haya otro bloqueo nuevo ahí
+    try:
+        os.link(broken_path, lock_path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(broken_path)
+
+    return False
+
+
+def try_acquire_lock(lock_path, stale_seconds=LOCK_STALE_SECONDS):
+
+    '''
+    Try once to claim a target file, breaking the claim first if it is stale or its
+    owner is dead.
+
+    Args:
+        - lock_path (str): The path of the claim file.
+        - stale_seconds (float, optional): Maximum age in seconds of a live claim. Defaults to 300.
+
+    Returns:
+        - acquired (bool): True if the claim was created by this process.
+    '''
+
+    if is_lock_stale(lock_path, stale_seconds) or is_lock_owner_dead(lock_path):
+        if not _break_stale_lock(lock_path, stale_seconds):
+            return False
+
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+
+    # Dejamos anotado quién tiene el bloqueo, para poder diagnosticar bloqueos huérfanos
+    with os.fdopen(fd, 'w') as file:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}, file)
+
+    _hold_lock(lock_path)
+
+    return True
+
+
+def acquire_lock(lock_path, done_path=None, stale_seconds=LOCK_STALE_SECONDS, timeout=None):
+
+    '''
+    Claim a target file, waiting while another process holds the claim.
+
+    Args:
+        - lock_path (str): The path of the claim file.
+        - done_path (str, optional): The path of the target file. If it appears while waiting,
+          the other process finished it and the wait ends without claiming. Defaults to None.
+        - stale_seconds (float, optional): Maximum age in seconds of a live claim. Defaults to 300.
+        - timeout (float, optional): Maximum time in seconds to wait. Defaults to None (no limit).
+
+    Returns:
+        - acquired (bool): True if the claim was created by this process, False if done_path
+          appeared while waiting.
+
+    Raises:
+        - TimeoutError: If the claim could not be taken within timeout seconds.
+    '''
+
+    start = time.monotonic()
+    while True:
+        if done_path is not None and os.path.exists(done_path):
+            return False
+        if try_acquire_lock(lock_path, stale_seconds):
+            return True
+        if timeout is not None and time.monotonic() - start > timeout:
+            raise TimeoutError('Could not acquire %s in %.0f s' % (lock_path, timeout))
+        time.sleep(LOCK_POLL_SECONDS*random.uniform(0.5, 1.5))
+
+
+def _hold_lock(lock_path):
+
+    # Anotamos el bloqueo para el hilo de latido, y lo iniciamos si no está corriendo (no
+    # existe antes del primer bloqueo, ni en un proceso hijo recién creado con fork)
+    global _heartbeat_thread
+    with _held_locks_lock:
+        _held_locks.add(lock_path)
+        if _heartbeat_thread is None or not _heartbeat_thread.is_alive():
+            _heartbeat_thread = threading.Thread(target=_heartbeat, name='lock-heartbeat', daemon=True)
+            _heartbeat_thread.start()
+
+
+def _heartbeat():
+
+    # Tocamos todos los bloqueos del proceso, sin importar en qué etapa está cada descarga
+    while True:
+        time.sleep(LOCK_HEARTBEAT_SECONDS)
+        with _held_locks_lock:
+            lock_paths = list(_held_locks)
+        for lock_path in lock_paths:
+            touch_lock(lock_path)
+
+
+def _forget_locks():
+
+    # Un proceso hijo no hereda los bloqueos del padre (el lock se crea de nuevo, por si otro
+    # hilo lo tenía tomado al momento del fork)
+    global _held_locks_lock
+    _held_locks_lock = threading.Lock()
+    _held_locks.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_locks)
+
+
+def touch_lock(lock_path):
+
+    '''
+    Refresh the modification time of a claim file, to show that its owner is alive.
+
+    Args:
+        - lock_path (str): The path of the claim file.
+
+    Returns:
+        - None
+    '''
+
+    try:
+        os.utime(lock_path)
+    except FileNotFoundError:
+        pass
+
+    return
+
+
+def release_lock(lock_path):
+
+    '''
+    Remove a claim file created by this process.
+
+    Args:
+        - lock_path (str): The path of the claim file.
+
+    Returns:
+        - None
+    '''
+
+    with _held_locks_lock:
+        _held_locks.discard(lock_path)
+    try:
+        os.remove(lock_path)
+    except FileNotFoundError:
+        pass
+
+    return
@@ -0,0 +1,341 @@
+import json
+import time
+import bisect
+import threading
+import contextlib
+import contextvars
+from urllib.parse import urlparse
+
+
+"""
+Timing and throughput instrumentation of the downloads.
+
+The listing, connection, request and transfer steps emit structured events
+(dictionaries) to the registered hooks:
+
+    - 'listing': fetch and parse of a remote directory listing ('seconds').
+    - 'connect': TCP and TLS setup of a new pooled connection ('seconds').
+    - 'first_byte': from sending a request until its response headers arrive
+      ('seconds'; it includes 'connect' when a new connection was opened).
+    - 'transfer': reception of the body of a file ('seconds', 'bytes').
+    - 'write': time spent writing the body of a file to disk ('seconds', 'bytes').
+    - 'job': a whole download job ('seconds', 'status': downloaded, existing or failed).
+    - 'retry': backoff before retrying a failed request ('seconds' of delay, 'attempt', 'error').
+
+Every event also has 'time' (epoch seconds), 'url' and 'host'. A RunReport
+collects the events of a run into per-phase latency histograms and bytes/s,
+and writes them as a JSON summary.
+
+Hooks registered with add_event_hook receive the events of the whole process.
+A RunReport only receives the events of its own run: it is registered in a
+context variable, so two runs at the same time (in different threads or
+asyncio tasks) do not mix their events. Code that hands work to other threads
+wraps it with bind_run, so those threads report to the same run.
+"""
+
+
+_event_hooks = []
+_hooks_lock = threading.Lock()
+
+# Hooks de la ejecución en curso (ver RunReport), propios de cada hilo o tarea de asyncio
+_run_hooks = contextvars.ContextVar('run_hooks', default=())
+
+# Límites superiores (en segundos) de los intervalos de los histogramas de latencia
+HISTOGRAM_BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+
+def add_event_hook(hook):
+
+    '''
+    Register a function to be called with every instrumentation event of the
+    process (see add_run_hook for the events of one run only).
+
+    Hooks are called from the thread that emits the event, so they must be
+    thread-safe and fast.
+
+    Args:
+        - hook (callable): Function called as hook(event), with event a dictionary.
+
+    Returns:
+        - None
+    '''
+
+    with _hooks_lock:
+        _event_hooks.append(hook)
+
+    return
+
+
+def remove_event_hook(hook):
+
+    '''
+    Unregister a function registered with add_event_hook.
+
+    Args:
+        - hook (callable): The function to unregister.
+
+    Returns:
+        - None
+    '''
+
+    with _hooks_lock:
+        if hook in _event_hooks:
+            _event_hooks.remove(hook)
+
+    return
+
+
+def add_run_hook(hook):
+
+    '''
+    Register a function to be called with the instrumentation events of the current
+    run only: the events emitted from this thread or asyncio task, from the tasks it
+    starts, and from the functions it hands to other threads with bind_run.
+
+    Args:
+        - hook (callable): Function called as hook(event), with event a dictionary.
+
+    Returns:
+        - token (contextvars.Token): The token to pass to remove_run_hook.
+    '''
+
+    return _run_hooks.set(_run_hooks.get() + (hook,))
+
+
+def remove_run_hook(token):
+
+    '''
+    Unregister a hook registered with add_run_hook, from the same thread or task.
+
+    Args:
+        - token (contextvars.Token): The token returned by add_run_hook.
+
+    Returns:
+        - None
+    '''
+
+    _run_hooks.reset(token)
+
+    return
+
+
+def bind_run(function):
+
+    '''
+    Wrap a function so that, wherever it is called (e.g. in the threads of an
+    executor), its events go to the hooks of the run that wrapped it.
+
+    Args:
+        - function (callable): The function to wrap.
+
+    Returns:
+        - function (callable): The wrapped function, with the same arguments.
+    '''
+
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # Un mismo contexto no puede estar activo en dos hilos a la vez: cada llamada usa una copia
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
+
+
+def has_event_hooks():
+
+    '''
+    Check whether any hook is registered, so that callers can skip measuring when
+    nobody listens.
+
+    Returns:
+        - listening (bool): True if at least one hook (of the process or of the current run)
+          is registered.
+    '''
+
+    return len(_event_hooks) > 0 or len(_run_hooks.get()) > 0
+
+
+def emit_event(phase, url=None, **fields):
+
+    '''
+    Send an instrumentation event to the hooks of the process and of the current run.
+
+    Args:
+        - phase (str): The phase of the event ('listing', 'connect', 'first_byte', 'transfer',
+          'write', 'job' or 'retry').
+        - url (str, optional): The URL the event refers to. Defaults to None.
+        - **fields: Other fields of the event (e.g. seconds, bytes, status).
+
+    Returns:
+        - None
+    '''
+
+    hooks = list(_event_hooks) + list(_run_hooks.get())
+    if not hooks:
+        return
+
+    event = {'phase': phase, 'time': time.time(), 'url': url,
+             'host': urlparse(url).netloc if url else fields.pop('host', None)}
+    event.update(fields)
+
+    for hook in hooks:
+        hook(event)
+
+    return
+
+
+class RunReport:
+
+    '''
+    Collector of the instrumentation events of a run, that summarizes them into
+    per-phase latency histograms, totals and bytes/s, overall and per host.
+
+    It is registered as a hook of the current run (see add_run_hook) between start()
+    and stop(), or while used as a context manager, so it only collects the events
+    of the code it encloses.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._hosts = {}
+        self._jobs = {}
+        self.start_time = None
+        self.end_time = None
+        self._token = None
+
+    def start(self):
+        self.start_time = time.time()
+        self._token = add_run_hook(self.add_event)
+        return self
+
+    def stop(self):
+        remove_run_hook(self._token)
+        self.end_time = time.time()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    @staticmethod
+    def _new_phase():
+        return {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0,
+                'histogram': [0]*(len(HISTOGRAM_BOUNDS) + 1)}
+
+    def add_event(self, event):
+
+        '''
+        Add an event to the report (this is the hook registered by start).
+
+        Args:
+            - event (dict): The instrumentation event.
+
+        Returns:
+            - None
+        '''
+
+        seconds = event.get('seconds', 0.0)
+        with self._lock:
+            for key, table in ((event['phase'], self._phases),
+                               ((event.get('host'), event['phase']), self._hosts)):
+                phase = table.setdefault(key, self._new_phase())
+                phase['count'] += 1
+                phase['seconds'] += seconds
+                phase['max_seconds'] = max(phase['max_seconds'], seconds)
+                phase['bytes'] += event.get('bytes', 0)
+                phase['histogram'][bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+
+            if event['phase'] == 'job':
+                status = event.get('status')
+                self._jobs[status] = self._jobs.get(status, 0) + 1
+
+        return
+
+    @staticmethod
+    def _summarize_phase(phase):
+        summary = {'count': phase['count'], 'total_seconds': phase['seconds'],
+                   'mean_seconds': phase['seconds']/phase['count'] if phase['count'] else 0.0,
+                   'max_seconds': phase['max_seconds'],
+                   'histogram': [{'le': bound, 'count': count} for bound, count
+                                 in zip(HISTOGRAM_BOUNDS + ['inf'], phase['histogram'])]}
+        if phase['bytes']:
+            summary['bytes'] = phase['bytes']
+            summary['bytes_per_second'] = phase['bytes']/phase['seconds'] if phase['seconds'] else None
+        return summary
+
+    def summary(self):
+
+        '''
+        Build the machine-readable summary of the run.
+
+        Returns:
+            - summary (dict): Dictionary with the start and end times, wall-clock duration, job
+              counts by status, bytes received, overall bytes/s, and the per-phase statistics
+              (count, total/mean/max seconds, latency histogram, bytes and bytes/s), overall
+              ('phases') and per host ('hosts').
+        '''
+
+        end_time = self.end_time if self.end_time is not None else time.time()
+        wall_seconds = end_time - self.start_time if self.start_time is not None else 0.0
+
+        with self._lock:
+            phases = dict((name, self._summarize_phase(phase)) for name, phase in self._phases.items())
+            hosts = {}
+            for (host, name), phase in self._hosts.items():
+                hosts.setdefault(host or '', {})[name] = self._summarize_phase(phase)
+            jobs = dict(self._jobs)
+
+        total_bytes = phases.get('transfer', {}).get('bytes', 0)
+
+        return {'start_time': self.start_time, 'end_time': end_time, 'wall_seconds': wall_seconds,
+                'jobs': jobs, 'bytes': total_bytes,
+                'bytes_per_second': total_bytes/wall_seconds if wall_seconds else None,
+                'phases': phases, 'hosts': hosts}
+
+    def write(self, path):
+
+        '''
+        Write the summary of the run to a JSON file.
+
+        Args:
+            - path (str): The path of the JSON file.
+
+        Returns:
+            - None
+        '''
+
+        with open(path, 'w') as file:
+            json.dump(self.summary(), file, indent=2)
+
+        return
+
+
+@contextlib.contextmanager
+def collect_run_report(report_path=None):
+
+    '''
+    Context manager that collects a RunReport for the enclosed code and writes it as
+    JSON to report_path when the code finishes. If report_path is None nothing is
+    collected.
+
+    Args:
+        - report_path (str, optional): The path of the JSON report. Defaults to None.
+
+    Yields:
+        - report (RunReport or None): The report being collected.
+    '''
+
+    if report_path is None:
+        yield None
+        return
+
+    report = RunReport()
+    try:
+        with report:
+            yield report
+    finally:
+        report.write(report_path)
@@ -0,0 +1,225 @@
+import sys
+import time
+import random
+import socket
+from Download_data.utils_metrics import emit_event
+
+
+"""
+Retry policy for the requests to the archive servers.
+
+Transient errors (timeouts, connection resets, truncated transfers, and the
+HTTP statuses 429 and 5xx) are retried with exponential backoff and full
+jitter, honouring the Retry-After header of the server when present. Other
+errors (e.g. 404 or an invalid CDF file) fail at once.
+"""
+
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 60.0
+
+# Estados HTTP que indican un problema pasajero del servidor
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Estados con los que el servidor nos pide bajar la tasa de peticiones
+THROTTLE_STATUS = {429, 503}
+
+
+class IncompleteDownloadError(IOError):
+
+    '''
+    The transfer of a file ended before the whole file was received.
+    '''
+
+
+def get_status_code(error):
+
+    '''
+    Return the HTTP status of the response attached to an exception, if any
+    (requests.HTTPError, or aiohttp.ClientResponseError for the asynchronous API).
+
+    Args:
+        - error (Exception): The exception.
+
+    Returns:
+        - status_code (int or None): The HTTP status, or None if the exception has no response.
+    '''
+
+    response = getattr(error, 'response', None)
+    if response is not None:
+        return getattr(response, 'status_code', None)
+
+    # aiohttp guarda el estado en la excepción misma
+    status = getattr(error, 'status', None)
+
+    return status if isinstance(status, int) else None
+
+
+def is_transient_error(error):
+
+    '''
+    Check whether a failed request is worth retrying.
+
+    Args:
+        - error (Exception): The exception raised by the request.
+
+    Returns:
+        - transient (bool): True for timeouts, connection errors, truncated transfers and the
+          HTTP statuses 429 and 5xx.
+    '''
+
+    status_code = get_status_code(error)
+    if status_code is not None:
+        return status_code in RETRY_STATUS
+
+    if isinstance(error, (IncompleteDownloadError, ConnectionError, TimeoutError, socket.timeout)):
+        return True
+
+    # Errores de aiohttp, sólo si la API asíncrona ya lo cargó
+    aiohttp = sys.modules.get('aiohttp')
+    if aiohttp is not None and isinstance(error, aiohttp.ClientError):
+        if isinstance(error, aiohttp.ClientSSLError):
+            return False
+        return isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+    # requests se importa aquí para que importar el paquete no lo cargue
+    import requests
+    if isinstance(error, requests.exceptions.SSLError):
+        return False
+    return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                              requests.exceptions.ChunkedEncodingError))
+
+
+def is_throttle_error(error):
+
+    '''
+    Check whether a failed request means that the server is throttling us.
+
+    Args:
+        - error (Exception): The exception raised by the request.
+
+    Returns:
+        - throttled (bool): True for the HTTP statuses 429 and 503.
+    '''
+
+    return get_status_code(error) in THROTTLE_STATUS
+
+
+def get_retry_after(error):
+
+    '''
+    Return the delay requested by the server in the Retry-After header of a failed request.
+
+    Args:
+        - error (Exception): The exception raised by the request.
+
+    Returns:
+        - delay (float or None): The delay in seconds, or None if the header is missing or is
+          not a number of seconds.
+    '''
+
+    response = getattr(error, 'response', None)
+    # aiohttp guarda los headers de la respuesta en la excepción misma
+    headers = getattr(response if response is not None else error, 'headers', None) or {}
+    value = headers.get('Retry-After')
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff_delay(attempt, base=DEFAULT_BACKOFF_BASE, maximum=DEFAULT_BACKOFF_MAX, error=None):
+
+    '''
+    Compute the delay before a retry: exponential backoff with full jitter, so that
+    workers that failed together do not retry together.
+
+    Args:
+        - attempt (int): The number of the failed attempt (0 for the first one).
+        - base (float, optional): The delay scale in seconds. Defaults to 1.
+        - maximum (float, optional): The maximum delay in seconds. Defaults to 60.
+        - error (Exception, optional): The exception of the failed attempt. If the server sent a
+          Retry-After header the delay is at least that long. Defaults to None.
+
+    Returns:
+        - delay (float): The delay in seconds.
+    '''
+
+    delay = random.uniform(0, min(maximum, base*2**attempt))
+    retry_after = get_retry_after(error) if error is not None else None
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, maximum))
+
+    return delay
+
+
+def call_with_retry(function, *args, max_retries=DEFAULT_MAX_RETRIES, base=DEFAULT_BACKOFF_BASE,
+                    maximum=DEFAULT_BACKOFF_MAX, url=None, **kwargs):
+
+    '''
+    Call a function, retrying it with backoff while it fails with transient errors.
+
+    Args:
+        - function (callable): The function to call as function(*args, **kwargs).
+        - max_retries (int, optional): Maximum number of retries after the first attempt. Defaults to 5.
+        - base (float, optional): The backoff delay scale in seconds. Defaults to 1.
+        - maximum (float, optional): The maximum backoff delay in seconds. Defaults to 60.
+        - url (str, optional): The URL of the request, for the 'retry' instrumentation events.
+          Defaults to None.
+
+    Returns:
+        - result: The value returned by the function.
+
+    Raises:
+        - Exception: The last error, if it is not transient or the retries are exhausted.
+    '''
+
+    attempt = 0
+    while True:
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            if attempt >= max_retries or not is_transient_error(e):
+                raise
+            delay = get_backoff_delay(attempt, base, maximum, e)
+            emit_event('retry', url, seconds=delay, attempt=attempt + 1, error=str(e))
+            time.sleep(delay)
+            attempt += 1
+
+
+async def call_with_retry_async(function, *args, max_retries=DEFAULT_MAX_RETRIES, base=DEFAULT_BACKOFF_BASE,
+                                maximum=DEFAULT_BACKOFF_MAX, url=None, **kwargs):
+
+    '''
+    Asynchronous counterpart of call_with_retry: await a coroutine function, retrying
+    it with the same backoff policy while it fails with transient errors, without
+    blocking the event loop while waiting.
+
+    Args:
+        - function (callable): The coroutine function to await as function(*args, **kwargs).
+        - max_retries (int, optional): Maximum number of retries after the first attempt. Defaults to 5.
+        - base (float, optional): The backoff delay scale in seconds. Defaults to 1.
+        - maximum (float, optional): The maximum backoff delay in seconds. Defaults to 60.
+        - url (str, optional): The URL of the request, for the 'retry' instrumentation events.
+          Defaults to None.
+
+    Returns:
+        - result: The value returned by the coroutine.
+
+    Raises:
+        - Exception: The last error, if it is not transient or the retries are exhausted.
+    '''
+
+    import asyncio
+
+    attempt = 0
+    while True:
+        try:
+            return await function(*args, **kwargs)
+        except Exception as e:
+            if attempt >= max_retries or not is_transient_error(e):
+                raise
+            delay = get_backoff_delay(attempt, base, maximum, e)
+            emit_event('retry', url, seconds=delay, attempt=attempt + 1, error=str(e))
+            await asyncio.sleep(delay)
+            attempt += 1
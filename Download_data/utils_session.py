@@ -0,0 +1,213 @@
+import time
+import threading
+from Download_data.utils_metrics import emit_event
+
+
+"""
+Pooled HTTP session shared by all the listings and downloads of the package.
+
+A single requests.Session is reused by every request, so connections to the
+SPDF/RBSP hosts are kept alive and reused instead of paying a new TCP+TLS
+handshake for each file. The pool size, TLS verification and timeout are
+configured here, in one place, with configure_session.
+"""
+
+
+_session = None
+_session_lock = threading.Lock()
+
+# Configuración de la sesión. Por defecto no se verifican los certificados,
+# igual que en las versiones anteriores del paquete.
+_session_config = {
+    'pool_connections': 10,
+    'pool_maxsize': 16,
+    'verify': False,
+    'timeout': 60,
+}
+
+
+def configure_session(pool_connections=None, pool_maxsize=None, verify=None, timeout=None):
+
+    '''
+    Change the configuration of the shared HTTP session.
+
+    Only the given options are changed. The current session is closed, and the
+    next call to get_session creates a new one with the new configuration.
+
+    Args:
+        - pool_connections (int, optional): Number of hosts for which connection pools are kept.
+        - pool_maxsize (int, optional): Maximum number of connections kept alive per host. It should
+          be at least the number of concurrent downloads against the same host.
+        - verify (bool or str, optional): Whether to verify TLS certificates, or the path of a
+          CA bundle to verify them with.
+        - timeout (float or tuple, optional): Timeout in seconds for the connection and for each
+          read, as accepted by requests.
+
+    Returns:
+        - None
+    '''
+
+    options = {'pool_connections': pool_connections, 'pool_maxsize': pool_maxsize,
+               'verify': verify, 'timeout': timeout}
+
+    with _session_lock:
+        for key, value in options.items():
+            if value is not None:
+                _session_config[key] = value
+        _close_session()
+
+    return
+
+
+def _get_netloc(host, port, default_port):
+
+    '''
+    Build the network location of a connection as it appears in URLs (host, and port
+    if it is not the default one), so that 'connect' events are grouped with the other
+    events of the host, whose host comes from urlparse(url).netloc.
+
+    Args:
+        - host (str): The host name or address.
+        - port (int or None): The port of the connection.
+        - default_port (int): The default port of the scheme.
+
+    Returns:
+        - netloc (str): The network location (e.g. 'localhost:8000').
+    '''
+
+    # Las direcciones IPv6 van entre corchetes en las URLs
+    if ':' in host and not host.startswith('['):
+        host = '[%s]' % host
+
+    return host if port in (None, default_port) else '%s:%s' % (host, port)
+
+
+def _make_adapter(pool_connections, pool_maxsize):
+
+    '''
+    Build the connection pool adapter of the shared session. Its connections emit a
+    'connect' instrumentation event (see utils_metrics) with the time taken by the
+    TCP and TLS setup every time a new connection is opened.
+
+    Args:
+        - pool_connections (int): Number of hosts for which connection pools are kept.
+        - pool_maxsize (int): Maximum number of connections kept alive per host.
+
+    Returns:
+        - adapter (requests.adapters.HTTPAdapter): The adapter.
+    '''
+
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class TimedConnectMixin:
+        def connect(self):
+            start = time.perf_counter()
+            super().connect()
+            emit_event('connect', host=_get_netloc(self.host, self.port, self.default_port),
+                       seconds=time.perf_counter() - start)
+
+    class TimedHTTPConnection(TimedConnectMixin, HTTPConnection):
+        pass
+
+    class TimedHTTPSConnection(TimedConnectMixin, HTTPSConnection):
+        pass
+
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    class TimedHTTPAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                       'https': TimedHTTPSConnectionPool}
+
+    return TimedHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+
+
+def get_session():
+
+    '''
+    Return the shared HTTP session, creating it on first use.
+
+    Returns:
+        - session (requests.Session): The shared session, with a keep-alive connection pool
+          mounted for http and https.
+    '''
+
+    global _session
+
+    # requests se importa aquí para que importar el paquete no lo cargue
+    import requests
+
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = _make_adapter(_session_config['pool_connections'], _session_config['pool_maxsize'])
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.verify = _session_config['verify']
+            _session = session
+
+        return _session
+
+
+def get_timeout():
+
+    '''
+    Return the timeout configured for the requests of the shared session.
+
+    Returns:
+        - timeout (float or tuple): The timeout, as accepted by requests.
+    '''
+
+    return _session_config['timeout']
+
+
+def get_verify():
+
+    '''
+    Return the TLS verification setting of the shared session.
+
+    Returns:
+        - verify (bool or str): Whether TLS certificates are verified, or the path of the CA bundle.
+    '''
+
+    return _session_config['verify']
+
+
+def _close_session():
+
+    '''
+    Close the shared session (the caller must hold _session_lock).
+
+    Returns:
+        - None
+    '''
+
+    global _session
+
+    if _session is not None:
+        _session.close()
+        _session = None
+
+    return
+
+
+def close_session():
+
+    '''
+    Close the shared HTTP session and all its pooled connections.
+
+    Returns:
+        - None
+    '''
+
+    with _session_lock:
+        _close_session()
+
+    return
@@ -0,0 +1,173 @@
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from Download_data.utils_cdf import check_cdf_file
+from Download_data.utils_download import file_checksum
+from Download_data.inventory import connect_inventory, get_relative_path, record_file, remove_file_record
+
+
+"""
+Integrity check of a local data tree.
+
+Every CDF file under local_root_dir is checked in parallel, across processes:
+it must be a complete CDF file (magic numbers and end-of-file offset), and if
+the file is in the inventory its size and checksum must match the recorded
+ones. Corrupt or truncated files are re-queued, i.e. deleted and removed from
+the inventory, so the next download run fetches them again.
+
+A file whose modification time differs from the recorded one was replaced
+after it was recorded (e.g. by a work-queue worker or a run without the
+inventory): its inventory row is stale and is updated, and the file is kept.
+A valid CDF file that differs from its row with the same modification time is
+reported, but not deleted.
+
+It can also be run from the command line:
+
+    python -m Download_data.verify <local_root_dir> [--processes N] [--no-checksum] [--dry-run]
+"""
+
+
+def check_local_file(local_path, size=None, checksum=None, mtime=None):
+
+    '''
+    Check the integrity of a single local CDF file.
+
+    The size and checksum are only compared if the modification time of the file is
+    the recorded one: otherwise the file was replaced after it was recorded, and it is
+    the inventory row that is out of date.
+
+    Args:
+        - local_path (str): The path of the file.
+        - size (int, optional): The expected size in bytes, if known. Defaults to None.
+        - checksum (str, optional): The expected SHA-256 checksum, if known. Defaults to None.
+        - mtime (float, optional): The modification time recorded with size and checksum. Defaults to None.
+
+    Returns:
+        - result (tuple): Tuple (local_path, error, state), where error is None if the file is valid
+          and state is None (valid), 'corrupt' (not a complete CDF file), 'mismatch' (a valid CDF file
+          that does not match the inventory) or 'stale' (a valid CDF file replaced after it was recorded).
+    '''
+
+    try:
+        error = check_cdf_file(local_path)
+        if error is not None:
+            return local_path, error, 'corrupt'
+        if mtime is not None and os.path.getmtime(local_path) != mtime:
+            return local_path, None, 'stale'
+        if size is not None and os.path.getsize(local_path) != size:
+            error = 'size %d does not match the inventory (%d)' % (os.path.getsize(local_path), size)
+        elif checksum is not None and file_checksum(local_path) != checksum:
+            error = 'checksum does not match the inventory'
+    except OSError as e:
+        return local_path, str(e), 'corrupt'
+
+    return local_path, error, 'mismatch' if error is not None else None
+
+
+def _check_local_file(args):
+
+    # Envoltorio para ProcessPoolExecutor.map, que entrega un solo argumento
+    return check_local_file(*args)
+
+
+def verify_CDFfiles(local_root_dir, n_processes=None, checksum=True, requeue=True):
+
+    '''
+    Verify the integrity of all the CDF files stored under local_root_dir.
+
+    The files are found with a single scan of the directory tree and checked in
+    parallel by a pool of n_processes processes (see check_local_file). The size
+    and checksum recorded in the inventory are used when available. Only files that
+    are not complete CDF files are deleted; the stale inventory rows of replaced
+    files are updated.
+
+    Args:
+        - local_root_dir (str): The root directory where the data files are stored locally.
+        - n_processes (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        - checksum (bool, optional): Whether to compare the checksums recorded in the inventory
+          (this reads every file completely). Defaults to True.
+        - requeue (bool, optional): Whether to delete the corrupt files and remove them from the
+          inventory, so that they are downloaded again by the next run, and to update the stale
+          rows. Defaults to True.
+
+    Returns:
+        - corrupt (dict): Dictionary with the local paths of the corrupt files, and of the valid
+          files that do not match the inventory, as keys and the description of the problem as values.
+    '''
+
+    connection = connect_inventory(local_root_dir)
+    try:
+        known = dict((row['path'], (row['size'], row['checksum'], row['mtime']))
+                     for row in connection.execute('SELECT path, size, checksum, mtime FROM files'))
+    finally:
+        connection.close()
+
+    tasks = []
+    for dirpath, dirnames, filenames in os.walk(local_root_dir):
+        for filename in filenames:
+            if filename.lower().endswith('.cdf'):
+                local_path = os.path.join(dirpath, filename)
+                size, file_sum, mtime = known.get(get_relative_path(local_root_dir, local_path), (None, None, None))
+                tasks.append((local_path, size, file_sum if checksum else None, mtime))
+
+    print(f'Verifying {len(tasks)} files in {local_root_dir}')
+
+    corrupt, broken, stale = {}, [], []
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        for local_path, error, state in executor.map(_check_local_file, tasks, chunksize=16):
+            if state == 'stale':
+                stale.append(local_path)
+            elif error is not None:
+                corrupt[local_path] = error
+                if state == 'corrupt':
+                    broken.append(local_path)
+                    print(f'Corrupt file {local_path}: {error}')
+                else:
+                    print(f'File {local_path} kept, but {error}')
+
+    if requeue:
+        # Sólo borramos lo que no es un CDF completo; un CDF válido distinto del inventario se conserva
+        for local_path in broken:
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            remove_file_record(local_root_dir, local_path)
+        # Archivos reemplazados sin pasar por el inventario: actualizamos su fila
+        for local_path in stale:
+            record_file(local_root_dir, local_path)
+
+    if stale:
+        print(f'{len(stale)} files replaced after they were recorded' + (': inventory updated' if requeue else ''))
+    print(f'{len(corrupt)} corrupt files' + (' (%d re-queued)' % len(broken) if requeue and corrupt else ''))
+
+    return corrupt
+
+
+def main(argv=None):
+
+    '''
+    Command line entry point of the verification (see the module docstring).
+
+    Args:
+        - argv (list, optional): Command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        - status (int): 0 if every file is valid, 1 otherwise.
+    '''
+
+    parser = argparse.ArgumentParser(prog='python -m Download_data.verify',
+                                     description='Verify the integrity of a local tree of CDF files.')
+    parser.add_argument('local_root_dir')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--no-checksum', action='store_true', help='do not compare checksums')
+    parser.add_argument('--dry-run', action='store_true', help='report corrupt files without deleting them')
+    args = parser.parse_args(argv)
+
+    corrupt = verify_CDFfiles(args.local_root_dir, n_processes=args.processes,
+                              checksum=not args.no_checksum, requeue=not args.dry_run)
+
+    return 1 if corrupt else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
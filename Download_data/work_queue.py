@@ -0,0 +1,411 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+from Download_data.download_engine import run_download_jobs, DEFAULT_N_WORKERS, DEFAULT_MAX_PER_HOST
+from Download_data.utils_retry import DEFAULT_MAX_RETRIES
+from Download_data.utils_metrics import RunReport
+from Download_data.inventory import get_inventory_callback, scan_inventory
+
+
+"""
+Distributed download mode, with a work queue kept as plain files on a shared
+filesystem (no broker needed).
+
+A planned job list (see Download_data.planner) is split into shards with
+create_queue. Any number of worker processes, on any node that mounts the queue
+directory, then run run_worker:
+
+    queue_dir/pending/shard_00042.json            waiting to be claimed
+    queue_dir/claimed/shard_00042.json.<worker>   being downloaded (leased)
+    queue_dir/done/shard_00042.json               finished
+    queue_dir/reports/<worker>.json               per-worker report
+
+A shard is claimed by renaming it from pending to claimed, which only one worker
+can do. The worker renews its lease by touching the claimed file. A claim whose
+lease has expired belongs to a worker that crashed, and it goes back to pending
+for another worker. A file that is in two shards is still fetched only once,
+thanks to the claim files of Download_data.utils_lock. merge_reports combines
+the per-worker reports into one.
+
+The workers do not write the inventory (Download_data.inventory) by default:
+SQLite locking is not reliable on network filesystems, so many nodes writing
+the same database can corrupt it. Instead, merge_reports updates the inventory
+once, from a single process, when given local_root_dir.
+
+Workers can also be started from the command line:
+
+    python -m Download_data.work_queue worker <queue_dir> [--workers N] [--lease 600] [--inventory <local_root_dir>]
+    python -m Download_data.work_queue status <queue_dir>
+    python -m Download_data.work_queue merge <queue_dir> [--output report.json] [--inventory <local_root_dir>]
+"""
+
+
+DEFAULT_SHARD_SIZE = 100
+DEFAULT_LEASE_SECONDS = 600
+
+_QUEUE_DIRS = ('pending', 'claimed', 'done', 'reports')
+
+
+def _write_json(path, data):
+
+    # Escritura atómica: los demás nodos nunca ven un archivo a medio escribir
+    tmp_path = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def get_worker_id():
+
+    '''
+    Build an identifier of the current worker process, unique across the nodes.
+
+    Returns:
+        - worker_id (str): '<hostname>-<pid>'.
+    '''
+
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def create_queue(queue_dir, jobs, shard_size=DEFAULT_SHARD_SIZE):
+
+    '''
+    Split a job list into shards and put them in the pending directory of a queue.
+
+    Args:
+        - queue_dir (str): The directory of the queue, on a filesystem shared by the workers.
+        - jobs (list): List of (url, local_path) tuples, e.g. plan['jobs'] from planner.plan_downloads.
+        - shard_size (int, optional): Number of jobs per shard. Defaults to 100.
+
+    Returns:
+        - n_shards (int): The number of shards created.
+    '''
+
+    for name in _QUEUE_DIRS:
+        os.makedirs(os.path.join(queue_dir, name), exist_ok=True)
+
+    n_shards = 0
+    for start in range(0, len(jobs), shard_size):
+        shard = [list(job[:2]) for job in jobs[start:start+shard_size]]
+        _write_json(os.path.join(queue_dir, 'pending', 'shard_%05d.json' % n_shards), shard)
+        n_shards += 1
+
+    return n_shards
+
+
+def requeue_expired(queue_dir, lease_seconds=DEFAULT_LEASE_SECONDS):
+
+    '''
+    Put back in pending the claimed shards whose lease has expired.
+
+    Args:
+        - queue_dir (str): The directory of the queue.
+        - lease_seconds (float, optional): Time in seconds after which a claim that has not
+          been renewed is considered abandoned. Defaults to 600.
+
+    Returns:
+        - n_requeued (int): The number of shards put back in pending.
+    '''
+
+    claimed_dir = os.path.join(queue_dir, 'claimed')
+    now = time.time()
+
+    n_requeued = 0
+    for name in os.listdir(claimed_dir):
+        claimed_path = os.path.join(claimed_dir, name)
+        try:
+            if now - os.path.getmtime(claimed_path) <= lease_seconds:
+                continue
+            # El nombre es shard_XXXXX.json.<worker>: devolvemos shard_XXXXX.json a pending
+            shard_name = name.split('.json.', 1)[0] + '.json'
+            os.rename(claimed_path, os.path.join(queue_dir, 'pending', shard_name))
+            n_requeued += 1
+        except FileNotFoundError:
+            # Otro nodo lo devolvió o lo terminó antes
+            continue
+
+    return n_requeued
+
+
+def claim_shard(queue_dir, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+
+    '''
+    Claim the next pending shard of a queue, after putting back the expired claims.
+
+    Args:
+        - queue_dir (str): The directory of the queue.
+        - worker_id (str): The identifier of the claiming worker.
+        - lease_seconds (float, optional): Lease of the claims, see requeue_expired. Defaults to 600.
+
+    Returns:
+        - claim (tuple or None): (claimed_path, jobs) with the path of the claimed file and the
+          list of (url, local_path) jobs of the shard, or None if no shard is pending.
+    '''
+
+    requeue_expired(queue_dir, lease_seconds)
+
+    pending_dir = os.path.join(queue_dir, 'pending')
+    for name in sorted(os.listdir(pending_dir)):
+        if not name.endswith('.json'):
+            continue
+        pending_path = os.path.join(pending_dir, name)
+        claimed_path = os.path.join(queue_dir, 'claimed', '%s.%s' % (name, worker_id))
+        try:
+            # El rename conserva el mtime del archivo: lo renovamos antes, para que el lease empiece
+            # vigente y requeue_expired de otro worker no lo devuelva a pending recién tomado
+            os.utime(pending_path)
+            os.rename(pending_path, claimed_path)
+        except FileNotFoundError:
+            # Otro worker lo tomó primero
+            continue
+
+        with open(claimed_path) as file:
+            jobs = [tuple(job) for job in json.load(file)]
+        return claimed_path, jobs
+
+    return None
+
+
+def complete_shard(queue_dir, claimed_path):
+
+    '''
+    Mark a claimed shard as done.
+
+    Args:
+        - queue_dir (str): The directory of the queue.
+        - claimed_path (str): The path returned by claim_shard.
+
+    Returns:
+        - completed (bool): True if the shard was still claimed by this worker, False if its
+          lease had expired and it was put back in pending meanwhile.
+    '''
+
+    shard_name = os.path.basename(claimed_path).split('.json.', 1)[0] + '.json'
+    try:
+        os.rename(claimed_path, os.path.join(queue_dir, 'done', shard_name))
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def get_queue_status(queue_dir):
+
+    '''
+    Count the shards of a queue in each state.
+
+    Args:
+        - queue_dir (str): The directory of the queue.
+
+    Returns:
+        - status (dict): Dictionary with the number of 'pending', 'claimed' and 'done' shards.
+    '''
+
+    return dict((name, len(os.listdir(os.path.join(queue_dir, name)))) for name in ('pending', 'claimed', 'done'))
+
+
+def run_worker(queue_dir, local_root_dir=None, worker_id=None, n_workers=DEFAULT_N_WORKERS,
+               max_per_host=DEFAULT_MAX_PER_HOST, lease_seconds=DEFAULT_LEASE_SECONDS,
+               use_inventory=False, max_retries=DEFAULT_MAX_RETRIES):
+
+    '''
+    Claim and download shards of a queue until none is pending or claimed, and
+    write the report of the worker to queue_dir/reports/<worker_id>.json.
+
+    While a shard is being downloaded a background thread renews its lease every
+    lease_seconds/3 seconds. When nothing is pending the worker keeps polling
+    while other workers hold claims, to take over the shards of a crashed worker.
+
+    Args:
+        - queue_dir (str): The directory of the queue.
+        - local_root_dir (str, optional): The root directory where the data files are saved, whose
+          inventory is written if use_inventory is True. The local paths of the jobs come from the
+          plan, so it is only needed then. Defaults to None.
+        - worker_id (str, optional): The identifier of the worker. Defaults to '<hostname>-<pid>'.
+        - n_workers (int, optional): Number of concurrent downloads of this worker. Defaults to 4.
+        - max_per_host (int, optional): Maximum number of concurrent downloads from the same host.
+          Defaults to 4.
+        - lease_seconds (float, optional): Lease of the claims, see requeue_expired. Defaults to 600.
+        - use_inventory (bool, optional): Whether to record the downloaded files in the inventory of
+          local_root_dir. Only safe when all the workers run on one host (or local_root_dir is not on
+          a network filesystem); otherwise update the inventory after the run with merge_reports.
+          Defaults to False.
+        - max_retries (int, optional): Maximum number of retries of a file after a transient error.
+          Defaults to 5.
+
+    Returns:
+        - report (dict): The report of the worker (see merge_reports for its keys).
+
+    Raises:
+        - ValueError: If use_inventory is True and local_root_dir is not given.
+    '''
+
+    if use_inventory and local_root_dir is None:
+        raise ValueError('use_inventory needs the local_root_dir of the inventory')
+    if worker_id is None:
+        worker_id = get_worker_id()
+    on_complete = get_inventory_callback(local_root_dir) if use_inventory else None
+
+    report = {'worker': worker_id, 'shards': [], 'downloaded': 0, 'existing': 0, 'failed': []}
+    run_report = RunReport()
+
+    with run_report:
+        while True:
+            claim = claim_shard(queue_dir, worker_id, lease_seconds)
+            if claim is None:
+                # Nos quedamos mientras otros tengan shards, por si alguno muere y su lease vence
+                if get_queue_status(queue_dir)['claimed'] == 0:
+                    break
+                time.sleep(min(lease_seconds/10, 30))
+                continue
+            claimed_path, jobs = claim
+
+            # Renovamos el lease en segundo plano mientras se descarga el shard
+            stop = threading.Event()
+            def renew():
+                while not stop.wait(lease_seconds/3):
+                    try:
+                        os.utime(claimed_path)
+                    except FileNotFoundError:
+                        return
+            renewer = threading.Thread(target=renew, daemon=True)
+            renewer.start()
+            try:
+                results = run_download_jobs(jobs, n_workers=n_workers, max_per_host=max_per_host,
+                                            on_complete=on_complete, max_retries=max_retries)
+            finally:
+                stop.set()
+                renewer.join()
+                # Los archivos del shard quedan en el inventario antes de darlo por terminado
+                if on_complete is not None:
+                    on_complete.close()
+
+            completed = complete_shard(queue_dir, claimed_path)
+            report['shards'].append({'shard': os.path.basename(claimed_path).split('.json.', 1)[0],
+                                     'completed': completed})
+            report['downloaded'] += len(results['downloaded'])
+            report['existing'] += len(results['existing'])
+            report['failed'] += [{'url': url, 'local_path': local_path, 'error': error}
+                                 for url, local_path, error in results['failed']]
+
+    report['metrics'] = run_report.summary()
+    _write_json(os.path.join(queue_dir, 'reports', worker_id + '.json'), report)
+
+    return report
+
+
+def merge_reports(queue_dir, output_path=None, local_root_dir=None):
+
+    '''
+    Merge the reports of all the workers of a queue.
+
+    Args:
+        - queue_dir (str): The directory of the queue.
+        - output_path (str, optional): Path of a JSON file where the merged report is written.
+          Defaults to None.
+        - local_root_dir (str, optional): The root directory where the workers saved the files. If
+          given, its inventory is brought in sync with a scan (see inventory.scan_inventory), from this
+          process only. Defaults to None.
+
+    Returns:
+        - merged (dict): Dictionary with the queue status ('queue'), the totals of 'downloaded',
+          'existing' and 'bytes', the 'failed' jobs (url, local_path, error) of all the workers
+          that were not downloaded later by another worker, the wall-clock span of the run
+          ('start_time', 'end_time', 'wall_seconds', 'bytes_per_second'), and the report of
+          every worker ('workers').
+    '''
+
+    reports_dir = os.path.join(queue_dir, 'reports')
+    reports = []
+    for name in sorted(os.listdir(reports_dir)):
+        if name.endswith('.json'):
+            with open(os.path.join(reports_dir, name)) as file:
+                reports.append(json.load(file))
+
+    # Un archivo que falló en un worker pudo bajarse después en otro (shard reencolado)
+    failed = [entry for report in reports for entry in report['failed']
+              if not os.path.exists(entry['local_path'])]
+
+    start_times = [report['metrics']['start_time'] for report in reports if report['metrics']['start_time']]
+    end_times = [report['metrics']['end_time'] for report in reports if report['metrics']['end_time']]
+    start_time = min(start_times) if start_times else None
+    end_time = max(end_times) if end_times else None
+    wall_seconds = end_time - start_time if start_times and end_times else 0.0
+    total_bytes = sum(report['metrics']['bytes'] for report in reports)
+
+    merged = {'queue': get_queue_status(queue_dir),
+              'downloaded': sum(report['downloaded'] for report in reports),
+              'existing': sum(report['existing'] for report in reports),
+              'bytes': total_bytes, 'failed': failed,
+              'start_time': start_time, 'end_time': end_time, 'wall_seconds': wall_seconds,
+              'bytes_per_second': total_bytes/wall_seconds if wall_seconds else None,
+              'workers': reports}
+
+    if output_path is not None:
+        _write_json(output_path, merged)
+
+    # Un solo proceso escribe el inventario, con lo que quedó en disco tras todos los workers
+    if local_root_dir is not None:
+        scan_inventory(local_root_dir)
+
+    return merged
+
+
+def main(argv=None):
+
+    '''
+    Command line entry point of the work queue (see the module docstring).
+
+    Args:
+        - argv (list, optional): Command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        - status (int): 0 on success, 1 if some jobs failed.
+    '''
+
+    parser = argparse.ArgumentParser(prog='python -m Download_data.work_queue',
+                                     description='Distributed downloads through a file-based work queue.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    worker = subparsers.add_parser('worker', help='claim and download shards until the queue is empty')
+    worker.add_argument('queue_dir')
+    worker.add_argument('--workers', type=int, default=DEFAULT_N_WORKERS)
+    worker.add_argument('--max-per-host', type=int, default=DEFAULT_MAX_PER_HOST)
+    worker.add_argument('--lease', type=float, default=DEFAULT_LEASE_SECONDS, help='lease of a claim in seconds')
+    worker.add_argument('--inventory', metavar='LOCAL_ROOT_DIR',
+                        help='record the files in the inventory of this data directory (only if the workers '
+                             'share no network filesystem)')
+
+    status = subparsers.add_parser('status', help='count the shards in each state')
+    status.add_argument('queue_dir')
+
+    merge = subparsers.add_parser('merge', help='merge the reports of the workers')
+    merge.add_argument('queue_dir')
+    merge.add_argument('--output', help='write the merged report to this JSON file')
+    merge.add_argument('--inventory', metavar='LOCAL_ROOT_DIR', help='update the inventory of this data directory')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'worker':
+        report = run_worker(args.queue_dir, args.inventory, n_workers=args.workers,
+                            max_per_host=args.max_per_host, lease_seconds=args.lease,
+                            use_inventory=args.inventory is not None)
+        return 1 if report['failed'] else 0
+
+    if args.command == 'status':
+        print(json.dumps(get_queue_status(args.queue_dir)))
+        return 0
+
+    merged = merge_reports(args.queue_dir, args.output, args.inventory)
+    print(f"{merged['downloaded']} downloaded, {merged['existing']} existing, {len(merged['failed'])} failed")
+    print(f"Queue: {merged['queue']}")
+
+    return 1 if merged['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
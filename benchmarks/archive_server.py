@@ -0,0 +1,295 @@
+import re
+import sys
+import json
+import time
+import struct
+import argparse
+import datetime
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+"""
+Stand-in HTTP archive server for offline benchmarks of the downloaders.
+
+It serves synthetic CDF files under the same directory layouts as the real
+archives, generated on the fly (nothing is stored on disk):
+
+    /ect/rbsp<probe>/<instrument>/level<level>/pitchangle/<year>/
+    /emfisis/rbsp<probe>/l<level>/emfisis/magnetometer/<interval>sec/<coordinates>/<year>
+    /omni/<typ>_<res>/<year>/   and   /omni/hourly/<year>/
+
+Directory URLs return Apache-style index pages and file URLs return valid CDF
+headers padded to the configured size. Every response is delayed by the
+configured latency and sent at the configured bandwidth per connection. Range
+(with If-Range), HEAD and conditional (If-None-Match, If-Modified-Since) requests
+are supported, and the counters of listings, files and bytes served are
+available as JSON at /_stats (POST /_reset sets them to zero).
+
+Usage:
+
+    python -m benchmarks.archive_server [--port 8000] [--latency 0.05] [--bandwidth 20e6] [--file-size 1e6]
+"""
+
+
+_ECT_DIR = re.compile(r'^/ect/rbsp([ab])/(\w+)/level(\d)/pitchangle/(\d{4})/?$')
+_EMFISIS_DIR = re.compile(r'^/emfisis/rbsp([ab])/l(\d)/emfisis/magnetometer/(\d)sec/(\w+)/(\d{4})/?$')
+_OMNI_DIR = re.compile(r'^/omni/(hourly|\w+_\w+)/(\d{4})/?$')
+
+
+def make_cdf_bytes(size):
+
+    '''
+    Build the content of a synthetic CDF file: valid version 3 magic numbers, a CDR
+    pointing to a GDR whose end-of-file offset is the size of the file, and zeros.
+
+    Args:
+        - size (int): The size of the file in bytes (at least 512).
+
+    Returns:
+        - content (bytes): The content of the file.
+    '''
+
+    size = max(int(size), 512)
+    content = bytearray(size)
+    content[0:8] = b'\xcd\xf3\x00\x01\x00\x00\xff\xff'
+    # CDR: RecordSize, RecordType=1, GDRoffset
+    content[8:28] = struct.pack('>qiq', 312, 1, 320)
+    # GDR: RecordSize, RecordType=2, rVDRhead, zVDRhead, ADRhead, eof
+    content[320:364] = struct.pack('>qiqqqq', 84, 2, 0, 0, 0, size)
+
+    return bytes(content)
+
+
+def _days_of_year(year):
+
+    date = datetime.date(year, 1, 1)
+    while date.year == year:
+        yield date
+        date += datetime.timedelta(days=1)
+
+
+def list_directory(path):
+
+    '''
+    Return the filenames of a synthetic archive directory.
+
+    Args:
+        - path (str): The URL path of the directory.
+
+    Returns:
+        - filenames (list or None): The filenames, or None if the path is not a directory.
+    '''
+
+    match = _ECT_DIR.match(path)
+    if match:
+        probe, instrument, level, year = match.groups()
+        return ['rbsp%s_rel03_ect-%s-sci-l%s_%s_v5.0.0.cdf' % (probe, instrument, level, date.strftime('%Y%m%d'))
+                for date in _days_of_year(int(year))]
+
+    match = _EMFISIS_DIR.match(path)
+    if match:
+        probe, level, interval, coordinates, year = match.groups()
+        return ['rbsp-%s_magnetometer_%ssec-%s_emfisis-l%s_%s_v1.3.2.cdf'
+                % (probe, interval, coordinates, level, date.strftime('%Y%m%d'))
+                for date in _days_of_year(int(year))]
+
+    match = _OMNI_DIR.match(path)
+    if match:
+        product, year = match.groups()
+        if product == 'hourly':
+            return ['omni2_h0_mrg1hr_%s0%d01_v01.cdf' % (year, month) for month in (1, 7)]
+        typ, res = product.split('_', 1)
+        return ['omni_%s_%s_%s%02d01_v01.cdf' % (typ, res, year, month) for month in range(1, 13)]
+
+    return None
+
+
+def make_index_page(path, filenames):
+
+    '''
+    Build an Apache-style index page for a directory.
+
+    Args:
+        - path (str): The URL path of the directory.
+        - filenames (list): The filenames of the directory.
+
+    Returns:
+        - content (bytes): The HTML page.
+    '''
+
+    rows = ['<tr><td><a href="../">Parent Directory</a></td></tr>']
+    rows += ['<tr><td><a href="%s">%s</a></td><td align="right">2019-03-14 10:00</td></tr>' % (name, name)
+             for name in filenames]
+    content = ('<html><head><title>Index of %s</title></head><body><h1>Index of %s</h1><table>\n%s\n</table></body></html>'
+               % (path, path, '\n'.join(rows)))
+
+    return content.encode('utf-8')
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+
+    '''
+    Request handler of the stand-in archive. The configuration and counters are
+    attributes of the server (see make_server).
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def _count(self, key, value=1):
+        with self.server.stats_lock:
+            self.server.stats[key] += value
+
+    def _send(self, status, headers, body, head_only=False):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if head_only:
+            return
+
+        # Enviamos el cuerpo a la tasa configurada
+        bandwidth = self.server.bandwidth
+        chunk_size = 64*1024
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start+chunk_size]
+            self.wfile.write(chunk)
+            if bandwidth:
+                time.sleep(len(chunk)/bandwidth)
+        self._count('bytes', len(body))
+
+    def _not_modified(self):
+        # If-None-Match tiene precedencia sobre If-Modified-Since (RFC 9110)
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return self.server.etag in [tag.strip() for tag in if_none_match.split(',')]
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                return parsedate_to_datetime(self.server.last_modified) <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _handle(self, head_only=False):
+        path = self.path.split('?', 1)[0]
+        self._count('requests')
+
+        if path == '/_stats':
+            body = json.dumps(self.server.stats).encode('utf-8')
+            return self._send(200, {'Content-Type': 'application/json', 'Content-Length': len(body)}, body, head_only)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        filenames = list_directory(path)
+        if filenames is not None:
+            self._count('listings')
+            body = make_index_page(path, filenames)
+            return self._send(200, {'Content-Type': 'text/html', 'Content-Length': len(body)}, body, head_only)
+
+        directory, _, filename = path.rpartition('/')
+        if filename in (list_directory(directory) or []):
+            self._count('files')
+            content = self.server.cdf_content
+            headers = {'Content-Type': 'application/x-cdf', 'Accept-Ranges': 'bytes',
+                       'Last-Modified': self.server.last_modified, 'ETag': self.server.etag}
+
+            if self._not_modified():
+                self._count('not_modified')
+                return self._send(304, {'Last-Modified': self.server.last_modified, 'ETag': self.server.etag},
+                                  b'', head_only)
+
+            match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+            # Con If-Range, el rango sólo vale si el archivo no cambió; si no, va el archivo completo
+            if_range = self.headers.get('If-Range')
+            if match and if_range is not None and if_range not in (self.server.etag, self.server.last_modified):
+                match = None
+            if match:
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else len(content) - 1
+                if start >= len(content):
+                    headers['Content-Range'] = 'bytes */%d' % len(content)
+                    headers['Content-Length'] = 0
+                    return self._send(416, headers, b'', head_only)
+                body = content[start:end+1]
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (start, start + len(body) - 1, len(content))
+                headers['Content-Length'] = len(body)
+                return self._send(206, headers, body, head_only)
+
+            headers['Content-Length'] = len(content)
+            return self._send(200, headers, content, head_only)
+
+        body = b'<html><body><h1>404 Not Found</h1></body></html>'
+        return self._send(404, {'Content-Type': 'text/html', 'Content-Length': len(body)}, body, head_only)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_HEAD(self):
+        self._handle(head_only=True)
+
+    def do_POST(self):
+        if self.path == '/_reset':
+            with self.server.stats_lock:
+                for key in self.server.stats:
+                    self.server.stats[key] = 0
+            return self._send(200, {'Content-Length': 0}, b'')
+        return self._send(404, {'Content-Length': 0}, b'')
+
+
+def make_server(port=0, latency=0.05, bandwidth=20e6, file_size=1e6):
+
+    '''
+    Create the stand-in archive server.
+
+    Args:
+        - port (int, optional): The port to listen on (0 for any free port). Defaults to 0.
+        - latency (float, optional): Delay in seconds added to every request. Defaults to 0.05.
+        - bandwidth (float, optional): Bytes per second sent on each connection (0 for no limit).
+          Defaults to 20e6.
+        - file_size (float, optional): Size in bytes of every synthetic CDF file. Defaults to 1e6.
+
+    Returns:
+        - server (ThreadingHTTPServer): The server; server.server_address gives the bound port.
+    '''
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), ArchiveHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.bandwidth = bandwidth
+    server.cdf_content = make_cdf_bytes(file_size)
+    modified = datetime.datetime(2019, 3, 14, 10, 0, tzinfo=datetime.timezone.utc)
+    server.last_modified = formatdate(modified.timestamp(), usegmt=True)
+    server.etag = '"%x-%x"' % (len(server.cdf_content), int(modified.timestamp()))
+    server.stats = {'requests': 0, 'listings': 0, 'files': 0, 'not_modified': 0, 'bytes': 0}
+    server.stats_lock = threading.Lock()
+
+    return server
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Stand-in HTTP archive server for benchmarks.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request')
+    parser.add_argument('--bandwidth', type=float, default=20e6, help='bytes/s per connection (0: no limit)')
+    parser.add_argument('--file-size', type=float, default=1e6, help='bytes per CDF file')
+    args = parser.parse_args(argv)
+
+    server = make_server(args.port, args.latency, args.bandwidth, args.file_size)
+    print('Serving synthetic archive on http://127.0.0.1:%d/' % server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
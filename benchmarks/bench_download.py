@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import resource
+import contextlib
+import multiprocessing
+import urllib.request
+from benchmarks.archive_server import make_server
+
+
+"""
+Benchmark of complete download runs against the stand-in archive server
+(benchmarks/archive_server.py), to catch throughput regressions offline.
+
+The server runs in its own process, with the configured latency, bandwidth and
+file size, and every dataset is downloaded in a fresh process into an empty
+directory. For each dataset the benchmark reports the number of files, files/s,
+MB/s, the number of listing pages fetched and the peak memory (maximum RSS) of
+the downloading process.
+
+Usage:
+
+    python -m benchmarks.bench_download [--start 2013-01-01] [--end 2014-12-31] [--workers 8]
+                                        [--latency 0.05] [--bandwidth 20e6] [--file-size 1e6] [--json report.json]
+
+(from the root of the repository, or with the package installed).
+"""
+
+
+DATASETS = ['ect-rept', 'ect-mageis', 'emfisis-4sec', 'omni-1min']
+
+
+def _serve(port, latency, bandwidth, file_size):
+
+    server = make_server(port, latency, bandwidth, file_size)
+    server.serve_forever()
+
+
+def _get_free_port():
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _download(dataset, base_url, local_root_dir, start_date, end_date, n_workers, queue):
+
+    '''
+    Download one dataset from the stand-in archive (run in a child process) and put
+    the elapsed time and peak memory in the queue.
+    '''
+
+    from Download_data.rbsp.download_ect import download_CDFfiles_ECT
+    from Download_data.rbsp.download_emfisis import download_CDFfiles_EMFISIS
+    from Download_data.omni.download_omni import download_CDFfiles_OMNI
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if dataset.startswith('ect-'):
+            download_CDFfiles_ECT(start_date, end_date, base_url + 'ect/', local_root_dir, 'both',
+                                  dataset[4:], level='3', n_workers=n_workers, max_per_host=n_workers)
+        elif dataset == 'emfisis-4sec':
+            download_CDFfiles_EMFISIS(start_date, end_date, base_url + 'emfisis', local_root_dir, 'both',
+                                      level='3', interval=4, coordinates='geo',
+                                      n_workers=n_workers, max_per_host=n_workers)
+        elif dataset == 'omni-1min':
+            download_CDFfiles_OMNI(start_date, end_date, base_url + 'omni/', local_root_dir, res='1min',
+                                   type='hro', n_workers=n_workers, max_per_host=n_workers)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss está en KiB en Linux y en bytes en macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak/1024**2 if sys.platform == 'darwin' else peak/1024
+
+    queue.put((elapsed, peak_mb))
+
+
+def run_benchmark(datasets, start_date, end_date, n_workers, latency, bandwidth, file_size):
+
+    '''
+    Run the download benchmark of several datasets against a fresh stand-in archive.
+
+    Args:
+        - datasets (list): Names of the datasets to download (see DATASETS).
+        - start_date (str): The start date of the range ('YYYY-MM-DD').
+        - end_date (str): The end date of the range ('YYYY-MM-DD').
+        - n_workers (int): Number of concurrent downloads.
+        - latency (float): Delay in seconds added by the server to every request.
+        - bandwidth (float): Bytes per second sent by the server on each connection.
+        - file_size (float): Size in bytes of every synthetic CDF file.
+
+    Returns:
+        - report (list): One dictionary per dataset with the measured figures.
+    '''
+
+    port = _get_free_port()
+    base_url = 'http://127.0.0.1:%d/' % port
+    server = multiprocessing.Process(target=_serve, args=(port, latency, bandwidth, file_size), daemon=True)
+    server.start()
+
+    for i in range(100):
+        try:
+            urllib.request.urlopen(base_url + '_stats').read()
+            break
+        except OSError:
+            time.sleep(0.05)
+
+    report = []
+    try:
+        for dataset in datasets:
+            urllib.request.urlopen(urllib.request.Request(base_url + '_reset', data=b'', method='POST')).read()
+            local_root_dir = tempfile.mkdtemp(prefix='bench_download_')
+            queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_download, args=(dataset, base_url, local_root_dir,
+                                                                     start_date, end_date, n_workers, queue))
+            worker.start()
+            elapsed, peak_mb = queue.get()
+            worker.join()
+            shutil.rmtree(local_root_dir, ignore_errors=True)
+
+            stats = json.loads(urllib.request.urlopen(base_url + '_stats').read())
+            report.append({'dataset': dataset, 'files': stats['files'], 'seconds': elapsed,
+                           'files_per_s': stats['files']/elapsed, 'mb_per_s': stats['bytes']/1e6/elapsed,
+                           'listings': stats['listings'], 'requests': stats['requests'],
+                           'peak_rss_mb': peak_mb})
+    finally:
+        server.terminate()
+
+    return report
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark of download runs against a stand-in archive.')
+    parser.add_argument('--datasets', nargs='+', default=DATASETS, choices=DATASETS)
+    parser.add_argument('--start', default='2013-01-01')
+    parser.add_argument('--end', default='2014-12-31')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request')
+    parser.add_argument('--bandwidth', type=float, default=20e6, help='bytes/s per connection (0: no limit)')
+    parser.add_argument('--file-size', type=float, default=1e6, help='bytes per CDF file')
+    parser.add_argument('--json', help='write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.datasets, args.start, args.end, args.workers,
+                           args.latency, args.bandwidth, args.file_size)
+
+    print('%-14s %7s %9s %9s %9s %9s %9s %12s' % ('dataset', 'files', 'seconds', 'files/s', 'MB/s',
+                                                 'listings', 'requests', 'peak RSS MB'))
+    for row in report:
+        print('%-14s %7d %9.2f %9.1f %9.1f %9d %9d %12.1f' % (
+            row['dataset'], row['files'], row['seconds'], row['files_per_s'], row['mb_per_s'],
+            row['listings'], row['requests'], row['peak_rss_mb']))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'config': vars(args), 'results': report}, file, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
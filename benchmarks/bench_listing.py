@@ -0,0 +1,133 @@
+import sys
+import time
+import argparse
+import datetime
+from Download_data.utils_listing import parse_links
+
+
+"""
+Benchmark of the parsing of remote directory index pages: the one-pass link
+extractor of Download_data.utils_listing against the BeautifulSoup parser used
+before.
+
+Usage:
+
+    python -m benchmarks.bench_listing [index.html ...] [--entries N] [--repeat R]
+
+(from the root of the repository, or with the package installed).
+
+Saved index pages (e.g. 'curl -o emfisis_1sec_2013.html <year directory URL>')
+are given as arguments. Without arguments a synthetic Apache-style index page of
+a yearly 1-second EMFISIS directory is generated.
+"""
+
+
+def make_index_page(n_entries):
+
+    '''
+    Generate a synthetic Apache-style index page with n_entries daily CDF files.
+
+    Args:
+        - n_entries (int): The number of file entries of the page.
+
+    Returns:
+        - content (bytes): The HTML page.
+    '''
+
+    rows = ['<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td>'
+            '<td><a href="/pub/data/rbsp/rbspa/l3/emfisis/magnetometer/1sec/geo/">Parent Directory</a></td></tr>']
+    date = datetime.date(2013, 1, 1)
+    for i in range(n_entries):
+        filename = 'rbsp-a_magnetometer_1sec-geo_emfisis-l3_%s_v1.%d.%d.cdf' % (
+            (date + datetime.timedelta(days=i % 365)).strftime('%Y%m%d'), i // 365, i % 7)
+        rows.append('<tr><td valign="top"><img src="/icons/unknown.gif" alt="[   ]"></td>'
+                    '<td><a href="%s">%s</a></td><td align="right">2019-03-14 10:%02d  </td>'
+                    '<td align="right"> 71M</td><td>&nbsp;</td></tr>' % (filename, filename, i % 60))
+
+    content = ('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n<html><head>'
+               '<title>Index of /pub/data</title></head><body><h1>Index of /pub/data</h1><table>'
+               + '\n'.join(rows) + '</table></body></html>')
+
+    return content.encode('utf-8')
+
+
+def parse_links_bs4(content):
+
+    '''
+    Parse an index page as read_site_content_ECT did before, with BeautifulSoup.
+
+    Args:
+        - content (bytes): The HTML page.
+
+    Returns:
+        - remote_files (list): The text of every <a> tag of the page.
+    '''
+
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, 'html.parser')
+
+    return [link.extract().get_text() for link in soup.find_all('a')]
+
+
+def time_parser(parser, content, repeat):
+
+    '''
+    Time a parser on a page, keeping the best of several runs.
+
+    Args:
+        - parser (callable): The parser, called as parser(content).
+        - content (bytes): The HTML page.
+        - repeat (int): The number of runs.
+
+    Returns:
+        - best (float): The best time in seconds.
+        - links (list): The links returned by the parser.
+    '''
+
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        links = parser(content)
+        best = min(best, time.perf_counter() - start)
+
+    return best, links
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark of the index page link extractors.')
+    parser.add_argument('pages', nargs='*', help='saved index pages')
+    parser.add_argument('--entries', type=int, default=5000, help='entries of the synthetic page')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.pages:
+        pages = [(path, open(path, 'rb').read()) for path in args.pages]
+    else:
+        pages = [('synthetic (%d entries)' % args.entries, make_index_page(args.entries))]
+
+    try:
+        import bs4
+        has_bs4 = True
+    except ImportError:
+        has_bs4 = False
+        print('BeautifulSoup is not installed, only the link extractor is timed')
+
+    print('%-40s %8s %8s %12s %12s %8s' % ('page', 'KiB', 'links', 'extractor ms', 'bs4 ms', 'speedup'))
+    for name, content in pages:
+        fast_time, fast_links = time_parser(parse_links, content, args.repeat)
+        line = '%-40s %8.0f %8d %12.2f' % (name[-40:], len(content)/1024, len(fast_links), fast_time*1000)
+
+        if has_bs4:
+            bs4_time, bs4_links = time_parser(parse_links_bs4, content, args.repeat)
+            line += ' %12.2f %7.1fx' % (bs4_time*1000, bs4_time/fast_time)
+            if bs4_links != fast_links:
+                line += '  (DIFFERENT OUTPUT)'
+        print(line)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
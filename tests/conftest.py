@@ -0,0 +1,83 @@
+import os
+import sys
+import datetime
+import threading
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.archive_server import make_server
+
+
+"""
+Shared fixtures of the test suite. The downloads run against the synthetic
+archive server of the benchmarks (benchmarks/archive_server.py), started on a
+free local port without latency or bandwidth limit.
+"""
+
+
+@pytest.fixture
+def archive_server():
+
+    '''
+    Start archive servers on demand: archive_server() returns a running server
+    (its URL root is server.url), and every server is shut down after the test.
+    '''
+
+    servers = []
+
+    def start(file_size=4096, latency=0, bandwidth=0):
+        server = make_server(latency=latency, bandwidth=bandwidth, file_size=file_size)
+        server.url = 'http://127.0.0.1:%d/' % server.server_port
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def cdf_writer(tmp_path):
+
+    '''
+    Write small real CDF files with cdflib: cdf_writer(name, compressed=0, var_compression=0,
+    start=datetime(2013, 3, 17), n_records=100, cadence=60, extra=None) returns the path of a
+    file (name is relative to tmp_path, or absolute) with n_records records of 'Epoch' (one every
+    cadence seconds from start), 'FEDU' (float32, 3x2 per record, counting up from 0) and the
+    non-record-varying 'energy'. extra is a dictionary name -> (values, attributes) of more
+    record-varying float64 variables.
+    '''
+
+    cdflib = pytest.importorskip('cdflib')
+    np = pytest.importorskip('numpy')
+    from cdflib.cdfwrite import CDF
+
+    def write(name, compressed=0, var_compression=0, start=datetime.datetime(2013, 3, 17), n_records=100,
+              cadence=60, extra=None):
+        path = str(tmp_path / name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        times = [start + datetime.timedelta(seconds=cadence*i) for i in range(n_records)]
+        epochs = cdflib.cdfepoch.compute_epoch([[time.year, time.month, time.day, time.hour, time.minute,
+                                                 time.second, time.microsecond//1000] for time in times])
+
+        cdf = CDF(path, cdf_spec={'Compressed': compressed, 'rDim_sizes': []})
+        cdf.write_var({'Variable': 'Epoch', 'Data_Type': 31, 'Num_Elements': 1, 'Rec_Vary': True, 'Dim_Sizes': [],
+                       'Compress': var_compression}, var_attrs={}, var_data=np.array(epochs))
+        cdf.write_var({'Variable': 'FEDU', 'Data_Type': 21, 'Num_Elements': 1, 'Rec_Vary': True, 'Dim_Sizes': [3, 2],
+                       'Compress': var_compression}, var_attrs={},
+                      var_data=np.arange(n_records*6, dtype='f4').reshape(n_records, 3, 2))
+        cdf.write_var({'Variable': 'energy', 'Data_Type': 22, 'Num_Elements': 1, 'Rec_Vary': False,
+                       'Dim_Sizes': [3]}, var_attrs={}, var_data=np.array([1.0, 2.0, 3.0]))
+        for variable, (values, attributes) in (extra or {}).items():
+            cdf.write_var({'Variable': variable, 'Data_Type': 22, 'Num_Elements': 1, 'Rec_Vary': True,
+                           'Dim_Sizes': [], 'Compress': var_compression},
+                          var_attrs=dict((key, [value, 'CDF_DOUBLE']) for key, value in attributes.items()),
+                          var_data=np.asarray(values, dtype='f8'))
+        cdf.close()
+        return path
+
+    return write
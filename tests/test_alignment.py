@@ -0,0 +1,77 @@
+import datetime
+import pytest
+from Download_data.alignment import interpolate_series, align_OMNI
+from Download_data.omni.download_omni import get_jobs_OMNI
+
+np = pytest.importorskip('numpy')
+
+
+FILL_VALUE = 9999.99
+
+
+def _times(*seconds):
+    return np.datetime64('2013-03-01T00:00:00', 'ns') + np.array(seconds, dtype='timedelta64[s]')
+
+
+def test_linear_interpolation():
+    source_times = _times(0, 60, 120, 180)
+    values = np.array([0.0, 1.0, np.nan, 3.0])
+
+    result = interpolate_series(source_times, values, _times(-1, 0, 30, 60, 90, 180, 181))
+
+    # Fuera de los datos y junto a un NaN no hay valor; en un dato exacto no se mezcla con el vecino
+    assert np.array_equal(result, [np.nan, 0.0, 0.5, 1.0, np.nan, 3.0, np.nan], equal_nan=True)
+
+
+def test_linear_interpolation_does_not_bridge_gaps():
+    source_times = _times(0, 60, 600)
+    values = np.array([0.0, 1.0, 10.0])
+
+    result = interpolate_series(source_times, values, _times(30, 300, 600), max_gap=120)
+
+    assert np.array_equal(result, [0.5, np.nan, 10.0], equal_nan=True)
+    assert interpolate_series(source_times, values, _times(330))[0] == pytest.approx(5.5)
+
+
+def test_nearest_sample():
+    source_times = _times(0, 60, 600)
+    values = np.array([0.0, 1.0, 10.0])
+
+    result = interpolate_series(source_times, values, _times(-20, 29, 30, 31, 300, 590), method='nearest', max_gap=30)
+
+    # A igual distancia gana el dato anterior
+    assert np.array_equal(result, [0.0, 0.0, 0.0, 1.0, np.nan, 10.0], equal_nan=True)
+    with pytest.raises(ValueError):
+        interpolate_series(source_times, values, _times(0), method='cubic')
+
+
+def test_align_OMNI_across_files_with_lags_and_fill_values(cdf_writer, tmp_path):
+    local_root_dir = str(tmp_path / 'omni') + '/'
+    # Dos archivos mensuales de 5 minutos; el valor es el número de pasos de 5 minutos desde el 1 de marzo
+    start = 0
+    for url, local_path in get_jobs_OMNI('2013-03-01', '2013-04-30', '', local_root_dir, res='5min'):
+        month = datetime.datetime.strptime(local_path.rsplit('_', 2)[1], '%Y%m%d')
+        n_records = (31 if month.month == 3 else 30)*288
+        values = np.arange(start, start + n_records, dtype=float)
+        values[values == 100] = FILL_VALUE
+        cdf_writer(local_path, start=month, n_records=n_records, cadence=300,
+                   extra={'BZ_GSM': (values, {'FILLVAL': FILL_VALUE})})
+        start += n_records
+
+    steps = np.array([8927.5, 2592.5, 8928, 100, 100.5, 10])
+    times = np.datetime64('2013-03-01T00:00:00', 'ns') + (steps*300e9).astype('timedelta64[ns]')
+
+    values = align_OMNI(times, local_root_dir, ['BZ_GSM'], res='5min', chunk_months=1, n_processes=1)['BZ_GSM']
+    assert np.array_equal(values, [8927.5, 2592.5, 8928, np.nan, np.nan, 10], equal_nan=True)
+
+    lagged = align_OMNI(times, local_root_dir, ['BZ_GSM'], res='5min', lag=[0, 300], n_processes=1)['BZ_GSM']
+    assert lagged.shape == (6, 2)
+    assert np.array_equal(lagged[:, 1], [8926.5, 2591.5, 8927, 99, np.nan, 9], equal_nan=True)
+
+    nearest = align_OMNI(times + np.timedelta64(20, 's'), local_root_dir, ['BZ_GSM'], res='5min', method='nearest',
+                         n_processes=1)['BZ_GSM']
+    assert np.array_equal(nearest, [8928, 2593, 8928, np.nan, 101, 10], equal_nan=True)
+
+    # Sin archivos OMNI para las fechas, NaN
+    may = np.array(['2013-05-10T00:00:00'], dtype='datetime64[ns]')
+    assert np.isnan(align_OMNI(may, local_root_dir, ['BZ_GSM'], res='5min', n_processes=1)['BZ_GSM'][0])
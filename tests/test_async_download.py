@@ -0,0 +1,85 @@
+import os
+import asyncio
+from Download_data import async_download
+from Download_data.async_download import download_jobs_async, get_jobs_OMNI_async
+from Download_data.inventory import get_inventory_callback, get_stored_files
+from Download_data.utils_download import file_checksum
+from Download_data.utils_metrics import RunReport, add_event_hook, remove_event_hook
+from benchmarks.archive_server import make_cdf_bytes
+
+
+class _Content:
+
+    # Como aiohttp, entrega el cuerpo en trozos de pocos KB, pida lo que se pida
+    def __init__(self, data):
+        self.data = data
+
+    async def iter_chunked(self, chunk_size):
+        for start in range(0, len(self.data), 4096):
+            yield self.data[start:start + 4096]
+
+
+class _Response:
+
+    def __init__(self, data):
+        self.status = 200
+        self.headers = {'Content-Length': str(len(data)), 'ETag': '"1"'}
+        self.content = _Content(data)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        return
+
+
+class _Session:
+
+    # Sesión con la interfaz de aiohttp.ClientSession que usa download_file_async
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, url, headers=None):
+        return _Response(self.data)
+
+
+def _download(jobs, data, on_complete):
+
+    async def run():
+        return [local_path async for local_path in download_jobs_async(_Session(data), jobs, on_complete=on_complete)]
+
+    return asyncio.run(run())
+
+
+def test_async_downloads_are_buffered_reported_and_recorded(tmp_path, monkeypatch):
+    data = make_cdf_bytes(300000)
+    jobs = asyncio.run(get_jobs_OMNI_async(None, '2013-01-01', '2013-03-31', 'http://host/', str(tmp_path) + '/'))
+    writes = []
+    write_chunks = async_download._write_chunks
+    monkeypatch.setattr(async_download, '_write_chunks', lambda *args: writes.append(1) or write_chunks(*args))
+    events = []
+    add_event_hook(events.append)
+
+    try:
+        with RunReport() as report, get_inventory_callback(str(tmp_path)) as recorder:
+            local_paths = _download(jobs, data, recorder)
+    finally:
+        remove_event_hook(events.append)
+
+    assert sorted(local_paths) == sorted(job[1] for job in jobs)
+    # Un solo paso a otro hilo por archivo, no uno por trozo de 4 KB
+    assert len(writes) == len(jobs)
+    assert {'first_byte', 'transfer', 'write', 'job'} <= set(event['phase'] for event in events)
+    assert report.summary()['jobs'] == {'downloaded': 3}
+    files = get_stored_files(str(tmp_path), 'hro')
+    assert len(files) == 3
+    for row in files:
+        assert row['checksum'] == file_checksum(os.path.join(str(tmp_path), row['path']))
+
+    # Los archivos que ya existen también se entregan a on_complete
+    recorded = []
+    _download(jobs, data, recorded.append)
+    assert sorted(recorded) == sorted(job[1] for job in jobs)
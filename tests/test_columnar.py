@@ -0,0 +1,69 @@
+import os
+import datetime
+import pytest
+from Download_data.columnar import sync_columnar_store, read_columnar, get_columnar_files, get_columnar_dir
+from Download_data.rbsp.download_ect import get_local_dir_ECT
+
+pytest.importorskip('pyarrow')
+
+
+SPEC = {'dataset': 'ect', 'probe': 'a', 'instrument': 'rept'}
+
+
+def _write_day(cdf_writer, local_root_dir, day, version='v5.0.0'):
+
+    # 10 registros repartidos en el día (uno cada 2,4 horas)
+    date = datetime.datetime(2013, 3, day)
+    local_dir = get_local_dir_ECT(date, local_root_dir, 'a', 'rept', '3')
+    name = 'rbspa_rel03_ect-rept-sci-l3_%s_%s.cdf' % (date.strftime('%Y%m%d'), version)
+    return cdf_writer(local_dir + name, start=date, n_records=10, cadence=8640)
+
+
+def test_read_columnar_gives_the_records_of_the_range(cdf_writer, tmp_path):
+    import numpy as np
+    local_root_dir = str(tmp_path / 'data')
+    for day in (17, 18, 19):
+        _write_day(cdf_writer, local_root_dir, day)
+    assert sync_columnar_store(SPEC, '2013-03-17', '2013-03-19', local_root_dir, n_processes=1) == 3
+
+    # Una fecha final sin hora incluye todo el día
+    data = read_columnar(SPEC, '2013-03-17', '2013-03-18', local_root_dir)
+    assert data['Epoch'].dtype == np.dtype('datetime64[ns]')
+    assert len(data['Epoch']) == 20 and data['Epoch'][-1] == np.datetime64('2013-03-18T21:36:00')
+    assert data['FEDU'].shape == (20, 3, 2) and data['FEDU'][0].tolist() == [[0, 1], [2, 3], [4, 5]]
+    assert data['energy'].tolist() == [1.0, 2.0, 3.0]
+
+    # Con hora, el final se incluye hasta ese instante
+    data = read_columnar(SPEC, '2013-03-18 00:00:00', '2013-03-18 12:00:00', local_root_dir, ['Epoch'])
+    assert set(data) == {'Epoch'} and len(data['Epoch']) == 6
+
+    table = read_columnar(SPEC, '2013-03-19', '2013-03-19', local_root_dir, ['FEDU'], as_table=True)
+    assert table.column_names == ['FEDU'] and table.num_rows == 10
+
+
+def test_files_are_pruned_by_the_range(cdf_writer, tmp_path):
+    local_root_dir = str(tmp_path / 'data')
+    for day in (17, 18, 19):
+        _write_day(cdf_writer, local_root_dir, day)
+    sync_columnar_store(SPEC, '2013-03-17', '2013-03-19', local_root_dir, n_processes=1)
+
+    files = get_columnar_files(SPEC, '2013-03-18', '2013-03-31', local_root_dir)
+
+    assert [os.path.basename(path).split('_')[3] for path in files] == ['20130318', '20130319']
+    assert read_columnar(SPEC, '2013-04-01', '2013-04-30', local_root_dir) == {}
+
+
+def test_sync_is_incremental_and_drops_superseded_versions(cdf_writer, tmp_path):
+    local_root_dir = str(tmp_path / 'data')
+    for day in (17, 18):
+        _write_day(cdf_writer, local_root_dir, day)
+    assert sync_columnar_store(SPEC, '2013-03-17', '2013-03-18', local_root_dir, n_processes=1) == 2
+    assert sync_columnar_store(SPEC, '2013-03-17', '2013-03-18', local_root_dir, n_processes=1) == 0
+
+    _write_day(cdf_writer, local_root_dir, 18, version='v5.1.0')
+    assert sync_columnar_store(SPEC, '2013-03-17', '2013-03-18', local_root_dir, n_processes=1) == 1
+
+    columnar_dir = get_columnar_dir(SPEC, datetime.date(2013, 3, 18), local_root_dir)
+    assert sorted(os.listdir(columnar_dir)) == ['rbspa_rel03_ect-rept-sci-l3_20130317_v5.0.0.parquet',
+                                                'rbspa_rel03_ect-rept-sci-l3_20130318_v5.1.0.parquet']
+    assert len(read_columnar(SPEC, '2013-03-17', '2013-03-18', local_root_dir, ['Epoch'])['Epoch']) == 20
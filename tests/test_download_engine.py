@@ -0,0 +1,103 @@
+import threading
+from collections import Counter
+from Download_data import download_engine
+from Download_data.download_engine import (run_download_jobs, iter_download_jobs, read_failure_manifest,
+                                           window_first)
+from Download_data.utils_metrics import RunReport
+
+
+class _StatusError(Exception):
+
+    # Error HTTP con la forma de requests.HTTPError (el estado está en error.response)
+    def __init__(self, status_code):
+        super().__init__('HTTP %d' % status_code)
+        self.response = type('Response', (), {'status_code': status_code, 'headers': {}})()
+
+
+def _flaky_download(failures):
+
+    # Función de descarga que falla según failures: url -> lista de errores de los primeros intentos
+    attempts = Counter()
+    lock = threading.Lock()
+
+    def download(url, local_path):
+        with lock:
+            attempt = attempts[url]
+            attempts[url] += 1
+        errors = failures.get(url, [])
+        if attempt < len(errors):
+            raise errors[attempt]
+        return True
+
+    return download, attempts
+
+
+def test_transient_errors_are_retried_and_the_rest_fail_at_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(download_engine, 'get_backoff_delay', lambda attempt, error=None: 0)
+    jobs = [('http://host/%s.cdf' % name, str(tmp_path / ('%s.cdf' % name))) for name in ('ok', 'reset', 'gone', 'down')]
+    download, attempts = _flaky_download({'http://host/reset.cdf': [ConnectionError('reset'), _StatusError(503)],
+                                          'http://host/gone.cdf': [_StatusError(404)],
+                                          'http://host/down.cdf': [_StatusError(503)]*10})
+    manifest_path = str(tmp_path / 'failed.json')
+
+    with RunReport() as report:
+        results = run_download_jobs(jobs, download_function=download, n_workers=2, max_retries=3,
+                                    failure_manifest=manifest_path, progress=False)
+
+    assert sorted(results['downloaded']) == sorted([jobs[0][1], jobs[1][1]])
+    assert sorted(url for url, local_path, error in results['failed']) == ['http://host/down.cdf', 'http://host/gone.cdf']
+    assert attempts == {'http://host/ok.cdf': 1, 'http://host/reset.cdf': 3, 'http://host/gone.cdf': 1,
+                        'http://host/down.cdf': 4}
+    assert report.summary()['jobs'] == {'downloaded': 2, 'failed': 2}
+
+    # El manifiesto de fallas se puede volver a correr tal cual
+    retry_jobs = read_failure_manifest(manifest_path)
+    assert sorted(retry_jobs) == sorted([jobs[2], jobs[3]])
+    download, attempts = _flaky_download({})
+    results = run_download_jobs(retry_jobs, download_function=download, failure_manifest=manifest_path,
+                                progress=False)
+    assert results['failed'] == [] and read_failure_manifest(manifest_path) == []
+
+
+def test_on_complete_errors_do_not_fail_the_job(tmp_path, capsys):
+    jobs = [('http://host/%d.cdf' % i, str(tmp_path / ('%d.cdf' % i))) for i in range(3)]
+    download, attempts = _flaky_download({})
+
+    def on_complete(local_path):
+        raise RuntimeError('database is locked')
+
+    results = run_download_jobs(jobs, download_function=download, on_complete=on_complete, progress=False)
+
+    assert len(results['downloaded']) == 3 and results['failed'] == []
+    assert capsys.readouterr().out.count('database is locked') == 3
+
+
+def test_iter_download_jobs_yields_in_job_order(archive_server, tmp_path):
+    server = archive_server()
+    root = server.url + 'omni/hro_1min/2013/'
+    jobs = [(root + 'omni_hro_1min_2013%02d01_v01.cdf' % month, str(tmp_path / ('%02d.cdf' % month)))
+            for month in range(1, 13)]
+    jobs.insert(3, (root + 'missing.cdf', str(tmp_path / 'missing.cdf')))
+    failed = []
+    completed = []
+
+    local_paths = list(iter_download_jobs(jobs, n_workers=4, on_complete=completed.append,
+                                          on_error=lambda url, local_path, e: failed.append(url)))
+
+    assert local_paths == [job[1] for job in jobs if 'missing' not in job[0]]
+    assert failed == [root + 'missing.cdf']
+    assert completed == local_paths
+
+    # Como run_download_jobs, on_complete también recibe los archivos que ya estaban
+    completed = []
+    assert list(iter_download_jobs(jobs[:3], on_complete=completed.append)) == completed == \
+        [job[1] for job in jobs[:3]]
+
+
+def test_window_first_uses_the_span_of_the_files():
+    priority = window_first('2013-03-17', '2013-03-20')
+    jobs = [('', '/hro/2013/omni_hro_1min_2013%02d01_v01.cdf' % month) for month in (2, 3, 4)]
+    jobs.append(('', '/hourly/2013/omni2_h0_mrg1hr_20130101_v01.cdf'))
+
+    assert [job[1].rsplit('_', 2)[1] for job in sorted(jobs, key=priority)] == \
+        ['20130101', '20130301', '20130201', '20130401']
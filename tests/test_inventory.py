@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import multiprocessing
+from Download_data import inventory
+from Download_data.inventory import (connect_inventory, scan_inventory, get_missing_jobs, get_stored_files,
+                                     get_inventory_callback, get_file_validators, get_inventory_path)
+from Download_data.download_engine import run_download_jobs
+from Download_data.omni.download_omni import get_jobs_OMNI
+from Download_data.utils_download import file_checksum
+
+
+def _omni_jobs(server, local_root_dir, start_date='2013-01-01', end_date='2013-12-31'):
+    return get_jobs_OMNI(start_date, end_date, server.url + 'omni/', str(local_root_dir) + '/')
+
+
+def test_recorder_stores_files_with_streamed_checksum(archive_server, tmp_path):
+    server = archive_server()
+    jobs = _omni_jobs(server, tmp_path)
+
+    recorder = get_inventory_callback(str(tmp_path))
+    try:
+        results = run_download_jobs(jobs, n_workers=4, on_complete=recorder)
+    finally:
+        recorder.close()
+
+    assert len(results['downloaded']) == 12
+    files = get_stored_files(str(tmp_path), 'hro')
+    assert len(files) == 12
+    # El checksum se calcula durante la descarga y coincide con el del archivo en disco
+    for row in files:
+        assert row['checksum'] == file_checksum(os.path.join(str(tmp_path), row['path']))
+    assert get_missing_jobs(str(tmp_path), jobs + _omni_jobs(server, tmp_path, '2014-01-01', '2014-02-28')) == \
+        _omni_jobs(server, tmp_path, '2014-01-01', '2014-02-28')
+
+
+def test_scan_inventory_follows_the_directory_tree(archive_server, tmp_path):
+    server = archive_server()
+    jobs = _omni_jobs(server, tmp_path)
+    run_download_jobs(jobs, n_workers=4)
+
+    assert scan_inventory(str(tmp_path)) == 12
+    os.remove(jobs[0][1])
+    assert scan_inventory(str(tmp_path)) == 11
+    assert get_missing_jobs(str(tmp_path), jobs) == jobs[:1]
+
+
+def test_recorder_survives_a_locked_database(archive_server, tmp_path, capsys):
+    server = archive_server()
+    jobs = _omni_jobs(server, tmp_path)
+    connect_inventory(str(tmp_path)).close()
+
+    # Otro proceso tiene el inventario bloqueado durante toda la ejecución
+    blocker = sqlite3.connect(get_inventory_path(str(tmp_path)))
+    blocker.execute('BEGIN EXCLUSIVE')
+    original_connect = sqlite3.connect
+    inventory.sqlite3.connect = lambda path, timeout=60: original_connect(path, timeout=0.1)
+    try:
+        recorder = get_inventory_callback(str(tmp_path))
+        try:
+            results = run_download_jobs(jobs, n_workers=4, on_complete=recorder)
+        finally:
+            recorder.close()
+    finally:
+        inventory.sqlite3.connect = original_connect
+        blocker.rollback()
+        blocker.close()
+
+    # Los archivos se descargaron y se cuentan una sola vez; el inventario se arregla con un scan
+    assert len(results['downloaded']) == 12 and results['failed'] == []
+    assert 'scan_inventory brings it back in sync' in capsys.readouterr().out
+    assert scan_inventory(str(tmp_path)) == 12
+
+
+def test_validators_keep_their_url(tmp_path):
+    local_path = str(tmp_path / 'hro' / '2013' / 'omni_hro_1min_20130101_v01.cdf')
+    os.makedirs(os.path.dirname(local_path))
+    with open(local_path, 'wb') as file:
+        file.write(b'data')
+
+    recorder = get_inventory_callback(str(tmp_path))
+    recorder.set_validators(local_path, {'etag': '"1"', 'last_modified': None, 'remote_size': 4,
+                                         'url': 'http://mirror/omni_hro_1min_20130101_v01.cdf'})
+    recorder(local_path)
+    recorder.close()
+
+    validators = get_file_validators(str(tmp_path), [local_path])[local_path]
+    assert validators['etag'] == '"1"'
+    assert validators['url'] == 'http://mirror/omni_hro_1min_20130101_v01.cdf'
+
+
+def _open_inventory(local_root_dir, counter):
+    original_scan = inventory._scan
+
+    def counting_scan(*args, **kwargs):
+        with counter.get_lock():
+            counter.value += 1
+        return original_scan(*args, **kwargs)
+
+    inventory._scan = counting_scan
+    connect_inventory(local_root_dir).close()
+
+
+def test_new_inventory_is_scanned_once(tmp_path):
+    counter = multiprocessing.Value('i', 0)
+    processes = [multiprocessing.Process(target=_open_inventory, args=(str(tmp_path), counter)) for _ in range(6)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert [process.exitcode for process in processes] == [0]*6
+    assert counter.value == 1
@@ -0,0 +1,71 @@
+import os
+import datetime
+import pytest
+from Download_data import loader
+from Download_data.loader import get_local_files, load_CDFfiles, load_CDF_arrays, read_CDF_info
+from Download_data.rbsp.download_ect import get_local_dir_ECT
+
+
+SPEC = {'dataset': 'ect', 'probe': 'a', 'instrument': 'rept'}
+
+
+def _write_days(cdf_writer, local_root_dir, days, version='v5.0.0'):
+
+    # Un archivo ECT por día, de 10 registros, en el árbol local de las descargas
+    paths = []
+    for day in days:
+        date = datetime.datetime(2013, 3, day)
+        local_dir = get_local_dir_ECT(date, local_root_dir, 'a', 'rept', '3')
+        name = 'rbspa_rel03_ect-rept-sci-l3_%s_%s.cdf' % (date.strftime('%Y%m%d'), version)
+        paths.append(cdf_writer(local_dir + name, start=date, n_records=10))
+    return paths
+
+
+def test_local_files_are_the_newest_version_of_each_day_in_range(cdf_writer, tmp_path):
+    local_root_dir = str(tmp_path / 'data')
+    old = _write_days(cdf_writer, local_root_dir, [17])
+    paths = _write_days(cdf_writer, local_root_dir, [16, 17, 18, 19], version='v5.1.0')
+
+    assert get_local_files(SPEC, '2013-03-17', '2013-03-18', local_root_dir) == paths[1:3]
+    assert old[0] not in get_local_files(SPEC, '2013-03-01', '2013-03-31', local_root_dir)
+    with pytest.raises(ValueError):
+        get_local_files(dict(SPEC, probe='both'), '2013-03-17', '2013-03-18', local_root_dir)
+
+
+def test_load_concatenates_the_files_in_order(cdf_writer, tmp_path):
+    import cdflib
+    local_root_dir = str(tmp_path / 'data')
+    paths = _write_days(cdf_writer, local_root_dir, [17, 18, 19])
+
+    data = load_CDFfiles(SPEC, '2013-03-17', '2013-03-19', local_root_dir, ['Epoch', 'FEDU', 'energy'],
+                         n_processes=1)
+
+    references = [cdflib.CDF(path) for path in paths]
+    assert data['FEDU'].shape == (30, 3, 2) and data['FEDU'].dtype == 'f4'
+    assert data['FEDU'].tolist() == sum((reference.varget('FEDU').tolist() for reference in references), [])
+    assert data['Epoch'].tolist() == sum((reference.varget('Epoch').tolist() for reference in references), [])
+    assert data['energy'].tolist() == [1.0, 2.0, 3.0]
+    assert read_CDF_info(paths[0], ['Epoch', 'FEDU', 'energy']) == \
+        {'Epoch': (10, (), 'f8'), 'FEDU': (10, (3, 2), 'f4'), 'energy': (None, (3,), 'f8')}
+
+
+def test_process_pool_gives_the_same_arrays_and_skips_bad_files(cdf_writer, tmp_path, monkeypatch, capsys):
+    paths = _write_days(cdf_writer, str(tmp_path / 'data'), [17, 18, 19])
+    bad_path = str(tmp_path / 'bad.cdf')
+    with open(bad_path, 'wb') as file:
+        file.write(b'<html></html>')
+
+    serial = load_CDF_arrays(paths, ['Epoch', 'FEDU'], n_processes=1)
+    monkeypatch.setattr(loader, 'PROCESS_POOL_MIN_FILES', 2)
+    pooled = load_CDF_arrays(paths[:2] + [bad_path] + paths[2:], ['Epoch', 'FEDU'], n_processes=2)
+
+    assert pooled['FEDU'].tolist() == serial['FEDU'].tolist()
+    assert pooled['Epoch'].tolist() == serial['Epoch'].tolist()
+    assert 'Could not read %s' % bad_path in capsys.readouterr().out
+
+
+def test_no_files_give_empty_arrays(tmp_path):
+    data = load_CDFfiles(SPEC, '2013-03-17', '2013-03-19', str(tmp_path), ['Epoch', 'FEDU'])
+
+    assert set(data) == {'Epoch', 'FEDU'} and len(data['Epoch']) == 0
+    assert not os.listdir(str(tmp_path))
@@ -0,0 +1,64 @@
+import os
+import pytest
+from Download_data.mirrors import Mirror, MirrorSet
+from Download_data.download_engine import run_download_jobs
+from Download_data.omni.download_omni import get_jobs_OMNI
+from Download_data.utils_metrics import add_event_hook, remove_event_hook
+
+
+def _mirror_set():
+    return MirrorSet([Mirror('a', 'http://a/omni/'), Mirror('b', 'http://b/omni/')])
+
+
+def test_jobs_fail_over_to_the_next_mirror(archive_server, tmp_path):
+    primary = archive_server()
+    secondary = archive_server()
+    mirror_set = MirrorSet([Mirror('primary', primary.url + 'omni/'), Mirror('secondary', secondary.url + 'omni/')])
+    jobs = get_jobs_OMNI('2013-01-01', '2013-12-31', primary.url + 'omni/', str(tmp_path) + '/')
+    # El servidor principal se cae antes de la descarga
+    primary.shutdown()
+    primary.server_close()
+
+    events = []
+    add_event_hook(events.append)
+    try:
+        results = run_download_jobs(jobs, download_function=mirror_set.get_download_function(),
+                                    max_per_host=mirror_set.get_max_jobs(), progress=False)
+    finally:
+        remove_event_hook(events.append)
+
+    assert len(results['downloaded']) == 12 and results['failed'] == []
+    assert all(os.path.exists(job[1]) for job in jobs)
+    assert secondary.stats['files'] == 12
+    assert any(event['phase'] == 'failover' for event in events)
+
+
+def test_transient_error_is_raised_over_a_missing_file():
+    calls = []
+
+    def download(url, local_path):
+        calls.append(url)
+        if url.startswith('http://a/'):
+            raise ConnectionError('connection reset')
+        raise FileNotFoundError('404 Not Found')
+
+    # El archivo falta en b, pero a sólo falló por un error pasajero: el motor debe reintentarlo
+    with pytest.raises(ConnectionError):
+        _mirror_set().get_download_function(download)('http://a/omni/x.cdf', '/data/x.cdf')
+    assert sorted(calls) == ['http://a/omni/x.cdf', 'http://b/omni/x.cdf']
+
+
+def test_pinned_url_is_tried_first():
+    calls = []
+
+    def download(url, local_path):
+        calls.append(url)
+        return False
+
+    mirror_set = _mirror_set()
+    pinned_urls = {'/data/x.cdf': 'http://b/omni/x.cdf'}
+    download_function = mirror_set.get_download_function(download, pinned_urls)
+
+    assert download_function('http://a/omni/x.cdf', '/data/x.cdf') is False
+    assert download_function('http://a/omni/y.cdf', '/data/y.cdf') is False
+    assert calls == ['http://b/omni/x.cdf', 'http://a/omni/y.cdf']
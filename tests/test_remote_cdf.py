@@ -0,0 +1,70 @@
+import pytest
+from Download_data import remote_cdf
+from Download_data.remote_cdf import RangeFile, read_remote_CDF
+
+
+def _url(server, month=1):
+    return server.url + 'omni/hro_1min/2013/omni_hro_1min_2013%02d01_v01.cdf' % month
+
+
+def test_missing_blocks_are_fetched_in_runs(archive_server):
+    server = archive_server(file_size=10000)
+    content = server.cdf_content
+    remote_file = RangeFile(_url(server), block_size=1024)
+
+    assert remote_file.read(1500, 100) == content[1500:1600]
+    assert remote_file.n_requests == 1 and remote_file.size == len(content)
+
+    # Faltan el bloque 0 y los bloques 2 a 4: dos peticiones, no cuatro
+    assert remote_file.read(0, 5000) == content[:5000]
+    assert remote_file.n_requests == 3 and remote_file.bytes_received == 5*1024
+
+    # Lo ya leído no se vuelve a pedir, y el final del archivo corta la lectura
+    assert remote_file.read(100, 4000) == content[100:4100]
+    assert remote_file.read(len(content) - 10, 100) == content[-10:]
+    assert remote_file.read(len(content) + 10, 100) == b''
+    assert remote_file.n_requests == 4
+
+
+class _WholeFileSession:
+
+    # Servidor que ignora el Range y responde 200 con el archivo entero
+    def __init__(self, content):
+        self.content = content
+        self.n_requests = 0
+
+    def get(self, url, headers=None, timeout=None):
+        self.n_requests += 1
+        return type('Response', (), {'status_code': 200, 'headers': {}, 'content': self.content,
+                                     'raise_for_status': lambda self: None})()
+
+
+def test_server_without_range_support(monkeypatch):
+    content = bytes(range(256))*40
+    session = _WholeFileSession(content)
+    monkeypatch.setattr(remote_cdf, 'get_session', lambda: session)
+    remote_file = RangeFile('http://host/file.cdf', block_size=1024)
+
+    assert remote_file.read(5000, 100) == content[5000:5100]
+    assert remote_file.size == len(content)
+    # Todo el archivo quedó en memoria
+    assert remote_file.read(0, len(content)) == content
+    assert session.n_requests == 1
+
+
+@pytest.mark.parametrize('compressed', [0, 6])
+def test_read_remote_slice(archive_server, cdf_writer, compressed):
+    import cdflib
+    path = cdf_writer('file.cdf', compressed)
+    server = archive_server()
+    with open(path, 'rb') as file:
+        server.cdf_content = file.read()
+    url = server.url + 'omni/hro_1min/2013/omni_hro_1min_2013%02d01_v01.cdf' % (compressed + 1)
+
+    data = read_remote_CDF(url, ['Epoch', 'FEDU', 'energy'], start_time='2013-03-17 00:10:00',
+                           end_time='2013-03-17 00:19:00')
+
+    reference = cdflib.CDF(path)
+    assert data['FEDU'].tolist() == reference.varget('FEDU')[10:20].tolist()
+    assert data['Epoch'].tolist() == reference.varget('Epoch')[10:20].tolist()
+    assert data['energy'].tolist() == [1.0, 2.0, 3.0]
@@ -0,0 +1,45 @@
+import pytest
+from Download_data.utils_cdf import check_cdf_file, decompress_cdf, read_cdf_structure, read_cdf_variable
+
+
+@pytest.mark.parametrize('compressed', [0, 6])
+def test_check_cdf_file_detects_truncation(cdf_writer, tmp_path, compressed):
+    path = cdf_writer('file.cdf', compressed)
+    assert check_cdf_file(path) is None
+
+    with open(path, 'rb') as file:
+        data = file.read()
+    for size in (len(data) - 1, len(data)//2, 12):
+        truncated_path = str(tmp_path / ('truncated_%d.cdf' % size))
+        with open(truncated_path, 'wb') as file:
+            file.write(data[:size])
+        assert check_cdf_file(truncated_path).startswith('truncated CDF file')
+
+
+def test_check_cdf_file_rejects_html(tmp_path):
+    path = str(tmp_path / 'page.cdf')
+    with open(path, 'wb') as file:
+        file.write(b'<html><body>Not Found</body></html>')
+
+    assert check_cdf_file(path) == 'not a CDF file (bad magic number)'
+
+
+def _reader(path):
+    with open(path, 'rb') as file:
+        data = decompress_cdf(file.read())
+    return lambda offset, size: data[offset:offset + size]
+
+
+@pytest.mark.parametrize('compressed, var_compression', [(0, 0), (0, 6), (6, 0)])
+def test_read_variables_like_cdflib(cdf_writer, compressed, var_compression):
+    import cdflib
+    path = cdf_writer('file.cdf', compressed, var_compression)
+
+    read = _reader(path)
+    cdf = read_cdf_structure(read)
+    reference = cdflib.CDF(path)
+
+    assert set(cdf['variables']) == {'Epoch', 'FEDU', 'energy'}
+    assert read_cdf_variable(read, cdf, 'FEDU', 10, 19).tolist() == reference.varget('FEDU')[10:20].tolist()
+    assert read_cdf_variable(read, cdf, 'Epoch').tolist() == reference.varget('Epoch').tolist()
+    assert read_cdf_variable(read, cdf, 'energy').tolist() == [1.0, 2.0, 3.0]
@@ -0,0 +1,90 @@
+import os
+import time
+import pytest
+from Download_data.utils_download import (download_file, revalidate_file, set_part_origin, pop_file_checksum,
+                                          file_checksum, PART_SUFFIX)
+
+
+def _url(server, month=1):
+    return server.url + 'omni/hro_1min/2013/omni_hro_1min_2013%02d01_v01.cdf' % month
+
+
+def _write_part(local_path, data, validators):
+    with open(local_path + PART_SUFFIX, 'wb') as file:
+        file.write(data)
+    set_part_origin(local_path + PART_SUFFIX, validators)
+
+
+def _sent_bytes(server, expected, timeout=2):
+
+    # El servidor cuenta los bytes después de escribir la respuesta: esperamos a que el contador llegue
+    deadline = time.monotonic() + timeout
+    while server.stats['bytes'] != expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return server.stats['bytes']
+
+
+def test_revalidation_of_an_unchanged_file_is_not_modified(archive_server, tmp_path):
+    server = archive_server()
+    local_path = str(tmp_path / 'file.cdf')
+    changed, validators = revalidate_file(_url(server), local_path)
+    assert changed and validators['etag'] == server.etag and validators['url'] == _url(server)
+
+    changed, new_validators = revalidate_file(_url(server), local_path, validators)
+
+    assert not changed and new_validators == validators
+    assert server.stats['not_modified'] == 1
+    # Sólo se transfirió la primera descarga
+    assert _sent_bytes(server, len(server.cdf_content)) == len(server.cdf_content)
+
+
+def test_revalidation_downloads_a_changed_file(archive_server, tmp_path):
+    server = archive_server()
+    local_path = str(tmp_path / 'file.cdf')
+    changed, validators = revalidate_file(_url(server), local_path)
+
+    server.etag = '"changed"'
+    changed, validators = revalidate_file(_url(server), local_path, validators)
+
+    assert changed and validators['etag'] == '"changed"'
+    assert server.stats['not_modified'] == 0
+
+
+def test_validators_of_another_url_are_ignored(archive_server, tmp_path):
+    server = archive_server()
+    local_path = str(tmp_path / 'file.cdf')
+    changed, validators = revalidate_file(_url(server), local_path)
+    os.utime(local_path, (0, 0))
+
+    # Con el ETag de otro espejo (que coincide por casualidad) sólo cuenta la fecha del archivo local
+    changed, validators = revalidate_file(_url(server, 2), local_path, validators)
+
+    assert changed and validators['url'] == _url(server, 2)
+    assert server.stats['not_modified'] == 0
+
+
+@pytest.mark.parametrize('case', ['resume', 'complete', 'oversize', 'changed', 'other_url'])
+def test_partial_downloads(archive_server, tmp_path, case):
+    server = archive_server(file_size=200000)
+    content = server.cdf_content
+    local_path = str(tmp_path / 'file.cdf')
+    validators = {'url': _url(server), 'etag': server.etag, 'last_modified': None}
+    data = {'resume': content[:5000], 'complete': content, 'oversize': content + b'xx',
+            'changed': b'Z'*5000, 'other_url': b'Z'*5000}[case]
+    if case == 'changed':
+        validators['etag'] = '"other"'
+    elif case == 'other_url':
+        validators['url'] = _url(server, 2)
+    _write_part(local_path, data, validators)
+
+    assert download_file(_url(server), local_path)
+
+    with open(local_path, 'rb') as file:
+        assert file.read() == content
+    assert os.listdir(str(tmp_path)) == ['file.cdf']
+    assert pop_file_checksum(local_path) == file_checksum(local_path)
+    if case == 'resume':
+        # Sólo se transfiere lo que faltaba
+        assert _sent_bytes(server, len(content) - 5000) == len(content) - 5000
+    elif case == 'complete':
+        assert _sent_bytes(server, 0) == 0
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import socket
+import threading
+from Download_data import utils_lock
+from Download_data.utils_lock import (try_acquire_lock, acquire_lock, release_lock, is_lock_stale,
+                                      is_lock_owner_dead)
+
+
+def test_lock_is_exclusive(tmp_path):
+    lock_path = str(tmp_path / 'file.cdf.lock')
+
+    assert try_acquire_lock(lock_path)
+    assert not try_acquire_lock(lock_path)
+    release_lock(lock_path)
+    assert try_acquire_lock(lock_path)
+    release_lock(lock_path)
+    assert not os.path.exists(lock_path)
+
+
+def test_stale_lock_is_broken(tmp_path):
+    lock_path = str(tmp_path / 'file.cdf.lock')
+    with open(lock_path, 'w') as file:
+        json.dump({'host': 'other-node', 'pid': 1, 'time': 0}, file)
+    os.utime(lock_path, (time.time() - 1000, time.time() - 1000))
+
+    assert is_lock_stale(lock_path, stale_seconds=300)
+    assert try_acquire_lock(lock_path, stale_seconds=300)
+    release_lock(lock_path)
+
+
+def test_lock_of_dead_process_is_broken_at_once(tmp_path):
+    lock_path = str(tmp_path / 'file.cdf.lock')
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    with open(lock_path, 'w') as file:
+        json.dump({'host': socket.gethostname(), 'pid': pid, 'time': time.time()}, file)
+
+    assert not is_lock_stale(lock_path)
+    assert is_lock_owner_dead(lock_path)
+    assert try_acquire_lock(lock_path)
+    release_lock(lock_path)
+
+
+def test_acquire_lock_returns_when_the_file_appears(tmp_path):
+    local_path = str(tmp_path / 'file.cdf')
+    lock_path = local_path + '.lock'
+    assert try_acquire_lock(lock_path)
+
+    # Otro "proceso" termina el archivo y suelta el bloqueo mientras esperamos
+    def finish():
+        time.sleep(0.2)
+        open(local_path, 'w').close()
+        release_lock(lock_path)
+    threading.Thread(target=finish).start()
+
+    assert acquire_lock(lock_path, done_path=local_path, timeout=10) is False
+
+
+def test_heartbeat_refreshes_held_locks(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_lock, 'LOCK_HEARTBEAT_SECONDS', 0.05)
+    monkeypatch.setattr(utils_lock, '_heartbeat_thread', None)
+    lock_path = str(tmp_path / 'file.cdf.lock')
+
+    assert try_acquire_lock(lock_path)
+    try:
+        # Sin que nadie toque el bloqueo a mano (p. ej. una conexión colgada), el latido lo mantiene vivo
+        os.utime(lock_path, (time.time() - 1000, time.time() - 1000))
+        time.sleep(0.3)
+        assert not is_lock_stale(lock_path, stale_seconds=10)
+    finally:
+        release_lock(lock_path)
+
+    assert lock_path not in utils_lock._held_locks
+
+
+def _write_lock(lock_path, owner):
+    with open(lock_path, 'w') as file:
+        json.dump(owner, file)
+
+
+def test_a_live_lock_is_not_broken(tmp_path):
+    lock_path = str(tmp_path / 'file.cdf.lock')
+    # Otro proceso rompió el bloqueo viejo y ya creó el suyo cuando llegamos a apartarlo
+    _write_lock(lock_path, {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()})
+    inode = os.stat(lock_path).st_ino
+
+    assert not utils_lock._break_stale_lock(lock_path, 300)
+    assert os.stat(lock_path).st_ino == inode
+    assert os.listdir(str(tmp_path)) == ['file.cdf.lock']
+
+
+def test_a_newer_lock_is_left_in_place(tmp_path, monkeypatch):
+    lock_path = str(tmp_path / 'file.cdf.lock')
+    _write_lock(lock_path, {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()})
+
+    # Mientras el bloqueo vivo está apartado, un tercer proceso crea uno nuevo
+    def create_newer_lock(path):
+        _write_lock(lock_path, {'host': 'other-node', 'pid': 1, 'time': time.time()})
+        return False
+    monkeypatch.setattr(utils_lock, 'is_lock_owner_dead', create_newer_lock)
+
+    assert not utils_lock._break_stale_lock(lock_path, 300)
+    with open(lock_path) as file:
+        assert json.load(file)['host'] == 'other-node'
+    assert os.listdir(str(tmp_path)) == ['file.cdf.lock']
@@ -0,0 +1,24 @@
+from Download_data.utils_metrics import RunReport, emit_event
+from Download_data.utils_session import _get_netloc
+from Download_data.utils_download import download_file
+
+
+def test_netloc_of_a_connection_is_the_one_of_its_urls():
+    assert _get_netloc('cdaweb.gsfc.nasa.gov', None, 443) == 'cdaweb.gsfc.nasa.gov'
+    assert _get_netloc('cdaweb.gsfc.nasa.gov', 443, 443) == 'cdaweb.gsfc.nasa.gov'
+    assert _get_netloc('localhost', 8000, 80) == 'localhost:8000'
+    assert _get_netloc('::1', 8000, 80) == '[::1]:8000'
+
+
+def test_connect_events_are_grouped_with_their_host(archive_server, tmp_path):
+    server = archive_server()
+    url = server.url + 'omni/hro_1min/2013/omni_hro_1min_20130101_v01.cdf'
+
+    with RunReport() as report:
+        # Lo que emite la conexión del pool al abrirse
+        emit_event('connect', host=_get_netloc('127.0.0.1', server.server_port, 80), seconds=0.001)
+        download_file(url, str(tmp_path / 'file.cdf'))
+
+    hosts = report.summary()['hosts']
+    assert list(hosts) == ['127.0.0.1:%d' % server.server_port]
+    assert {'connect', 'first_byte', 'transfer'} <= set(hosts['127.0.0.1:%d' % server.server_port])
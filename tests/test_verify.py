@@ -0,0 +1,66 @@
+import os
+from Download_data.verify import verify_CDFfiles
+from Download_data.inventory import get_inventory_callback, get_stored_files, get_relative_path
+from Download_data.download_engine import run_download_jobs
+from Download_data.omni.download_omni import get_jobs_OMNI
+from Download_data.utils_download import file_checksum
+
+
+def _download(server, local_root_dir):
+    jobs = get_jobs_OMNI('2013-01-01', '2013-03-31', server.url + 'omni/', local_root_dir + '/')
+    recorder = get_inventory_callback(local_root_dir)
+    try:
+        run_download_jobs(jobs, on_complete=recorder, progress=False)
+    finally:
+        recorder.close()
+    return [local_path for url, local_path in jobs]
+
+
+def _rows(local_root_dir):
+    return dict((row['path'], row) for row in get_stored_files(local_root_dir, 'hro'))
+
+
+def test_truncated_files_are_requeued(archive_server, tmp_path):
+    local_root_dir = str(tmp_path)
+    paths = _download(archive_server(), local_root_dir)
+    with open(paths[0], 'r+b') as file:
+        file.truncate(100)
+
+    corrupt = verify_CDFfiles(local_root_dir, n_processes=2)
+
+    assert list(corrupt) == [paths[0]]
+    assert not os.path.exists(paths[0])
+    assert get_relative_path(local_root_dir, paths[0]) not in _rows(local_root_dir)
+
+
+def test_files_replaced_after_they_were_recorded_are_kept(archive_server, tmp_path):
+    local_root_dir = str(tmp_path)
+    paths = _download(archive_server(), local_root_dir)
+    # Un worker sin inventario reemplaza el archivo por otra versión válida
+    newer = archive_server(file_size=8192).cdf_content
+    with open(paths[1], 'wb') as file:
+        file.write(newer)
+    os.utime(paths[1], (os.path.getmtime(paths[1]) + 10,)*2)
+
+    corrupt = verify_CDFfiles(local_root_dir, n_processes=2)
+
+    assert corrupt == {}
+    with open(paths[1], 'rb') as file:
+        assert file.read() == newer
+    row = _rows(local_root_dir)[get_relative_path(local_root_dir, paths[1])]
+    assert row['size'] == len(newer) and row['checksum'] == file_checksum(paths[1])
+
+
+def test_valid_files_that_do_not_match_the_inventory_are_not_deleted(archive_server, tmp_path):
+    local_root_dir = str(tmp_path)
+    paths = _download(archive_server(), local_root_dir)
+    stat = os.stat(paths[2])
+    with open(paths[2], 'r+b') as file:
+        file.seek(stat.st_size//2)
+        file.write(b'\xff')
+    os.utime(paths[2], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    corrupt = verify_CDFfiles(local_root_dir, n_processes=2)
+
+    assert corrupt == {paths[2]: 'checksum does not match the inventory'}
+    assert os.path.exists(paths[2])
@@ -0,0 +1,91 @@
+import os
+import time
+import pytest
+from Download_data import work_queue
+from Download_data.work_queue import (create_queue, claim_shard, complete_shard, requeue_expired, get_queue_status,
+                                      run_worker, merge_reports)
+from Download_data.inventory import get_inventory_path, get_stored_files
+from Download_data.omni.download_omni import get_jobs_OMNI
+
+
+def _jobs(server, local_root_dir):
+    return get_jobs_OMNI('2013-01-01', '2013-12-31', server.url + 'omni/', str(local_root_dir) + '/')
+
+
+def test_shards_are_claimed_once_and_requeued_when_expired(tmp_path):
+    queue_dir = str(tmp_path / 'queue')
+    jobs = [('http://host/%d.cdf' % i, '/data/%d.cdf' % i) for i in range(5)]
+    create_queue(queue_dir, jobs, shard_size=2)
+    assert get_queue_status(queue_dir) == {'pending': 3, 'claimed': 0, 'done': 0}
+
+    claimed_path, shard_jobs = claim_shard(queue_dir, 'worker-1')
+    assert [tuple(job) for job in shard_jobs] == jobs[:2]
+    assert get_queue_status(queue_dir)['claimed'] == 1
+
+    # El worker "muere": su lease vence y el shard vuelve a la cola
+    os.utime(claimed_path, (time.time() - 100, time.time() - 100))
+    requeue_expired(queue_dir, lease_seconds=10)
+    assert get_queue_status(queue_dir) == {'pending': 3, 'claimed': 0, 'done': 0}
+
+    claimed_path, shard_jobs = claim_shard(queue_dir, 'worker-2')
+    assert complete_shard(queue_dir, claimed_path)
+    assert get_queue_status(queue_dir)['done'] == 1
+
+
+def test_a_shard_being_claimed_is_not_requeued(tmp_path, monkeypatch):
+    queue_dir = str(tmp_path / 'queue')
+    create_queue(queue_dir, [('http://host/0.cdf', '/data/0.cdf')])
+    # El shard se creó hace rato: su mtime es más viejo que el lease
+    pending_path = os.path.join(queue_dir, 'pending', 'shard_00000.json')
+    os.utime(pending_path, (time.time() - 100, time.time() - 100))
+
+    # Otro worker revisa los leases justo después del rename del claim
+    rename = os.rename
+    requeued = []
+    def rename_and_requeue(source, target):
+        rename(source, target)
+        if os.sep + 'claimed' + os.sep in target:
+            requeued.append(requeue_expired(queue_dir, lease_seconds=10))
+    monkeypatch.setattr(work_queue.os, 'rename', rename_and_requeue)
+
+    claimed_path, shard_jobs = claim_shard(queue_dir, 'worker-1', lease_seconds=10)
+
+    assert requeued == [0]
+    assert os.path.exists(claimed_path)
+    assert get_queue_status(queue_dir) == {'pending': 0, 'claimed': 1, 'done': 0}
+
+
+def test_inventory_of_a_worker_needs_local_root_dir(tmp_path):
+    with pytest.raises(ValueError):
+        run_worker(str(tmp_path / 'queue'), use_inventory=True)
+
+
+def test_workers_download_the_queue_and_merge_updates_the_inventory(archive_server, tmp_path):
+    server = archive_server()
+    queue_dir = str(tmp_path / 'queue')
+    local_root_dir = str(tmp_path / 'data')
+    jobs = _jobs(server, local_root_dir)
+    create_queue(queue_dir, jobs, shard_size=5)
+
+    # Las rutas locales vienen de los trabajos: el worker no necesita local_root_dir sin inventario
+    reports = [run_worker(queue_dir, worker_id='worker-%d' % i, n_workers=2) for i in range(2)]
+
+    assert sum(report['downloaded'] for report in reports) == 12
+    assert all(os.path.exists(job[1]) for job in jobs)
+    # Los workers no tocan el inventario; lo escribe merge_reports, desde un solo proceso
+    assert not os.path.exists(get_inventory_path(local_root_dir))
+
+    merged = merge_reports(queue_dir, str(tmp_path / 'report.json'), local_root_dir=local_root_dir)
+    assert merged['downloaded'] == 12 and merged['failed'] == []
+    assert merged['queue'] == {'pending': 0, 'claimed': 0, 'done': 3}
+    assert len(get_stored_files(local_root_dir, 'hro')) == 12
+
+
+def test_worker_command_line_records_the_inventory(archive_server, tmp_path):
+    server = archive_server()
+    queue_dir = str(tmp_path / 'queue')
+    local_root_dir = str(tmp_path / 'data')
+    create_queue(queue_dir, _jobs(server, local_root_dir), shard_size=5)
+
+    assert work_queue.main(['worker', queue_dir, '--workers', '2', '--inventory', local_root_dir]) == 0
+    assert len(get_stored_files(local_root_dir, 'hro')) == 12